@@ -0,0 +1,101 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+"""Decide how many workers are needed to keep up with the queues
+
+The controller regularly samples how many records are waiting in the queues and how many were
+processed since the last sample. From those it estimates how fast records arrive and how many
+records a worker can process per second, then how many workers it takes to process the arriving
+records while draining the backlog in a reasonable time.
+"""
+
+import math
+from typing import Optional
+
+from .config import Config
+
+
+# How much the throughput of the workers measured in a new sample weighs in the estimate
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class Autoscaler:
+    def __init__(self, config: Config) -> None:
+        self.min_workers = config.main.autoscale_min_workers
+        self.max_workers = config.main.number_of_workers
+        self.drain_seconds = config.main.autoscale_drain_seconds
+        self.cooldown_seconds = config.main.autoscale_cooldown_seconds
+
+        # How many records per second a busy worker processes
+        self.worker_throughput: Optional[float] = None
+
+        self._last_time: Optional[float] = None
+        self._last_backlog = 0
+        self._scale_down_since: Optional[float] = None
+        self._scale_down_to = 0
+
+    def _get_wanted_workers(self, elapsed: float, backlog: int, num_processed: int,
+                            num_workers: int) -> int:
+        if self._last_backlog and backlog and num_processed:
+            # The workers had records waiting for them during the whole sample, so they processed
+            # as many as they could
+            throughput = num_processed / elapsed / num_workers
+
+            if self.worker_throughput is None:
+                self.worker_throughput = throughput
+            else:
+                self.worker_throughput += THROUGHPUT_SMOOTHING * (
+                    throughput - self.worker_throughput)
+
+        if self.worker_throughput is None:
+            # The workers were never busy yet, try with one more or one less
+            return num_workers + 1 if backlog else num_workers - 1
+
+        arrival_rate = max(num_processed + backlog - self._last_backlog, 0) / elapsed
+        wanted_rate = arrival_rate + backlog / self.drain_seconds
+
+        return math.ceil(wanted_rate / self.worker_throughput)
+
+    def update(self, now: float, backlog: int, num_processed: int, num_workers: int) -> int:
+        """Get how many workers should be running
+
+        The backlog is the number of records currently waiting in the queues, num_processed the
+        number of records processed since the last update, by num_workers workers.
+
+        Scaling up happens right away, but scaling down only once fewer workers were needed for
+        the whole cooldown period, to not stop and start workers all the time.
+        """
+        if self._last_time is None or now <= self._last_time:
+            wanted = num_workers
+
+        else:
+            wanted = self._get_wanted_workers(now - self._last_time, backlog, num_processed,
+                                              num_workers)
+
+        self._last_time = now
+        self._last_backlog = backlog
+        wanted = max(self.min_workers, min(wanted, self.max_workers))
+
+        if wanted >= num_workers:
+            self._scale_down_since = None
+            return wanted
+
+        if self._scale_down_since is None:
+            self._scale_down_since = now
+            self._scale_down_to = wanted
+
+        else:
+            self._scale_down_to = max(self._scale_down_to, wanted)
+
+        if now - self._scale_down_since < self.cooldown_seconds:
+            return num_workers
+
+        self._scale_down_since = None
+
+        return self._scale_down_to
@@ -0,0 +1,116 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Measure how fast the handlers process records"""
+
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+import logging
+import multiprocessing
+import statistics
+import time
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Mapping, Optional
+
+from ..config import PostgreSQL as PgConfig
+from ..model import Db
+from . import records
+
+
+log = logging.getLogger(__name__)
+
+HANDLERS = {
+    'activation-v1': 'azafea.event_processors.endless.activation.v1',
+    'ping-v1': 'azafea.event_processors.endless.ping.v1',
+    'metrics-v2': 'azafea.event_processors.endless.metrics.v2',
+    'metrics-v3': 'azafea.event_processors.endless.metrics.v3',
+}
+SESSIONS = ('null', 'postgresql')
+
+
+class NullSession:
+    """A session which does nothing, to measure the cost of the handlers alone
+
+    Calling it or getting any of its attributes returns itself, it is an empty iterable and a
+    context manager, which is all the handlers need.
+    """
+    def __getattr__(self, name: str) -> 'NullSession':
+        return self
+
+    def __call__(self, *args: Any, **kwargs: Any) -> 'NullSession':
+        return self
+
+    def __enter__(self) -> 'NullSession':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(())
+
+
+def measure(process: Callable[[Any, bytes], None], values: List[bytes],
+            session_scope: ContextManager[Any]) -> Dict[str, Any]:
+    latencies = []
+    num_errors = 0
+    start = time.perf_counter()
+
+    for value in values:
+        before = time.perf_counter()
+
+        try:
+            # Just like in the processor, each record is processed and committed on its own
+            with session_scope as dbsession:
+                process(dbsession, value)
+
+        except Exception:
+            log.exception('Failed to process a record')
+            num_errors += 1
+
+        latencies.append(time.perf_counter() - before)
+
+    elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+
+    return {
+        'records': len(values),
+        'errors': num_errors,
+        'seconds': elapsed,
+        'records_per_second': len(values) / elapsed,
+        'latency_ms': {
+            'p50': percentiles[49] * 1000,
+            'p99': percentiles[98] * 1000,
+        },
+    }
+
+
+def run(handler: str, session: str, num_records: int, mix: Mapping[str, float],
+        events_per_record: int, pgconfig: Optional[PgConfig] = None) -> Dict[str, Any]:
+    """Generate records for the handler, then process them and return the measurements"""
+    process = import_module(HANDLERS[handler]).process  # type: ignore
+    values = records.generate(handler, num_records, mix, events_per_record)
+
+    if session == 'postgresql':
+        assert pgconfig is not None
+        session_scope: ContextManager[Any] = Db(pgconfig)
+
+    else:
+        session_scope = NullSession()
+
+    result = measure(process, values, session_scope)
+    result.update(handler=handler, session=session)
+
+    return result
+
+
+def run_isolated(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+    """Same as run(), in a fresh process so the caches of the handlers start empty"""
+    context = multiprocessing.get_context('fork')
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run, *args, **kwargs).result()
@@ -0,0 +1,83 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Compare the image id parsing with what it used to be
+
+Run it with: python -m azafea.benchmarks.image
+"""
+
+from datetime import datetime, timezone
+import timeit
+from typing import Dict, List
+
+from azafea.event_processors.endless.image import (
+    IMAGE_PARSING_PATTERN, _parse_endless_os_image, parse_endless_os_image)
+
+
+# Roughly the number of distinct image ids we see in production
+NUM_IMAGE_IDS = 2000
+
+
+def get_image_ids(count: int = NUM_IMAGE_IDS) -> List[str]:
+    return [
+        f'eos-eos3.{i % 10}-amd64-amd64.{190101 + i % 28:06d}-{i % 24:02d}{i % 60:02d}00.base'
+        for i in range(count)
+    ]
+
+
+def parse_with_strptime(image_id: str) -> datetime:
+    # How the image timestamp was parsed before it was memoized and sliced
+    match = IMAGE_PARSING_PATTERN.match(image_id)
+    assert match is not None
+
+    date = datetime.strptime(f"20{match.group('date')}", '%Y%m%d')
+    time = datetime.strptime(match.group('time'), '%H%M%S')
+
+    return datetime(date.year, date.month, date.day, time.hour, time.minute, time.second,
+                    tzinfo=timezone.utc)
+
+
+def run(number: int = 50) -> Dict[str, float]:
+    """Parse the image ids in various ways, and return the time each took per id, in µs"""
+    image_ids = get_image_ids()
+    uncached = _parse_endless_os_image.__wrapped__  # type: ignore
+
+    def strptime() -> None:
+        for image_id in image_ids:
+            parse_with_strptime(image_id)
+
+    def slicing() -> None:
+        for image_id in image_ids:
+            uncached(image_id, True)
+
+    def memoized() -> None:
+        for image_id in image_ids:
+            parse_endless_os_image(image_id)
+
+    _parse_endless_os_image.cache_clear()
+    memoized()
+
+    results = {}
+
+    for name, func in (('strptime', strptime), ('slicing', slicing), ('memoized', memoized)):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        results[name] = seconds * 1000000 / number / len(image_ids)
+
+    return results
+
+
+def main() -> None:
+    results = run()
+    reference = results['strptime']
+
+    for name, microseconds in results.items():
+        print(f'{name:>10}: {microseconds:6.2f} µs per image id ({reference / microseconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
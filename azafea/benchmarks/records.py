@@ -0,0 +1,235 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Generate synthetic records, as they would be pushed to the Redis queues"""
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import json
+from random import Random
+from typing import Any, Callable, Dict, List, Mapping, Tuple
+from uuid import UUID
+
+
+# These are meant to look like the real ones, not to be exhaustive: the images and vendors in
+# particular are repeated a lot, which is what the caches of the handlers rely on
+IMAGES = (
+    'eos-eos3.7-amd64-amd64.190419-225606.base',
+    'eos-eos3.9-amd64-amd64.200910-084529.en',
+    'eos-eos4.0-amd64-amd64.221014-103929.pt_BR',
+    'eosoem-eos3.6-armv7hl-ec100.190419-225606.base',
+    'eos-master-amd64-nexthw.211018-163812.fr',
+    'unknown',
+)
+VENDORS = ('ASUSTeK COMPUTER INC.', 'Dell Inc.', 'Hewlett-Packard', 'LENOVO', 'Acer', 'unknown')
+PRODUCTS = ('ZenBook', 'Inspiron 15', 'HP Laptop 15', 'ThinkPad X1', 'Aspire 5')
+COUNTRIES = ('BR', 'FR', 'GB', 'ID', 'MX', 'US', 'ZA', None)
+APP_IDS = ('org.gnome.Calculator', 'org.mozilla.Firefox', 'com.endlessm.encyclopedia.en',
+           'org.libreoffice.LibreOffice', 'com.valvesoftware.Steam')
+
+
+def _created_at(rng: Random) -> str:
+    created_at = datetime.now(tz=timezone.utc) - timedelta(seconds=rng.randrange(86400))
+
+    return created_at.strftime('%Y-%m-%d %H:%M:%S.%fZ')
+
+
+def activation_v1(rng: Random) -> bytes:
+    return json.dumps({
+        'image': rng.choice(IMAGES),
+        'vendor': rng.choice(VENDORS),
+        'product': rng.choice(PRODUCTS),
+        'release': '3.9.0',
+        'dualboot': rng.choice((True, False)),
+        'live': rng.choice((True, False)),
+        'country': rng.choice(COUNTRIES),
+        'latitude': rng.randrange(-90, 90) + 0.5,
+        'longitude': rng.randrange(-180, 180) + 0.5,
+        'created_at': _created_at(rng),
+    }).encode('utf-8')
+
+
+def ping_v1(rng: Random) -> bytes:
+    return json.dumps({
+        'image': rng.choice(IMAGES),
+        'vendor': rng.choice(VENDORS),
+        'product': rng.choice(PRODUCTS),
+        'release': '3.9.0',
+        'dualboot': rng.choice((True, False, None)),
+        'count': rng.randrange(1000),
+        'country': rng.choice(COUNTRIES),
+        'metrics_enabled': rng.choice((True, False)),
+        'metrics_environment': rng.choice(('production', 'dev')),
+        'created_at': _created_at(rng),
+    }).encode('utf-8')
+
+
+def _uuid_bytes(event_id: str) -> bytes:
+    return UUID(event_id).bytes
+
+
+def _received_at_bytes() -> bytes:
+    received_at = datetime.now(tz=timezone.utc)
+
+    return int(received_at.timestamp() * 1000000).to_bytes(8, 'little')
+
+
+# For each kind of event, the UUID and a function building a random payload. The "unknown" events
+# have a UUID no model is registered for, and the "invalid" ones a payload of the wrong type.
+EventFactory = Tuple[str, Callable[[Random], Any]]
+
+
+@lru_cache(maxsize=None)
+def _v2_events() -> Dict[str, EventFactory]:
+    from gi.repository import GLib
+
+    return {
+        'image-version': ('6b1c1cfc-bc36-438c-0647-dacd5878f2b3',
+                          lambda rng: GLib.Variant('s', rng.choice(IMAGES[:-1]))),
+        'network-id': ('38eb48f8-e131-9b57-77c6-35e0590c82fd',
+                       lambda rng: GLib.Variant('u', rng.randrange(2 ** 32))),
+        'updater-failure': ('927d0f61-4890-4912-a513-b2cb0205908f',
+                            lambda rng: GLib.Variant('(ss)', ('eos-updater', 'Network error'))),
+        'windows-app-opened': ('cf09194a-3090-4782-ab03-87b2f1515aed',
+                               lambda rng: GLib.Variant('as', ['setup.exe'])),
+        'shell-app-is-open': ('b5e11a3d-13f8-4219-84fd-c9ba0bf3d1f0',
+                              lambda rng: GLib.Variant('s', rng.choice(APP_IDS))),
+        'unknown': ('ffffffff-ffff-ffff-ffff-ffffffffffff', lambda rng: None),
+        'invalid': ('927d0f61-4890-4912-a513-b2cb0205908f', lambda rng: GLib.Variant('s', '')),
+    }
+
+
+@lru_cache(maxsize=None)
+def _v3_events() -> Dict[str, EventFactory]:
+    from gi.repository import GLib
+
+    return {
+        'parental-controls-blocked-flatpak-run': (
+            'afca2515-e9ce-43aa-b355-7663c770b4b6',
+            lambda rng: GLib.Variant('s', rng.choice(APP_IDS))),
+        'updater-failure': ('927d0f61-4890-4912-a513-b2cb0205908f',
+                            lambda rng: GLib.Variant('(ss)', ('eos-updater', 'Network error'))),
+        'windows-app-opened': ('cf09194a-3090-4782-ab03-87b2f1515aed',
+                               lambda rng: GLib.Variant('as', ['setup.exe'])),
+        'daily-app-usage': ('49d0451a-f706-4f50-81d2-70cc0ec923a4',
+                            lambda rng: GLib.Variant('s', rng.choice(APP_IDS))),
+        'daily-users': ('a3826320-9192-446a-8886-e2129c0ce302', lambda rng: None),
+        'unknown': ('ffffffff-ffff-ffff-ffff-ffffffffffff', lambda rng: None),
+        'invalid': ('927d0f61-4890-4912-a513-b2cb0205908f', lambda rng: GLib.Variant('s', '')),
+    }
+
+
+# Aggregate events only exist in the v3 protocol, and sequences only in the v2 one
+V2_SEQUENCES = ('shell-app-is-open', )
+V3_AGGREGATES = ('daily-app-usage', 'daily-users')
+
+
+def get_event_names(handler: str) -> List[str]:
+    """Get the names of the kinds of events which can be mixed in metrics records"""
+    if handler == 'metrics-v2':
+        return sorted(_v2_events())
+
+    if handler == 'metrics-v3':
+        return sorted(_v3_events())
+
+    return []
+
+
+def _pick_events(rng: Random, mix: Mapping[str, float], num_events: int) -> List[str]:
+    names = sorted(mix)
+
+    return rng.choices(names, weights=[mix[name] for name in names], k=num_events)
+
+
+def metrics_v2(rng: Random, mix: Mapping[str, float], num_events: int) -> bytes:
+    from gi.repository import GLib
+
+    events = _v2_events()
+    singulars: List[Tuple[int, bytes, int, Any]] = []
+    sequences: List[Tuple[int, bytes, List[Tuple[int, Any]]]] = []
+
+    for i, name in enumerate(_pick_events(rng, mix, num_events)):
+        event_id, new_payload = events[name]
+        user_id = rng.randrange(1000, 1010)
+
+        if name in V2_SEQUENCES:
+            sequences.append((user_id, _uuid_bytes(event_id), [
+                (1000000 * i, new_payload(rng)),
+                (1000000 * i + rng.randrange(1, 3600) * 1000000000, None),
+            ]))
+
+        else:
+            singulars.append((user_id, _uuid_bytes(event_id), 1000000 * i, new_payload(rng)))
+
+    request = GLib.Variant('(ixxaya(uayxmv)a(uayxxmv)a(uaya(xmv)))', (
+        rng.randrange(100),                                   # send number
+        2000000,                                              # relative timestamp
+        int(datetime.now(tz=timezone.utc).timestamp() * 1000000000),  # absolute timestamp
+        rng.randbytes(16),                                    # machine id
+        singulars,
+        [],                                                   # aggregates
+        sequences,
+    ))
+
+    return _received_at_bytes() + request.get_data_as_bytes().get_data()
+
+
+def metrics_v3(rng: Random, mix: Mapping[str, float], num_events: int) -> bytes:
+    from gi.repository import GLib
+
+    events = _v3_events()
+    singulars: List[Tuple[bytes, str, int, Any]] = []
+    aggregates: List[Tuple[bytes, str, str, int, Any]] = []
+
+    for i, name in enumerate(_pick_events(rng, mix, num_events)):
+        event_id, new_payload = events[name]
+
+        if name in V3_AGGREGATES:
+            aggregates.append((_uuid_bytes(event_id), '4.0.0', '2020-06-15', rng.randrange(1000),
+                               new_payload(rng)))
+
+        else:
+            singulars.append((_uuid_bytes(event_id), '4.0.0', 1000000 * i, new_payload(rng)))
+
+    request = GLib.Variant('(xxsa{ss}ya(aysxmv)a(ayssumv))', (
+        2000000,                                              # relative timestamp
+        int(datetime.now(tz=timezone.utc).timestamp() * 1000000000),  # absolute timestamp
+        rng.choice(IMAGES[:-1]),
+        {'id': str(rng.randrange(10)), 'city': '', 'country': rng.choice(COUNTRIES[:-1])},
+        rng.randrange(4),                                     # dual boot and live flags
+        singulars,
+        aggregates,
+    ))
+
+    return _received_at_bytes() + request.get_data_as_bytes().get_data()
+
+
+def generate(handler: str, num_records: int, mix: Mapping[str, float], events_per_record: int,
+             seed: int = 0) -> List[bytes]:
+    """Generate records for one of the handlers
+
+    The mix maps the names of the kinds of events to their relative weights in metrics records. If
+    it is empty, all kinds of events are equally likely. It is ignored for the other handlers.
+    """
+    rng = Random(seed)
+
+    if handler == 'activation-v1':
+        return [activation_v1(rng) for _ in range(num_records)]
+
+    if handler == 'ping-v1':
+        return [ping_v1(rng) for _ in range(num_records)]
+
+    mix = mix or {name: 1 for name in get_event_names(handler)}
+
+    if handler == 'metrics-v2':
+        return [metrics_v2(rng, mix, events_per_record) for _ in range(num_records)]
+
+    if handler == 'metrics-v3':
+        return [metrics_v3(rng, mix, events_per_record) for _ in range(num_records)]
+
+    raise ValueError(f'Unknown handler: {handler}')
@@ -8,27 +8,111 @@
 
 
 import argparse
+from datetime import datetime, timezone
+import json
 import logging
+import platform
+import socket
+import time
+from typing import Any, Dict, Tuple
 
 import requests
 from alembic.command import revision as make_db_revision, upgrade as upgrade_db
 
 from redis import Redis
-from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
 from sqlalchemy.exc import ProgrammingError
 
+from ..benchmarks.handlers import HANDLERS, SESSIONS, run_isolated as run_benchmark
+from ..benchmarks.records import get_event_names
 from ..config import Config
 from ..controller import Controller
 from ..migrations.utils import get_alembic_config, get_migration_heads, get_queue_migrations_path
 from ..model import Db, PostgresqlConnectionError, views
+from ..monitoring import get_stage_timings
+from ..profiling import get_default_profile_request
+from ..queues import (
+    STREAM_DATA_FIELD, get_profile_request_key, get_retry_queue, get_stream_status)
 from ..utils import progress
-from .errors import ConnectionErrorExit, NoEventQueueExit, UnknownErrorExit
+from .errors import ConnectionErrorExit, MetricsDisabledExit, NoEventQueueExit, UnknownErrorExit
 
 
 log = logging.getLogger(__name__)
 
 
+def _event_weight(value: str) -> Tuple[str, float]:
+    name, sep, weight = value.partition('=')
+
+    try:
+        return name, float(weight) if sep else 1.0
+
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid event weight: {value!r}')
+
+
+def _num_records(value: str) -> int:
+    try:
+        num_records = int(value)
+
+    except ValueError:
+        num_records = 0
+
+    # Percentiles of the latencies can't be computed with fewer
+    if num_records < 2:
+        raise argparse.ArgumentTypeError(f'Invalid number of records, at least 2 are needed: '
+                                         f'{value!r}')
+
+    return num_records
+
+
+def _rate(value: str) -> int:
+    try:
+        rate = int(value)
+
+    except ValueError:
+        rate = -1
+
+    if rate < 0:
+        raise argparse.ArgumentTypeError(f'Invalid rate: {value!r}')
+
+    return rate
+
+
+def _batch_size(value: str) -> int:
+    try:
+        batch_size = int(value)
+
+    except ValueError:
+        batch_size = 0
+
+    if batch_size < 1:
+        raise argparse.ArgumentTypeError(f'Invalid batch size: {value!r}')
+
+    return batch_size
+
+
 def register_commands(subs: argparse._SubParsersAction) -> None:
+    benchmark = subs.add_parser('benchmark',
+                                help='Measure how fast the handlers process synthetic records',
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    benchmark.add_argument('--handler', action='append', choices=HANDLERS, dest='handlers',
+                           help='The handler to benchmark, can be repeated (default: all)')
+    benchmark.add_argument('--session', action='append', choices=SESSIONS, dest='sessions',
+                           help='Whether to process the records with a session which does '
+                                'nothing, or with a real PostgreSQL one which inserts them in '
+                                'the configured database; can be repeated (default: null)')
+    benchmark.add_argument('--records', type=_num_records, default=1000,
+                           help='The number of records to process for each handler')
+    benchmark.add_argument('--events-per-record', type=int, default=10,
+                           help='The number of events in each metrics record')
+    benchmark.add_argument('--mix', action='append', type=_event_weight, default=[],
+                           metavar='EVENT[=WEIGHT]',
+                           help='The kinds of events in metrics records and their relative '
+                                'weights, can be repeated (default: all kinds, equally)')
+    benchmark.add_argument('-o', '--output', help='Write the results to this file, as JSON '
+                                                  '(default: print them)')
+    benchmark.set_defaults(subcommand=do_benchmark)
+
     dropdb = subs.add_parser('dropdb', help='Drop the tables in the database')
     dropdb.set_defaults(subcommand=do_dropdb)
 
@@ -45,6 +129,23 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
     migratedb = subs.add_parser('migratedb', help='Migrate the database')
     migratedb.set_defaults(subcommand=do_migratedb)
 
+    profile_defaults = get_default_profile_request()
+    profile = subs.add_parser('profile-worker',
+                              help='Ask the workers of a running controller to profile the next '
+                                   'events they process',
+                              formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    profile.add_argument('--worker', help='The name of the worker to profile, e.g "worker-1" '
+                                          '(default: all of them)')
+    profile.add_argument('--records', type=int, default=profile_defaults['records'],
+                         help='Stop profiling after this number of events')
+    profile.add_argument('--seconds', type=int, default=profile_defaults['seconds'],
+                         help='Stop profiling after this number of seconds')
+    profile.add_argument('--output-dir', default=profile_defaults['directory'],
+                         help='The directory in which the workers write the profiles')
+    profile.add_argument('--host', default=socket.gethostname(),
+                         help='The host on which the controller runs')
+    profile.set_defaults(subcommand=do_profile_worker)
+
     print_config = subs.add_parser('print-config',
                                    help='Print the loaded configuration then exit')
     print_config.set_defaults(subcommand=do_print_config)
@@ -53,12 +154,30 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                              help='Pull events from the error queue and send them back to the '
                                   'incoming one')
     replay.add_argument('queue', help='The name of the queue to replay, e.g "ping-1"')
+    replay.add_argument('--batch-size', type=_batch_size, default=1000,
+                        help='How many events to move back in a single round trip to Redis')
+    replay.add_argument('--rate', type=_rate, default=0,
+                        help='Move at most this number of events per second, so as to not '
+                             'overwhelm the workers (default: as fast as possible)')
+    replay.add_argument('--dry-run', action='store_true',
+                        help='Only print how many events would be moved back')
     replay.set_defaults(subcommand=do_replay)
 
+    queue_status = subs.add_parser('queue-status',
+                                   help='Print how many events are waiting in each queue')
+    queue_status.set_defaults(subcommand=do_queue_status)
+
     refresh = subs.add_parser('refresh-views',
                               help='Refresh the content of the materialized views')
     refresh.set_defaults(subcommand=do_refresh_views)
 
+    stage_timings = subs.add_parser('stage-timings',
+                                    help='Print how much time the running workers spent in each '
+                                         'stage of processing events')
+    stage_timings.add_argument('--host', default='localhost',
+                               help='The host on which the controller serves the metrics')
+    stage_timings.set_defaults(subcommand=do_stage_timings)
+
     deploy_documentation = subs.add_parser('deploy-documentation',
                                            help='Deploy documentation on ReadTheDocs')
     deploy_documentation.add_argument('-v', '--version', default='latest',
@@ -70,6 +189,46 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
     run.set_defaults(subcommand=do_run)
 
 
+def do_benchmark(config: Config, args: argparse.Namespace) -> None:
+    handlers = args.handlers or list(HANDLERS)
+    # Never write into the configured database, which could be the production one, unless asked
+    sessions = args.sessions or ['null']
+    mix = dict(args.mix)
+    known_events = {name for handler in handlers for name in get_event_names(handler)}
+    unknown_events = sorted(set(mix) - known_events)
+
+    if unknown_events:
+        log.warning('Ignoring unknown events in the mix: %s', ', '.join(unknown_events))
+
+    results: Dict[str, Any] = {
+        'date': datetime.now(tz=timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'records': args.records,
+        'events_per_record': args.events_per_record,
+        'mix': mix,
+        'results': [],
+    }
+
+    for handler in handlers:
+        handler_events = get_event_names(handler)
+        handler_mix = {name: weight for name, weight in mix.items() if name in handler_events}
+
+        for session in sessions:
+            # Each benchmark runs in a new process, so the caches of the handlers start empty
+            results['results'].append(run_benchmark(
+                handler, session, args.records, handler_mix, args.events_per_record,
+                pgconfig=config.postgresql))
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+        return
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    log.info('Wrote the benchmark results to %s', args.output)
+
+
 def do_dropdb(config: Config, args: argparse.Namespace) -> None:
     if not config.queues:
         log.error('Could not clear the database: no event queue configured')
@@ -149,6 +308,33 @@ def do_migratedb(config: Config, args: argparse.Namespace) -> None:
     log.info('Successfully migrated the database')
 
 
+def do_profile_worker(config: Config, args: argparse.Namespace) -> None:
+    redis = Redis(
+        host=config.redis.host,
+        port=config.redis.port,
+        password=config.redis.password,
+        ssl=config.redis.ssl,
+    )
+    request = {
+        'worker': args.worker,
+        'records': args.records,
+        'seconds': args.seconds,
+        'directory': args.output_dir,
+    }
+
+    try:
+        # The controller checks for requests every second, don't leave them around if it isn't
+        # running
+        redis.set(get_profile_request_key(args.host), json.dumps(request), ex=10)
+
+    except RedisConnectionError as e:
+        log.error('Could not connect to Redis: %s', e)
+        raise ConnectionErrorExit()
+
+    log.info('Asked the controller on %s to profile %s, the profiles will be written in %s',
+             args.host, args.worker or 'all workers', args.output_dir)
+
+
 def do_print_config(config: Config, args: argparse.Namespace) -> None:
     print('----- BEGIN -----')
     print(config)
@@ -184,24 +370,107 @@ def do_replay(config: Config, args: argparse.Namespace) -> None:
     # new ones added while we pull, but then we can just rerun the command as needed.
     num_errors = redis.llen(error_queue)
 
-    for i in range(num_errors):
-        failed_event = redis.rpop(error_queue)
+    if args.dry_run:
+        num_retrying = redis.zcard(get_retry_queue(args.queue))
+        print(f'{args.queue}: {num_errors} errors would be moved back, {num_retrying} retrying')
+        return
 
-        if failed_event is None:
-            log.warning(f'"{args.queue}" emptied faster than planned after {i} elements out of '
-                        f'{num_errors}')
-            break
+    num_moved = 0
+    start = time.monotonic()
+
+    # Moving a whole batch at once and only then waiting would defeat the purpose of the rate
+    max_batch_size = min(args.batch_size, args.rate) if args.rate else args.batch_size
+
+    while num_moved < num_errors:
+        batch_size = min(max_batch_size, num_errors - num_moved)
+        failed_events = []
 
         try:
-            redis.lpush(args.queue, failed_event)
+            if config.queues[args.queue].backend == 'stream':
+                failed_events = redis.rpop(error_queue, batch_size) or []
+
+                with redis.pipeline() as pipeline:
+                    for failed_event in failed_events:
+                        pipeline.xadd(args.queue, {STREAM_DATA_FIELD: failed_event})
+
+                    pipeline.execute()
+
+            else:
+                # Each event is moved on the server, so none can be lost on the way
+                with redis.pipeline() as pipeline:
+                    for _ in range(batch_size):
+                        pipeline.rpoplpush(error_queue, args.queue)
+
+                    failed_events = [event for event in pipeline.execute() if event is not None]
 
         except Exception:
-            log.exception(f'Failed to push {failed_event} back in "{args.queue}":')
+            if failed_events:
+                # They were pulled from the error queue, make sure they can be recovered
+                log.exception(f'Failed to push {failed_events} back in "{args.queue}":')
+
+            else:
+                log.exception(f'Failed to move failed events back to "{args.queue}":')
+
             raise UnknownErrorExit()
 
+        num_moved += len(failed_events)
+        progress(num_moved, num_errors)
+
+        if len(failed_events) < batch_size:
+            log.warning(f'"{args.queue}" emptied faster than planned after {num_moved} elements '
+                        f'out of {num_errors}')
+            break
+
+        if args.rate and num_moved < num_errors:
+            delay = start + num_moved / args.rate - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+    progress(num_moved, num_errors, end='\n')
     log.info(f'Successfully moved failed events back to "{args.queue}"')
 
 
+def do_queue_status(config: Config, args: argparse.Namespace) -> None:
+    if not config.queues:
+        log.error('Could not get the status of the queues: no event queue configured')
+        raise NoEventQueueExit()
+
+    redis = Redis(
+        host=config.redis.host,
+        port=config.redis.port,
+        password=config.redis.password,
+        ssl=config.redis.ssl,
+    )
+
+    for queue, queue_config in config.queues.items():
+        num_errors = redis.llen(f'errors-{queue}')
+        num_retrying = redis.zcard(get_retry_queue(queue))
+        failed = f'{num_retrying} retrying, {num_errors} errors'
+
+        if queue_config.backend == 'list':
+            print(f'{queue}: {redis.llen(queue)} waiting, {failed}')
+            continue
+
+        try:
+            status = get_stream_status(redis, queue)
+
+        except ResponseError:
+            # The stream does not exist yet
+            status = None
+
+        if status is None:
+            print(f'{queue}: no consumer group yet, {failed}')
+            continue
+
+        lag = 'unknown' if status['lag'] is None else status['lag']
+        print(f'{queue}: {lag} waiting, {status["pending"]} pending, {failed}')
+
+        for consumer, consumer_status in sorted(status['consumers'].items()):
+            print(f'  {consumer}: {consumer_status["pending"]} pending, '
+                  f'idle for {consumer_status["idle"]}ms')
+
+
 def do_refresh_views(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     total_nb_views = nb_views = len(views)
@@ -221,6 +490,40 @@ def do_refresh_views(config: Config, args: argparse.Namespace) -> None:
     log.info(f'Successfully refreshed {total_nb_views} materialized views')
 
 
+def do_stage_timings(config: Config, args: argparse.Namespace) -> None:
+    if not config.main.metrics_port:
+        log.error('Could not get the stage timings: the metrics are disabled')
+        raise MetricsDisabledExit()
+
+    url = f'http://{args.host}:{config.main.metrics_port}/metrics'
+
+    try:
+        response = requests.get(url)
+        response.raise_for_status()
+
+    except requests.RequestException as e:
+        log.error('Could not get the metrics from %s: %s', url, e)
+        raise ConnectionErrorExit()
+
+    timings = get_stage_timings(response.text)
+
+    if not timings:
+        print('No event processed yet')
+        return
+
+    for queue, queue_timings in sorted(timings.items()):
+        seconds = queue_timings['seconds']
+        print(f'{queue}: {queue_timings["records"]} events processed in {seconds:.3f}s')
+
+        # Whatever is not in a stage, like acknowledging the events or the rest of the handlers
+        stages = queue_timings['stages']
+        stages['other'] = max(seconds - sum(stages.values()), 0)
+
+        for stage, stage_seconds in sorted(stages.items(), key=lambda i: i[1], reverse=True):
+            percent = 100 * stage_seconds / seconds if seconds else 0
+            print(f'  {stage}: {stage_seconds:.3f}s ({percent:.1f}%)')
+
+
 def do_deploy_documentation(config: Config, args: argparse.Namespace) -> None:
     log.info('Deploying documentation on ReadTheDocs')
     url = f'https://readthedocs.org/api/v3/projects/azafea/versions/{args.version}/builds/'
@@ -25,3 +25,7 @@ class ConnectionErrorExit(BaseExit):
 
 class UnknownErrorExit(BaseExit):
     status_code: int = -4
+
+
+class MetricsDisabledExit(BaseExit):
+    status_code: int = -5
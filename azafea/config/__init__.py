@@ -19,13 +19,15 @@ from pydantic_core import ErrorDetails
 
 import toml
 
-from ._validators import is_boolean, is_non_empty_string, is_strictly_positive_integer
+from ._validators import (
+    is_boolean, is_non_empty_string, is_one_of, is_positive_integer, is_strictly_positive_integer)
 from ..utils import get_callable, get_cpu_count
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_PASSWORD = 'CHANGE ME!!'
+QUEUE_BACKENDS = ('list', 'stream')
 
 
 class InvalidConfigurationError(Exception):
@@ -48,7 +50,9 @@ class InvalidConfigurationError(Exception):
         # Make the output prettier
         # FIXME: Do that better: https://github.com/samuelcolvin/pydantic/issues/982
         loc = details['loc']
-        if loc[0] == 'queues':
+        if loc[0] == 'queues' and len(loc) == 2:
+            # Errors raised from Queue.__post_init__ are not attached to a field, but they are all
+            # about the handler
             loc += ('handler',)
 
         path = ''
@@ -109,6 +113,13 @@ class Main(_Base):
     verbose: bool = False
     number_of_workers: int = dataclasses.field(default_factory=get_cpu_count)
     exit_on_empty_queues: bool = False
+    metrics_port: int = 0
+    worker_max_restarts: int = 5
+    worker_max_records: int = 0
+    worker_max_memory_mb: int = 0
+    autoscale_min_workers: int = 0
+    autoscale_drain_seconds: int = 60
+    autoscale_cooldown_seconds: int = 300
 
     @field_validator('verbose', mode='before')
     @classmethod
@@ -125,6 +136,45 @@ class Main(_Base):
     def exit_on_empty_queues_is_boolean(cls, value: Any) -> bool:
         return is_boolean(value)
 
+    @field_validator('metrics_port', mode='before')
+    @classmethod
+    def metrics_port_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('worker_max_restarts', mode='before')
+    @classmethod
+    def worker_max_restarts_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('worker_max_records', mode='before')
+    @classmethod
+    def worker_max_records_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('worker_max_memory_mb', mode='before')
+    @classmethod
+    def worker_max_memory_mb_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('autoscale_min_workers', mode='before')
+    @classmethod
+    def autoscale_min_workers_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('autoscale_drain_seconds', mode='before')
+    @classmethod
+    def autoscale_drain_seconds_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('autoscale_cooldown_seconds', mode='before')
+    @classmethod
+    def autoscale_cooldown_seconds_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    def __post_init__(self) -> None:
+        if self.autoscale_min_workers > self.number_of_workers:
+            raise ValueError('autoscale_min_workers must not be greater than number_of_workers')
+
 
 @dataclass(frozen=True)
 class Redis(_Base):
@@ -151,6 +201,14 @@ class PostgreSQL(_Base):
     user: str = 'azafea'
     password: str = DEFAULT_PASSWORD
     database: str = 'azafea'
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_pre_ping: bool = False
+    pool_recycle: int = 0
+    statement_timeout_ms: int = 0
+    transaction_pooler: bool = False
+    executemany_values_page_size: int = 1000
+    executemany_batch_page_size: int = 100
     connect_args: Dict[str, str] = dataclasses.field(default_factory=dict)
 
     @field_validator('host', mode='before')
@@ -178,11 +236,61 @@ class PostgreSQL(_Base):
     def database_is_non_empty_string(cls, value: Any) -> str:
         return is_non_empty_string(value)
 
+    @field_validator('pool_size', mode='before')
+    @classmethod
+    def pool_size_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('max_overflow', mode='before')
+    @classmethod
+    def max_overflow_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('pool_pre_ping', mode='before')
+    @classmethod
+    def pool_pre_ping_is_boolean(cls, value: Any) -> bool:
+        return is_boolean(value)
+
+    @field_validator('pool_recycle', mode='before')
+    @classmethod
+    def pool_recycle_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('statement_timeout_ms', mode='before')
+    @classmethod
+    def statement_timeout_ms_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('transaction_pooler', mode='before')
+    @classmethod
+    def transaction_pooler_is_boolean(cls, value: Any) -> bool:
+        return is_boolean(value)
+
+    @field_validator('executemany_values_page_size', mode='before')
+    @classmethod
+    def executemany_values_page_size_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('executemany_batch_page_size', mode='before')
+    @classmethod
+    def executemany_batch_page_size_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
 
 @dataclass(frozen=True)
 class Queue(_Base):
     handler: str
+    backend: str = 'list'
+    batch_size: int = 1
+    batch_linger_ms: int = 0
+    reliable: bool = False
+    workers: int = 0
+    weight: int = 1
+    synchronous_commit: bool = True
+    max_attempts: int = 10
+    retry_delay_ms: int = 1000
     processor: Callable = dataclasses.field(init=False)
+    batch_processor: Optional[Callable] = dataclasses.field(default=None, init=False)
     cli: Optional[Callable] = dataclasses.field(default=None, init=False)
 
     @staticmethod
@@ -196,13 +304,66 @@ class Queue(_Base):
         except AttributeError:
             raise ValueError(f'Module {module_name!r} is missing a {callable_name!r} function')
 
-    # Since processor and cli are init=False, they need to be set in __post_init__ instead of
-    # @model_validator. Also, since the dataclass is frozen, they need to be set with
-    # object.__setattr__.
+    @field_validator('backend', mode='before')
+    @classmethod
+    def backend_is_supported(cls, value: Any) -> str:
+        return is_one_of(value, QUEUE_BACKENDS)
+
+    @field_validator('batch_size', mode='before')
+    @classmethod
+    def batch_size_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('batch_linger_ms', mode='before')
+    @classmethod
+    def batch_linger_ms_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('reliable', mode='before')
+    @classmethod
+    def reliable_is_boolean(cls, value: Any) -> bool:
+        return is_boolean(value)
+
+    @field_validator('workers', mode='before')
+    @classmethod
+    def workers_is_positive_integer(cls, value: Any) -> int:
+        return is_positive_integer(value)
+
+    @field_validator('weight', mode='before')
+    @classmethod
+    def weight_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('synchronous_commit', mode='before')
+    @classmethod
+    def synchronous_commit_is_boolean(cls, value: Any) -> bool:
+        return is_boolean(value)
+
+    @field_validator('max_attempts', mode='before')
+    @classmethod
+    def max_attempts_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    @field_validator('retry_delay_ms', mode='before')
+    @classmethod
+    def retry_delay_ms_is_strictly_positive_integer(cls, value: Any) -> int:
+        return is_strictly_positive_integer(value)
+
+    # Since processor, batch_processor and cli are init=False, they need to be set in
+    # __post_init__ instead of @model_validator. Also, since the dataclass is frozen, they need to
+    # be set with object.__setattr__.
     def __post_init__(self) -> None:
         processor = self._validate_callable(self.handler, 'process')
         object.__setattr__(self, 'processor', processor)
 
+        try:
+            batch_processor = self._validate_callable(self.handler, 'process_batch')
+            object.__setattr__(self, 'batch_processor', batch_processor)
+
+        except ValueError:
+            # Records will be processed one by one then
+            pass
+
         try:
             cli = self._validate_callable(self.handler, 'register_commands')
             object.__setattr__(self, 'cli', cli)
@@ -7,7 +7,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
-from typing import Any
+from typing import Any, Tuple
 
 
 def is_boolean(value: Any) -> bool:
@@ -27,6 +27,25 @@ def is_non_empty_string(value: Any) -> str:
     return value
 
 
+def is_one_of(value: Any, choices: Tuple[str, ...]) -> str:
+    value = is_non_empty_string(value)
+
+    if value not in choices:
+        raise ValueError(f'{value!r} is not one of {", ".join(repr(c) for c in choices)}')
+
+    return value
+
+
+def is_positive_integer(value: Any) -> int:
+    if type(value) is not int:
+        raise ValueError(f'{value!r} is not an integer')
+
+    if value < 0:
+        raise ValueError(f'{value!r} is not a positive integer')
+
+    return value
+
+
 def is_strictly_positive_integer(value: Any) -> int:
     if type(value) is not int:
         raise ValueError(f'{value!r} is not an integer')
@@ -7,35 +7,90 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
+import gc
+import json
 import logging
+import multiprocessing
+from multiprocessing.queues import Queue
 from signal import SIGINT, SIGTERM, Signals, signal as intercept_signal
+import socket
 import sys
 import time
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from redis import Redis
+from redis.exceptions import RedisError
+
+from sqlalchemy.orm import configure_mappers
+
+from .autoscaling import Autoscaler
 from .config import Config
-from .processor import Processor
+from .monitoring import MetricsServer
+from .processor import RECYCLE_EXIT_CODE, Processor
+from .queues import (
+    get_consumer_name, get_profile_request_key, get_queue_lengths, requeue_orphaned_records,
+    requeue_worker_records)
 
 
 log = logging.getLogger(__name__)
 
+# How long to wait before restarting a crashed worker the first time, in seconds; this doubles
+# each time it crashes again, up to the maximum
+RESTART_BACKOFF = 1
+RESTART_BACKOFF_MAX = 60
+
+# A worker which ran that long before crashing is not considered to be crash looping, in seconds
+STABLE_RUN_TIME = 300
+
+# How often to check whether the number of workers should change, in seconds
+AUTOSCALE_INTERVAL = 10
+
 
 class Controller:
     def __init__(self, config: Config) -> None:
         self.config = config
         self._processors: List[Processor] = []
+        self._metrics_channel: Optional[Queue] = None
+        self._metrics_server: Optional[MetricsServer] = None
+        self._redis: Optional[Redis] = None
 
+        # The supervision state of the workers, by name
+        self._started_at: Dict[str, float] = {}
+        self._crashes: Dict[str, int] = {}
+        self._restart_at: Dict[str, float] = {}
+        self._finished: Set[str] = set()
+
+        # Queues with their own dedicated workers are not pulled from by the shared ones
+        self._shared_queues = tuple(
+            queue for queue, queue_config in config.queues.items() if not queue_config.workers)
         self._number_of_workers = config.main.number_of_workers
 
+        if config.queues and not self._shared_queues:
+            self._number_of_workers = 0
+
+        # Workers which were asked to exit because they are not needed any more, but which are
+        # still finishing their current task
+        self._retiring: List[Processor] = []
+        self._autoscaler: Optional[Autoscaler] = None
+        self._next_autoscale = 0.0
+        self._num_processed: Dict[Processor, int] = {}
+
+        if config.main.autoscale_min_workers and self._number_of_workers:
+            self._autoscaler = Autoscaler(config)
+            self._number_of_workers = config.main.autoscale_min_workers
+
         log.debug('Loaded the following configuration:\n%s', config)
 
         intercept_signal(SIGINT, self._handle_exit_signals)
         intercept_signal(SIGTERM, self._handle_exit_signals)
 
     def _exit_cleanly(self) -> None:
-        for proc in self._processors:
+        for proc in self._processors + self._retiring:
             proc.join()
 
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+
         log.info('All workers finished, exiting')
         sys.exit(0)
 
@@ -45,27 +100,287 @@ class Controller:
 
         if signum == SIGTERM:
             # SIGTERM is not automatically sent to subprocesses
-            for proc in self._processors:
+            for proc in self._processors + self._retiring:
                 proc.terminate()
 
         self._exit_cleanly()
 
+    def _get_redis(self) -> Redis:
+        if self._redis is None:
+            self._redis = Redis(
+                host=self.config.redis.host,
+                port=self.config.redis.port,
+                password=self.config.redis.password,
+                ssl=self.config.redis.ssl,
+            )
+
+        return self._redis
+
+    def _close_redis(self) -> None:
+        # Forked workers would otherwise inherit the connections of the controller to Redis, and
+        # share them with it
+        if self._redis is not None:
+            self._redis.close()
+            self._redis = None
+
+    def _requeue_orphaned_records(self) -> None:
+        reliable_queues = [
+            name for name, queue in self.config.queues.items()
+            if queue.backend == 'list' and queue.reliable
+        ]
+
+        if not reliable_queues:
+            return
+
+        for queue in reliable_queues:
+            num_requeued = requeue_orphaned_records(self._get_redis(), queue)
+
+            if num_requeued:
+                log.warning('Requeued %d records left unprocessed by dead workers in the %s queue',
+                            num_requeued, queue)
+
+    def _handle_profile_requests(self) -> None:
+        key = get_profile_request_key(socket.gethostname())
+
+        try:
+            with self._get_redis().pipeline() as pipeline:
+                pipeline.get(key)
+                pipeline.delete(key)
+                request_json, _ = pipeline.execute()
+
+        except RedisError as e:
+            log.warning('Could not check for profile requests: %s', e)
+            return
+
+        if request_json is None:
+            return
+
+        request = json.loads(request_json)
+        worker = request.pop('worker', None)
+
+        for proc in self._processors:
+            if worker not in (None, proc.name) or not proc.is_alive():
+                continue
+
+            log.info('Asking %s to profile itself', proc.name)
+            proc.request_profile(**request)
+
+    def _requeue_worker_records(self, name: str) -> None:
+        # The new worker will have the same name, and would otherwise forget the records in its
+        # processing lists once it is done with its first ones
+        consumer = get_consumer_name(name)
+
+        for queue, queue_config in self.config.queues.items():
+            if queue_config.backend != 'list' or not queue_config.reliable:
+                continue
+
+            try:
+                num_requeued = requeue_worker_records(self._get_redis(), queue, consumer)
+
+            except RedisError as e:
+                log.error('Could not requeue the records left unprocessed by %s in the %s queue: '
+                          '%s', name, queue, e)
+                continue
+
+            if num_requeued:
+                log.warning('Requeued %d records left unprocessed by %s in the %s queue',
+                            num_requeued, name, queue)
+
+    def _schedule_restart(self, name: str, exitcode: Optional[int]) -> None:
+        now = time.monotonic()
+
+        if exitcode == RECYCLE_EXIT_CODE:
+            log.info('Replacing %s', name)
+            self._restart_at[name] = now
+            return
+
+        if now - self._started_at[name] >= STABLE_RUN_TIME:
+            self._crashes[name] = 0
+
+        self._crashes[name] = crashes = self._crashes.get(name, 0) + 1
+
+        if crashes > self.config.main.worker_max_restarts:
+            log.error('%s crashed with exit code %s too many times in a row, giving up on it',
+                      name, exitcode)
+            self._finished.add(name)
+            return
+
+        delay = min(RESTART_BACKOFF * 2 ** (crashes - 1), RESTART_BACKOFF_MAX)
+        log.error('%s crashed with exit code %s, restarting it in %d second%s',
+                  name, exitcode, delay, 's' if delay > 1 else '')
+        self._restart_at[name] = now + delay
+
+    def _start_worker(self, name: str, queues: Tuple[str, ...]) -> Processor:
+        proc = Processor(name, self.config, self._metrics_channel, queues)
+        self._close_redis()
+        proc.start()
+        self._started_at[name] = time.monotonic()
+
+        return proc
+
+    def _supervise(self) -> None:
+        for proc in self._retiring[:]:
+            if proc.is_alive():
+                continue
+
+            self._retiring.remove(proc)
+
+            if proc.exitcode != 0:
+                self._requeue_worker_records(proc.name)
+
+        for i, proc in enumerate(self._processors):
+            name = proc.name
+
+            if proc.is_alive() or name in self._finished:
+                continue
+
+            if name not in self._restart_at:
+                if proc.exitcode == 0:
+                    # The worker exited on its own, e.g because the queues were empty
+                    self._finished.add(name)
+                    continue
+
+                self._requeue_worker_records(name)
+                self._schedule_restart(name, proc.exitcode)
+                continue
+
+            if time.monotonic() < self._restart_at[name]:
+                continue
+
+            del self._restart_at[name]
+
+            try:
+                self._processors[i] = self._start_worker(name, proc.queues)
+
+            except Exception as e:
+                # e.g the databases are unreachable for now
+                log.error('Could not restart %s: %s', name, e)
+                self._schedule_restart(name, None)
+
+    def _get_new_worker_name(self) -> str:
+        # Retiring workers must finish with their processing lists before their name is reused
+        names = {proc.name for proc in self._processors + self._retiring}
+        i = 1
+
+        while f'worker-{i}' in names:
+            i += 1
+
+        return f'worker-{i}'
+
+    def _get_shared_workers(self) -> List[Processor]:
+        return [proc for proc in self._processors if proc.queues == self._shared_queues]
+
+    def _retire_worker(self) -> None:
+        proc = self._get_shared_workers()[-1]
+        self._processors.remove(proc)
+        self._started_at.pop(proc.name, None)
+        self._crashes.pop(proc.name, None)
+        self._restart_at.pop(proc.name, None)
+        self._finished.discard(proc.name)
+
+        # Let it finish its current task, just like when the controller is stopped
+        proc.terminate()
+        self._retiring.append(proc)
+
+    def _pop_num_processed(self) -> int:
+        num_processed = {}
+        total = 0
+
+        for proc in self._get_shared_workers() + self._retiring:
+            num_processed[proc] = proc.num_processed
+            total += num_processed[proc] - self._num_processed.get(proc, 0)
+
+        self._num_processed = num_processed
+
+        return total
+
+    def _autoscale(self) -> None:
+        now = time.monotonic()
+
+        if self._autoscaler is None or now < self._next_autoscale:
+            return
+
+        self._next_autoscale = now + AUTOSCALE_INTERVAL
+        shared_queues = {queue: self.config.queues[queue] for queue in self._shared_queues}
+        backlog = sum(get_queue_lengths(self._get_redis(), shared_queues).values())
+        num_workers = len(self._get_shared_workers())
+        wanted = self._autoscaler.update(now, backlog, self._pop_num_processed(), num_workers)
+
+        if wanted == num_workers:
+            return
+
+        log.info('Scaling from %d to %d workers, with %d records waiting in the queues',
+                 num_workers, wanted, backlog)
+
+        for _ in range(num_workers, wanted):
+            try:
+                self._processors.append(
+                    self._start_worker(self._get_new_worker_name(), self._shared_queues))
+
+            except Exception as e:
+                # e.g the databases are unreachable for now, try again next time
+                log.error('Could not start a new worker: %s', e)
+                break
+
+        for _ in range(wanted, num_workers):
+            self._retire_worker()
+
+    def _start_metrics_server(self) -> None:
+        if not self.config.main.metrics_port:
+            return
+
+        self._metrics_channel = multiprocessing.Queue()
+        self._metrics_server = MetricsServer(self.config, self._metrics_channel)
+        self._metrics_server.start()
+
+    def _preload(self) -> None:
+        # The handler modules were imported with their models when loading the configuration. Set
+        # up the models now rather than in each worker, so that they all share the result instead
+        # of holding their own copy.
+        configure_mappers()
+
+        # Memory pages are only shared until they are written to, keep the garbage collector of
+        # the workers from doing that with everything created so far
+        gc.freeze()
+
     def start(self) -> None:
+        # Before opening any connection or starting any thread, so that the workers share exactly
+        # what was set up so far
+        self._preload()
+        self._requeue_orphaned_records()
+        self._start_metrics_server()
+
+        number_of_workers = self._number_of_workers + sum(
+            queue_config.workers for queue_config in self.config.queues.values())
         log.info('Starting the controller with %s worker%s',
-                 self._number_of_workers, 's' if self._number_of_workers > 1 else '')
+                 number_of_workers, 's' if number_of_workers > 1 else '')
 
         for i in range(1, self._number_of_workers + 1):
-            proc = Processor(f'worker-{i}', self.config)
-            proc.start()
-            self._processors.append(proc)
+            self._processors.append(self._start_worker(f'worker-{i}', self._shared_queues))
+
+        for queue, queue_config in self.config.queues.items():
+            if not queue_config.workers:
+                continue
+
+            log.info('Dedicating %d worker%s to the %s queue',
+                     queue_config.workers, 's' if queue_config.workers > 1 else '', queue)
+
+            for i in range(1, queue_config.workers + 1):
+                self._processors.append(self._start_worker(f'{queue}-worker-{i}', (queue,)))
+
+        if self._autoscaler is not None:
+            log.info('Scaling between %d and %d workers depending on the queues',
+                     self._autoscaler.min_workers, self._autoscaler.max_workers)
 
     def main(self) -> None:
         self.start()
 
         while True:
-            active_processors = [p for p in self._processors if p.is_alive()]
+            self._supervise()
 
-            if not active_processors:
+            if len(self._finished) == len(self._processors):
                 self._exit_cleanly()
 
+            self._autoscale()
+            self._handle_profile_requests()
             time.sleep(1)
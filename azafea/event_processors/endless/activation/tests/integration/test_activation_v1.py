@@ -54,6 +54,51 @@ class TestActivation(IntegrationTest):
                                                           tzinfo=timezone.utc)
             assert activation.image_personality == 'base'
 
+    def test_activation_v1_batch(self):
+        from azafea.event_processors.endless.activation.v1.handler import (
+            Activation, process_batch)
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Activation)
+
+        # Process a batch of events, with different sets of columns
+        created_at = datetime.now(tz=timezone.utc)
+        records = [
+            json.dumps({
+                'image': image,
+                'vendor': 'the vendor',
+                'product': 'product',
+                'release': 'release',
+                'country': country,
+                'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S.%fZ'),
+            }).encode('utf-8')
+            for (image, country) in (
+                ('eos-eos3.7-amd64-amd64.190419-225606.base', 'FR'),
+                ('unknown', 'HK'),
+                ('eos-eos3.7-amd64-amd64.190419-225606.base', ''),
+            )
+        ]
+
+        with self.db as dbsession:
+            process_batch(dbsession, records)
+
+        # Ensure the records were inserted into the DB
+        with self.db as dbsession:
+            activations = dbsession.query(Activation).order_by(Activation.id).all()
+            assert len(activations) == 3
+
+            assert activations[0].country == 'FR'
+            assert activations[0].image_product == 'eos'
+            assert activations[1].country == 'HK'
+            assert activations[1].image_product is None
+            assert activations[2].country is None
+            assert activations[2].image_product == 'eos'
+
+            for activation in activations:
+                assert activation.vendor == 'the vendor'
+                assert activation.created_at == created_at
+
     def test_activation_v1_unknown_image(self):
         from azafea.event_processors.endless.activation.v1.handler import Activation
 
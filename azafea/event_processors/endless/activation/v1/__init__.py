@@ -9,4 +9,4 @@
 
 # Reexport these so Azafea finds them
 from .cli import register_commands  # noqa: F401
-from .handler import process  # noqa: F401
+from .handler import process, process_batch  # noqa: F401
@@ -13,7 +13,7 @@ from sqlalchemy.orm.query import Query
 
 from azafea.config import Config
 from azafea.model import Db
-from azafea.utils import progress
+from azafea.utils import jobs_number, progress
 from azafea.vendors import normalize_vendor
 
 from ...image import parse_endless_os_image
@@ -29,6 +29,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     normalize_vendors.add_argument('--chunk-size', type=int, default=5000,
                                    help='The size of the chunks to operate on')
+    normalize_vendors.add_argument('--jobs', type=jobs_number, default=1,
+                                   help='The number of processes to run in parallel')
     normalize_vendors.set_defaults(subcommand=do_normalize_vendors)
 
     parse_images = subs.add_parser('parse-old-images',
@@ -36,6 +38,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parse_images.add_argument('--chunk-size', type=int, default=5000,
                               help='The size of the chunks to operate on')
+    parse_images.add_argument('--jobs', type=jobs_number, default=1,
+                              help='The number of processes to run in parallel')
     parse_images.set_defaults(subcommand=do_parse_images)
 
 
@@ -56,22 +60,30 @@ def do_normalize_vendors(config: Config, args: argparse.Namespace) -> None:
 
     with db as dbsession:
         query = dbsession.chunked_query(Activation, chunk_size=args.chunk_size)
-        num_records = query.count()
+        num_records = query.count(estimated=True)
 
         if num_records == 0:
             log.info('-> No activation record in database')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            _normalize_chunk(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    chunks = db.process_chunks(query, _normalize_chunk, jobs=args.jobs)
+
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
     log.info('All done!')
 
 
+def _parse_images_chunk(chunk: Query) -> None:
+    for activation in chunk:
+        parsed_image = parse_endless_os_image(activation.image)
+
+        for k, v in parsed_image.items():
+            setattr(activation, k, v)
+
+
 def do_parse_images(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     log.info('Parsing the image ids for old activations')
@@ -87,15 +99,10 @@ def do_parse_images(config: Config, args: argparse.Namespace) -> None:
             log.info('-> No activation record with unparsed image ids')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            for activation in chunk:
-                parsed_image = parse_endless_os_image(activation.image)
-
-                for k, v in parsed_image.items():
-                    setattr(activation, k, v)
+    chunks = db.process_chunks(query, _parse_images_chunk, jobs=args.jobs)
 
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
@@ -10,7 +10,7 @@
 import json
 import logging
 import math
-from typing import Optional
+from typing import List, Optional
 
 from sqlalchemy.orm import validates
 from sqlalchemy.schema import CheckConstraint, Column
@@ -106,3 +106,10 @@ def process(dbsession: DbSession, record: bytes) -> None:
     activation = Activation.from_serialized(record)
     dbsession.add(activation)
     log.debug('Inserting activation record:\n%s', activation)
+
+
+def process_batch(dbsession: DbSession, records: List[bytes]) -> None:
+    log.debug('Processing %d activation v1 records', len(records))
+
+    activations = [Activation.from_serialized(record) for record in records]
+    dbsession.insert_all(activations)
@@ -7,7 +7,8 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
-from datetime import datetime, timezone
+from datetime import date, datetime, time, timezone
+from functools import lru_cache
 import re
 from typing import TYPE_CHECKING, Dict, Optional
 
@@ -49,12 +50,21 @@ IMAGE_PARSING_RE = r"""
 $"""
 IMAGE_PARSING_PATTERN = re.compile(IMAGE_PARSING_RE, re.VERBOSE)
 
+# There are only a few thousands distinct image ids, but we parse one for each event
+IMAGE_PARSING_CACHE_SIZE = 16384
+
 
 class ImageParsingError(Exception):
     pass
 
 
 def parse_endless_os_image(image_id: str, tzinfo: bool = True) -> ParsedImage:
+    # Callers get their own copy, since they could modify it
+    return dict(_parse_endless_os_image(image_id, tzinfo))  # type: ignore
+
+
+@lru_cache(maxsize=IMAGE_PARSING_CACHE_SIZE)
+def _parse_endless_os_image(image_id: str, tzinfo: bool) -> ParsedImage:
     if image_id in ('unknown', '[Invalid UTF-8]'):
         # If the image ID cannot be read from disk, the activation/ping and metrics submissions
         # use the string "unknown", which we must treat as valid-but-empty.
@@ -83,14 +93,20 @@ def parse_endless_os_image(image_id: str, tzinfo: bool = True) -> ParsedImage:
         # with the full year
         matched_date = f'20{matched_date}'
 
+    # The regex guarantees these are digits, so slicing them is much faster than strptime
     try:
-        date = datetime.strptime(matched_date, '%Y%m%d')
+        if len(matched_date) != 8:
+            raise ValueError(f'unconverted data remains: {matched_date[8:]}')
+
+        parsed_date = date(int(matched_date[:4]), int(matched_date[4:6]), int(matched_date[6:]))
 
     except ValueError as e:
         raise ImageParsingError(f'Invalid image id {image_id!r}: Could not parse the date: {e}')
 
+    matched_time = match.group('time')
+
     try:
-        time = datetime.strptime(match.group('time'), '%H%M%S')
+        parsed_time = time(int(matched_time[:2]), int(matched_time[2:4]), int(matched_time[4:]))
 
     except ValueError as e:
         raise ImageParsingError(f'Invalid image id {image_id!r}: Could not parse the time: {e}')
@@ -100,8 +116,7 @@ def parse_endless_os_image(image_id: str, tzinfo: bool = True) -> ParsedImage:
         'image_branch': match.group('branch'),
         'image_arch': match.group('arch'),
         'image_platform': match.group('platform'),
-        'image_timestamp': datetime(date.year, date.month, date.day,
-                                    time.hour, time.minute, time.second,
-                                    tzinfo=timezone.utc if tzinfo else None),
+        'image_timestamp': datetime.combine(parsed_date, parsed_time,
+                                            tzinfo=timezone.utc if tzinfo else None),
         'image_personality': match.group('personality'),
     }
@@ -123,6 +123,64 @@ class TestMetrics(IntegrationTest):
             # Ensure we deduplicated the request and the events it contains
             assert dbsession.query(UnknownSingularEvent).count() == 1
 
+    def test_duplicate_request_batch(self):
+        from azafea.event_processors.endless.metrics.v2.handler import process_batch
+        from azafea.event_processors.endless.metrics.v2.model import (
+            Request, UnknownSingularEvent)
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Request)
+
+        # Build requests as they would have been sent to us
+        now = datetime.now(tz=timezone.utc)
+        machine_id = 'ffffffffffffffffffffffffffffffff'
+        records = []
+
+        for send_number in range(2):
+            request = GLib.Variant(
+                '(ixxaya(uayxmv)a(uayxxmv)a(uaya(xmv)))',
+                (
+                    send_number,                       # network send number
+                    2000000000,                        # request relative timestamp (2 secs)
+                    int(now.timestamp() * 1000000000),  # request absolute timestamp
+                    bytes.fromhex(machine_id),
+                    [                                  # singular events
+                        (
+                            1000,                      # user id
+                            UUID('d3863909-8eff-43b6-9a33-ef7eda266195').bytes,
+                            3000000000,                # event relative timestamp (3 secs)
+                            None,                      # empty payload
+                        ),
+                    ],
+                    [],                                # aggregate events
+                    []                                 # sequence events
+                )
+            )
+            assert request.is_normal_form()
+            request_body = request.get_data_as_bytes().get_data()
+
+            received_at = now + timedelta(minutes=2)
+            received_at_timestamp = int(received_at.timestamp() * 1000000)  # microseconds
+            received_at_timestamp_bytes = received_at_timestamp.to_bytes(8, 'little')
+
+            records.append(received_at_timestamp_bytes + request_body)
+
+        # Process the first request alone, then a batch with both requests twice
+        with self.db as dbsession:
+            process_batch(dbsession, records[:1])
+
+        with self.db as dbsession:
+            process_batch(dbsession, records + records)
+
+        # Ensure the requests were deduplicated
+        with self.db as dbsession:
+            requests = dbsession.query(Request).order_by(Request.send_number).all()
+            assert [r.send_number for r in requests] == [0, 1]
+
+            # Ensure we deduplicated the events too
+            assert dbsession.query(UnknownSingularEvent).count() == 2
+
     def test_invalid_request(self):
         from azafea.event_processors.endless.metrics.v2.model import Request
 
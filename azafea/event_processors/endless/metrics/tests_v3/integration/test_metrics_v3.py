@@ -88,6 +88,54 @@ class TestMetrics(IntegrationTest):
             assert request.relative_timestamp == 2000000
             assert request.absolute_timestamp == absolute_timestamp
 
+    def test_request_batch(self):
+        from azafea.event_processors.endless.metrics.v3.handler import process_batch
+        from azafea.event_processors.endless.metrics.v3.model import Channel, Request
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Channel, Request)
+
+        # Build requests as they would have been sent to us, from 2 channels
+        now = datetime.now(tz=timezone.utc)
+        records = []
+
+        for i, image_id in enumerate(('eos-eos3.7-amd64-amd64.190419-225606.base',
+                                      'eos-eos3.7-amd64-amd64.190419-225606.base',
+                                      'eos-eos4.0-amd64-amd64.221014-103929.pt_BR')):
+            request = GLib.Variant(
+                '(xxsa{ss}ya(aysxmv)a(ayssumv))',
+                (
+                    2000000 + i,                       # request relative timestamp
+                    int(now.timestamp() * 1000000000),  # Absolute timestamp
+                    image_id,
+                    {},
+                    0,                                 # flags
+                    [],                                # singular events
+                    []                                 # aggregate events
+                )
+            )
+            assert request.is_normal_form()
+            request_body = request.get_data_as_bytes().get_data()
+
+            received_at = now + timedelta(minutes=2)
+            received_at_timestamp = int(received_at.timestamp() * 1000000)  # microseconds
+            received_at_timestamp_bytes = received_at_timestamp.to_bytes(8, 'little')
+
+            records.append(received_at_timestamp_bytes + request_body)
+
+        # Process the batch, with a duplicated request
+        with self.db as dbsession:
+            process_batch(dbsession, records + records[:1])
+
+        with self.db as dbsession:
+            assert dbsession.query(Channel).count() == 2
+
+            requests = dbsession.query(Request).order_by(Request.relative_timestamp).all()
+            assert [r.relative_timestamp for r in requests] == [2000000, 2000001, 2000002]
+            assert requests[0].channel_id == requests[1].channel_id
+            assert requests[0].channel_id != requests[2].channel_id
+
     def test_invalid_request(self):
         from azafea.event_processors.endless.metrics.v3.model import Channel
 
@@ -9,13 +9,14 @@
 import argparse
 import logging
 
-from sqlalchemy import or_
+from sqlalchemy import or_, select
 from sqlalchemy.orm.query import Query
+from sqlalchemy.schema import Column
 from sqlalchemy.sql.functions import func
 
 from azafea.config import Config
 from azafea.model import Db
-from azafea.utils import progress
+from azafea.utils import jobs_number, progress
 from azafea.vendors import normalize_vendor
 
 from ...image import parse_endless_os_image
@@ -80,6 +81,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     normalize_vendors.add_argument('--chunk-size', type=int, default=5000,
                                    help='The size of the chunks to operate on')
+    normalize_vendors.add_argument('--jobs', type=jobs_number, default=1,
+                                   help='The number of processes to run in parallel')
     normalize_vendors.set_defaults(subcommand=do_normalize_vendors)
 
     parse_images = subs.add_parser('parse-old-images',
@@ -87,6 +90,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parse_images.add_argument('--chunk-size', type=int, default=5000,
                               help='The size of the chunks to operate on')
+    parse_images.add_argument('--jobs', type=jobs_number, default=1,
+                              help='The number of processes to run in parallel')
     parse_images.set_defaults(subcommand=do_parse_images)
 
     replay_machine_dualboots = subs.add_parser(
@@ -117,12 +122,16 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     replay_invalid.add_argument('--chunk-size', type=int, default=5000,
                                 help='The size of the chunks to operate on')
+    replay_invalid.add_argument('--jobs', type=jobs_number, default=1,
+                                help='The number of processes to run in parallel')
     replay_invalid.set_defaults(subcommand=do_replay_invalid)
 
     replay_unknown = subs.add_parser('replay-unknown', help='Replay unknown events',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     replay_unknown.add_argument('--chunk-size', type=int, default=5000,
                                 help='The size of the chunks to operate on')
+    replay_unknown.add_argument('--jobs', type=jobs_number, default=1,
+                                help='The number of processes to run in parallel')
     replay_unknown.set_defaults(subcommand=do_replay_unknown)
 
     set_open_durations = subs.add_parser('set-open-durations', help='Set open shell apps durations',
@@ -144,6 +153,49 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
     remove_empty_location_info.set_defaults(subcommand=do_remove_empty_location_info)
 
 
+def _delete_duplicates(db: Db, column: Column, chunk_size: int) -> int:
+    """Delete the rows which have the same value in column as an older one
+
+    Only the row with the lowest id is kept for each value. This runs entirely in the database,
+    one range of values at a time, each in its own transaction.
+
+    Return the number of deleted rows.
+    """
+    table = column.table
+
+    with db as dbsession:
+        first, last = dbsession.query(func.min(column), func.max(column)).one()
+
+    if first is None:
+        return 0
+
+    num_deleted = 0
+    total = last - first + 1
+
+    for start in range(first, last + 1, chunk_size):
+        stop = min(start + chunk_size, last + 1)
+
+        ranked = select([
+            table.c.id,
+            func.row_number().over(partition_by=column, order_by=table.c.id).label('row_number'),
+        ])
+        ranked = ranked.where(column >= start).where(column < stop).alias('ranked')
+
+        # This is a DELETE … USING, PostgreSQL doesn't allow window functions in the WHERE clause
+        delete_query = table.delete()
+        delete_query = delete_query.where(table.c.id == ranked.c.id)
+        delete_query = delete_query.where(ranked.c.row_number > 1)
+
+        with db as dbsession:
+            num_deleted += dbsession.connection().execute(delete_query).rowcount
+
+        progress(stop - first, total)
+
+    progress(total, total, end='\n')
+
+    return num_deleted
+
+
 def do_dedupe_dualboots(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     log.info('Deduplicating the metrics requests with multiple "dual boot" (%s) events',
@@ -155,34 +207,16 @@ def do_dedupe_dualboots(config: Config, args: argparse.Namespace) -> None:
         query = query.having(func.count(DualBootBooted.id) > 1)
         num_requests_with_dupes = query.count()
 
-        if num_requests_with_dupes == 0:
-            log.info('-> No metrics requests with deduplicate dual boot events found')
-            return None
-
-        log.info('-> Found %s metrics requests with duplicate dual boot events',
-                 num_requests_with_dupes)
-        request_ids_with_dupes = [x[0] for x in query]
-
-    previous_request_id = None
-
-    for start in range(0, num_requests_with_dupes, args.chunk_size):
-        stop = min(num_requests_with_dupes, start + args.chunk_size)
-        request_id_chunk = request_ids_with_dupes[start:stop]
-
-        with db as dbsession:
-            query = dbsession.query(DualBootBooted)
-            query = query.filter(DualBootBooted.request_id.in_(request_id_chunk))
-            query = query.order_by(DualBootBooted.request_id, DualBootBooted.id)
-
-            for dualboot in query:
-                if dualboot.request_id == previous_request_id:
-                    dbsession.delete(dualboot)
+    if num_requests_with_dupes == 0:
+        log.info('-> No metrics requests with deduplicate dual boot events found')
+        return None
 
-                previous_request_id = dualboot.request_id
+    log.info('-> Found %s metrics requests with duplicate dual boot events',
+             num_requests_with_dupes)
 
-        progress(stop, num_requests_with_dupes)
+    num_deleted = _delete_duplicates(db, DualBootBooted.__table__.c.request_id, args.chunk_size)
 
-    progress(num_requests_with_dupes, num_requests_with_dupes, end='\n')
+    log.info('-> Deleted %s duplicate events', num_deleted)
     log.info('All done!')
 
 
@@ -197,34 +231,16 @@ def do_dedupe_image_versions(config: Config, args: argparse.Namespace) -> None:
         query = query.having(func.count(ImageVersion.id) > 1)
         num_requests_with_dupes = query.count()
 
-        if num_requests_with_dupes == 0:
-            log.info('-> No metrics requests with deduplicate image versions found')
-            return None
-
-        log.info('-> Found %s metrics requests with duplicate image versions',
-                 num_requests_with_dupes)
-        request_ids_with_dupes = [x[0] for x in query]
-
-    previous_request_id = None
-
-    for start in range(0, num_requests_with_dupes, args.chunk_size):
-        stop = min(num_requests_with_dupes, start + args.chunk_size)
-        request_id_chunk = request_ids_with_dupes[start:stop]
-
-        with db as dbsession:
-            query = dbsession.query(ImageVersion)
-            query = query.filter(ImageVersion.request_id.in_(request_id_chunk))
-            query = query.order_by(ImageVersion.request_id, ImageVersion.id)
-
-            for image_version in query:
-                if image_version.request_id == previous_request_id:
-                    dbsession.delete(image_version)
+    if num_requests_with_dupes == 0:
+        log.info('-> No metrics requests with deduplicate image versions found')
+        return None
 
-                previous_request_id = image_version.request_id
+    log.info('-> Found %s metrics requests with duplicate image versions',
+             num_requests_with_dupes)
 
-        progress(stop, num_requests_with_dupes)
+    num_deleted = _delete_duplicates(db, ImageVersion.__table__.c.request_id, args.chunk_size)
 
-    progress(num_requests_with_dupes, num_requests_with_dupes, end='\n')
+    log.info('-> Deleted %s duplicate events', num_deleted)
     log.info('All done!')
 
 
@@ -239,34 +255,16 @@ def do_dedupe_live_usbs(config: Config, args: argparse.Namespace) -> None:
         query = query.having(func.count(LiveUsbBooted.id) > 1)
         num_requests_with_dupes = query.count()
 
-        if num_requests_with_dupes == 0:
-            log.info('-> No metrics requests with deduplicate live usb events found')
-            return None
-
-        log.info('-> Found %s metrics requests with duplicate live usb events',
-                 num_requests_with_dupes)
-        request_ids_with_dupes = [x[0] for x in query]
-
-    previous_request_id = None
-
-    for start in range(0, num_requests_with_dupes, args.chunk_size):
-        stop = min(num_requests_with_dupes, start + args.chunk_size)
-        request_id_chunk = request_ids_with_dupes[start:stop]
-
-        with db as dbsession:
-            query = dbsession.query(LiveUsbBooted)
-            query = query.filter(LiveUsbBooted.request_id.in_(request_id_chunk))
-            query = query.order_by(LiveUsbBooted.request_id, LiveUsbBooted.id)
+    if num_requests_with_dupes == 0:
+        log.info('-> No metrics requests with deduplicate live usb events found')
+        return None
 
-            for live_usb in query:
-                if live_usb.request_id == previous_request_id:
-                    dbsession.delete(live_usb)
+    log.info('-> Found %s metrics requests with duplicate live usb events',
+             num_requests_with_dupes)
 
-                previous_request_id = live_usb.request_id
+    num_deleted = _delete_duplicates(db, LiveUsbBooted.__table__.c.request_id, args.chunk_size)
 
-        progress(stop, num_requests_with_dupes)
-
-    progress(num_requests_with_dupes, num_requests_with_dupes, end='\n')
+    log.info('-> Deleted %s duplicate events', num_deleted)
     log.info('All done!')
 
 
@@ -288,22 +286,30 @@ def do_normalize_vendors(config: Config, args: argparse.Namespace) -> None:
 
     with db as dbsession:
         query = dbsession.chunked_query(UpdaterBranchSelected, chunk_size=args.chunk_size)
-        num_records = query.count()
+        num_records = query.count(estimated=True)
 
         if num_records == 0:
             log.info('-> No "updater branch selected" record in database')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            _normalize_chunk(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    chunks = db.process_chunks(query, _normalize_chunk, jobs=args.jobs)
+
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
     log.info('All done!')
 
 
+def _parse_images_chunk(chunk: Query) -> None:
+    for machine in chunk:
+        parsed_image = parse_endless_os_image(machine.image_id)
+
+        for k, v in parsed_image.items():
+            setattr(machine, k, v)
+
+
 def do_parse_images(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     log.info('Parsing the image ids for old activations')
@@ -318,15 +324,10 @@ def do_parse_images(config: Config, args: argparse.Namespace) -> None:
             log.info('-> No machine record with unparsed image ids')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            for machine in chunk:
-                parsed_image = parse_endless_os_image(machine.image_id)
-
-                for k, v in parsed_image.items():
-                    setattr(machine, k, v)
+    chunks = db.process_chunks(query, _parse_images_chunk, jobs=args.jobs)
 
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
@@ -340,12 +341,12 @@ def do_replay_invalid(config: Config, args: argparse.Namespace) -> None:
     with db as dbsession:
         query = dbsession.chunked_query(InvalidSingularEvent, chunk_size=args.chunk_size)
         query = query.reverse_chunks()
-        total = query.count()
+        total = query.count(estimated=True)
+
+    chunks = db.process_chunks(query, replay_invalid_singular_events, jobs=args.jobs)
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_invalid_singular_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -354,13 +355,13 @@ def do_replay_invalid(config: Config, args: argparse.Namespace) -> None:
     with db as dbsession:
         query = dbsession.chunked_query(InvalidAggregateEvent, chunk_size=args.chunk_size)
         query = query.reverse_chunks()
-        total = query.count()
+        total = query.count(estimated=True)
+
+    chunks = db.process_chunks(query, replay_invalid_aggregate_events, jobs=args.jobs)
 
-        # FIXME: Stop ignoring from coverage report once we actually have aggregate events
-        for chunk_number, chunk in enumerate(query, start=1):  # pragma: no cover
-            replay_invalid_aggregate_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    # FIXME: Stop ignoring from coverage report once we actually have aggregate events
+    for num_processed in chunks:  # pragma: no cover
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -369,12 +370,12 @@ def do_replay_invalid(config: Config, args: argparse.Namespace) -> None:
     with db as dbsession:
         query = dbsession.chunked_query(InvalidSequence, chunk_size=args.chunk_size)
         query = query.reverse_chunks()
-        total = query.count()
+        total = query.count(estimated=True)
+
+    chunks = db.process_chunks(query, replay_invalid_sequences, jobs=args.jobs)
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_invalid_sequences(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -390,7 +391,9 @@ def do_replay_machine_dualboots(config: Config, args: argparse.Namespace) -> Non
 
         total = query.count()
 
-        for i, (machine_id, ) in enumerate(query, start=1):
+        rows = dbsession.stream(query, chunk_size=args.chunk_size)
+
+        for i, (machine_id, ) in enumerate(rows, start=1):
             upsert_machine_dualboot(dbsession, machine_id)
 
             if (i % args.chunk_size) == 0:
@@ -411,7 +414,9 @@ def do_replay_machine_images(config: Config, args: argparse.Namespace) -> None:
 
         total = query.count()
 
-        for i, (machine_id, image_id) in enumerate(query, start=1):
+        rows = dbsession.stream(query, chunk_size=args.chunk_size)
+
+        for i, (machine_id, image_id) in enumerate(rows, start=1):
             upsert_machine_image(dbsession, machine_id, image_id)
 
             if (i % args.chunk_size) == 0:
@@ -432,7 +437,9 @@ def do_replay_machine_live_usbs(config: Config, args: argparse.Namespace) -> Non
 
         total = query.count()
 
-        for i, (machine_id, ) in enumerate(query, start=1):
+        rows = dbsession.stream(query, chunk_size=args.chunk_size)
+
+        for i, (machine_id, ) in enumerate(rows, start=1):
             upsert_machine_live(dbsession, machine_id)
 
             if (i % args.chunk_size) == 0:
@@ -457,10 +464,11 @@ def do_replay_unknown(config: Config, args: argparse.Namespace) -> None:
         total = query.count()
 
         progress(0, total)
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_unknown_singular_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+
+    chunks = db.process_chunks(query, replay_unknown_singular_events, jobs=args.jobs)
+
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -477,11 +485,11 @@ def do_replay_unknown(config: Config, args: argparse.Namespace) -> None:
         total = query.count()
 
         progress(0, total)
-        # FIXME: Stop ignoring from coverage report once we actually have aggregate events
-        for chunk_number, chunk in enumerate(query, start=1):  # pragma: no cover
-            replay_unknown_aggregate_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    chunks = db.process_chunks(query, replay_unknown_aggregate_events, jobs=args.jobs)
+
+    # FIXME: Stop ignoring from coverage report once we actually have aggregate events
+    for num_processed in chunks:  # pragma: no cover
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -498,10 +506,11 @@ def do_replay_unknown(config: Config, args: argparse.Namespace) -> None:
         total = query.count()
 
         progress(0, total)
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_unknown_sequences(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+
+    chunks = db.process_chunks(query, replay_unknown_sequences, jobs=args.jobs)
+
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -8,21 +8,20 @@
 
 
 import logging
+from typing import List
 
 from sqlalchemy.exc import IntegrityError
 
 from azafea.model import DbSession
 
-from .model import RequestBuilder, new_aggregate_event, new_sequence_event, new_singular_event
+from .model import (
+    Request, RequestBuilder, new_aggregate_event, new_sequence_event, new_singular_event)
 
 
 log = logging.getLogger(__name__)
 
 
-def process(dbsession: DbSession, record: bytes) -> None:
-    log.debug('Processing metric v2 record: %s', record)
-
-    request_builder = RequestBuilder.parse_bytes(record)
+def _add_request(dbsession: DbSession, request_builder: RequestBuilder) -> None:
     request = request_builder.build_request()
     dbsession.add(request)
 
@@ -42,6 +41,13 @@ def process(dbsession: DbSession, record: bytes) -> None:
         if sequence_event is not None:
             log.debug('Inserting sequence event:\n%s', sequence_event)
 
+
+def process(dbsession: DbSession, record: bytes) -> None:
+    log.debug('Processing metric v2 record: %s', record)
+
+    request_builder = RequestBuilder.parse_bytes(record)
+    _add_request(dbsession, request_builder)
+
     try:
         dbsession.commit()
 
@@ -54,3 +60,24 @@ def process(dbsession: DbSession, record: bytes) -> None:
         # FIXME: Given how the request is built, this shouldn't ever happen; if it does though, we
         # absolutely need an integration test
         raise  # pragma: no cover
+
+
+def process_batch(dbsession: DbSession, records: List[bytes]) -> None:
+    log.debug('Processing %d metric v2 records', len(records))
+
+    request_builders = [RequestBuilder.parse_bytes(record) for record in records]
+
+    # We can't rely on the unicity constraint to skip the requests which had already been
+    # processed, as that would fail the whole batch; filter them out beforehand instead
+    query = dbsession.query(Request.sha512)
+    query = query.filter(Request.sha512.in_({b.sha512 for b in request_builders}))
+    processed_sha512s = {sha512 for (sha512, ) in query}
+
+    for request_builder in request_builders:
+        if request_builder.sha512 in processed_sha512s:
+            log.debug('Request had already been processed in the past')
+            continue
+
+        # The same request could be twice in the batch
+        processed_sha512s.add(request_builder.sha512)
+        _add_request(dbsession, request_builder)
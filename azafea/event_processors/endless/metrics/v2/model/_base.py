@@ -22,6 +22,7 @@ from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.types import BigInteger, DateTime, Integer, LargeBinary, Unicode
 
 from azafea.model import Base, DbSession
+from azafea.timing import ORM, PARSE_PAYLOAD
 
 from ..utils import get_bytes, get_child_values, get_event_datetime, get_variant
 from ._request import Request
@@ -122,6 +123,7 @@ class MetricEvent(Base, metaclass=MetricMeta):
     # This comes in as a uint32, but PostgreSQL only has signed types so we need a BIGINT (int64)
     user_id = Column(BigInteger, nullable=False)
 
+    @ORM
     def __init__(self, payload: GLib.Variant, **kwargs: Dict[str, Any]) -> None:
         payload_fields = self._parse_payload(payload)
         kwargs.update(payload_fields)
@@ -150,7 +152,8 @@ class MetricEvent(Base, metaclass=MetricMeta):
                                     f'{self.__payload_type__} payload, but got '
                                     f'{payload} ({payload_type})')
 
-        return self._get_fields_from_payload(payload)
+        with PARSE_PAYLOAD:
+            return self._get_fields_from_payload(payload)
 
     @staticmethod
     def _get_fields_from_payload(payload: GLib.Variant) -> Dict[str, Any]:
@@ -15,6 +15,7 @@ from sqlalchemy.schema import Column, Index
 from sqlalchemy.types import BigInteger, Date, DateTime, Integer, Unicode
 
 from azafea.model import Base, DbSession, View
+from azafea.timing import DECODE
 
 from gi.repository import GLib
 
@@ -64,10 +65,12 @@ class RequestBuilder:
         received_at = datetime.fromtimestamp(received_at_timestamp / 1000000, tz=timezone.utc)
 
         request_body = data[8:]
-        variant = GLib.Variant.new_from_bytes(cls.__variant_type__, GLib.Bytes.new(request_body),
-                                              False)
+        with DECODE:
+            variant = GLib.Variant.new_from_bytes(cls.__variant_type__,
+                                                  GLib.Bytes.new(request_body), False)
+            is_normal_form = variant.is_normal_form()
 
-        if not variant.is_normal_form():
+        if not is_normal_form:
             raise ValueError('Metric request is not in the expected format: '
                              f'{cls.__format_string__}')
 
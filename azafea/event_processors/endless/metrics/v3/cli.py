@@ -9,9 +9,11 @@
 import argparse
 import logging
 
+from sqlalchemy.orm.query import Query
+
 from azafea.config import Config
 from azafea.model import Db
-from azafea.utils import progress
+from azafea.utils import jobs_number, progress
 
 from ...image import parse_endless_os_image
 from .model import (
@@ -37,12 +39,16 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     replay_invalid.add_argument('--chunk-size', type=int, default=5000,
                                 help='The size of the chunks to operate on')
+    replay_invalid.add_argument('--jobs', type=jobs_number, default=1,
+                                help='The number of processes to run in parallel')
     replay_invalid.set_defaults(subcommand=do_replay_invalid)
 
     replay_unknown = subs.add_parser('replay-unknown', help='Replay unknown events',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     replay_unknown.add_argument('--chunk-size', type=int, default=5000,
                                 help='The size of the chunks to operate on')
+    replay_unknown.add_argument('--jobs', type=jobs_number, default=1,
+                                help='The number of processes to run in parallel')
     replay_unknown.set_defaults(subcommand=do_replay_unknown)
 
     parse_images = subs.add_parser('parse-old-images',
@@ -50,6 +56,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parse_images.add_argument('--chunk-size', type=int, default=5000,
                               help='The size of the chunks to operate on')
+    parse_images.add_argument('--jobs', type=jobs_number, default=1,
+                              help='The number of processes to run in parallel')
     parse_images.set_defaults(subcommand=do_parse_images)
 
 
@@ -60,12 +68,12 @@ def do_replay_invalid(config: Config, args: argparse.Namespace) -> None:
     with db as dbsession:
         query = dbsession.chunked_query(InvalidSingularEvent, chunk_size=args.chunk_size)
         query = query.reverse_chunks()
-        total = query.count()
+        total = query.count(estimated=True)
+
+    chunks = db.process_chunks(query, replay_invalid_singular_events, jobs=args.jobs)
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_invalid_singular_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -74,13 +82,13 @@ def do_replay_invalid(config: Config, args: argparse.Namespace) -> None:
     with db as dbsession:
         query = dbsession.chunked_query(InvalidAggregateEvent, chunk_size=args.chunk_size)
         query = query.reverse_chunks()
-        total = query.count()
+        total = query.count(estimated=True)
+
+    chunks = db.process_chunks(query, replay_invalid_aggregate_events, jobs=args.jobs)
 
-        # FIXME: Stop ignoring from coverage report once we actually have aggregate events
-        for chunk_number, chunk in enumerate(query, start=1):  # pragma: no cover
-            replay_invalid_aggregate_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    # FIXME: Stop ignoring from coverage report once we actually have aggregate events
+    for num_processed in chunks:  # pragma: no cover
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -100,10 +108,11 @@ def do_replay_unknown(config: Config, args: argparse.Namespace) -> None:
         total = query.count()
 
         progress(0, total)
-        for chunk_number, chunk in enumerate(query, start=1):
-            replay_unknown_singular_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+
+    chunks = db.process_chunks(query, replay_unknown_singular_events, jobs=args.jobs)
+
+    for num_processed in chunks:
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
@@ -120,15 +129,23 @@ def do_replay_unknown(config: Config, args: argparse.Namespace) -> None:
         total = query.count()
 
         progress(0, total)
-        # FIXME: Stop ignoring from coverage report once we actually have aggregate events
-        for chunk_number, chunk in enumerate(query, start=1):  # pragma: no cover
-            replay_unknown_aggregate_events(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, total)
+    chunks = db.process_chunks(query, replay_unknown_aggregate_events, jobs=args.jobs)
+
+    # FIXME: Stop ignoring from coverage report once we actually have aggregate events
+    for num_processed in chunks:  # pragma: no cover
+        progress(num_processed, total)
 
     progress(total, total, end='\n')
 
 
+def _parse_images_chunk(chunk: Query) -> None:
+    for channel in chunk:
+        parsed_image = parse_endless_os_image(channel.image_id, tzinfo=False)
+
+        for k, v in parsed_image.items():
+            setattr(channel, k, v)
+
+
 def do_parse_images(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     log.info('Parsing image IDs for existing channel records')
@@ -143,14 +160,10 @@ def do_parse_images(config: Config, args: argparse.Namespace) -> None:
             log.info('-> No Channel records with unparsed image IDs')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            for channel in chunk:
-                parsed_image = parse_endless_os_image(channel.image_id, tzinfo=False)
-                for k, v in parsed_image.items():
-                    setattr(channel, k, v)
+    chunks = db.process_chunks(query, _parse_images_chunk, jobs=args.jobs)
 
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
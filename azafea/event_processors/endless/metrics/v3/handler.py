@@ -10,16 +10,19 @@
 import logging
 from dataclasses import asdict
 from datetime import datetime, timezone
+from typing import Iterator, List
 from uuid import UUID
 
-from azafea.model import DbSession
-from sqlalchemy.exc import IntegrityError
+from azafea.model import DbSession, IdCache
+from azafea.timing import FLUSH
 
 from .model import (
     IGNORED_EVENTS,
     Channel,
+    MetricEvent,
     Request,
     RequestChannel,
+    RequestData,
     new_aggregate_event,
     new_singular_event,
     parse_record,
@@ -30,54 +33,103 @@ from .utils import get_bytes
 log = logging.getLogger(__name__)
 
 
-def _get_or_create_channel(dbsession: DbSession, request_channel: RequestChannel) -> Channel:
+# The number of distinct channels is tiny compared to the number of requests, so keep the ids of
+# the most recent ones around rather than looking them up for each request
+CHANNEL_CACHE_SIZE = 10000
+
+_channel_ids = IdCache(Channel, CHANNEL_CACHE_SIZE)
+
+
+def _get_channel_id(dbsession: DbSession, request_channel: RequestChannel) -> int:
+    key = (request_channel.image_id, tuple(sorted(request_channel.site.items())),
+           request_channel.dual_boot, request_channel.live)
     channel_dict = asdict(request_channel)
 
-    channel = dbsession.query(Channel).filter_by(**channel_dict).one_or_none()
-    if not channel:
-        try:
-            with dbsession.begin_nested():
-                channel = Channel(**channel_dict)
-                dbsession.add(channel)
-        except IntegrityError:
-            channel = dbsession.query(Channel).filter_by(**channel_dict).one()
+    return _channel_ids.get_id(dbsession, key, channel_dict,
+                               lambda: Channel(**channel_dict).to_row())
+
+
+def _new_events(dbsession: DbSession, request_data: RequestData, channel_id: int
+                ) -> Iterator[MetricEvent]:
+    events_and_functions = (
+        (request_data.singulars, new_singular_event),
+        (request_data.aggregates, new_aggregate_event))
+
+    for events, new_event in events_and_functions:
+        for event_variant in events:
+            event_id = str(UUID(bytes=get_bytes(event_variant.get_child_value(0))))
+            if event_id in IGNORED_EVENTS:
+                continue
+            event = new_event(request_data, channel_id, event_id, event_variant, dbsession)
+
+            if event is not None:
+                log.debug('Inserting metric:\n%s', event)
+                yield event
+
 
-    return channel
+def _new_request(request_data: RequestData, channel_id: int) -> Request:
+    return Request(
+        sha512=request_data.sha512,  # type: ignore
+        received_at=datetime.fromtimestamp(
+            request_data.received_at / 1000000, tz=timezone.utc
+        ),
+        absolute_timestamp=request_data.absolute_timestamp,
+        relative_timestamp=request_data.relative_timestamp,
+        channel_id=channel_id
+    )
 
 
 def process(dbsession: DbSession, record: bytes) -> None:
     log.debug('Processing metric v3 record: %s', record)
 
     request_data, request_channel = parse_record(record)
-    events_and_functions = (
-        (request_data.singulars, new_singular_event),
-        (request_data.aggregates, new_aggregate_event))
 
-    channel = _get_or_create_channel(dbsession, request_channel)
+    channel_id = _get_channel_id(dbsession, request_channel)
 
     try:
         with dbsession.begin_nested():
-            request = Request(
-                sha512=request_data.sha512,  # type: ignore
-                received_at=datetime.fromtimestamp(
-                    request_data.received_at / 1000000, tz=timezone.utc
-                ),
-                absolute_timestamp=request_data.absolute_timestamp,
-                relative_timestamp=request_data.relative_timestamp,
-                channel=channel
-            )
+            request = _new_request(request_data, channel_id)
             dbsession.add(request)
     except Exception as e:
         log.error(e)
 
-    for events, new_event in events_and_functions:
-        for event_variant in events:
-            event_id = str(UUID(bytes=get_bytes(event_variant.get_child_value(0))))
-            if event_id in IGNORED_EVENTS:
-                continue
-            event = new_event(request_data, channel, event_id, event_variant, dbsession)
+    events = list(_new_events(dbsession, request_data, channel_id))
+
+    # Nothing needs the events in the identity map nor their ids, so insert them with a few
+    # multi-row statements rather than one by one as a flush would, to fetch their ids
+    with FLUSH:
+        dbsession.bulk_save_objects(events, preserve_order=False)
 
-            if event is not None:
-                dbsession.add(event)
-                log.debug('Inserting metric:\n%s', event)
     dbsession.commit()
+
+
+def process_batch(dbsession: DbSession, records: List[bytes]) -> None:
+    log.debug('Processing %d metric v3 records', len(records))
+
+    parsed_records = [parse_record(record) for record in records]
+
+    # Find the requests which had already been processed beforehand, rather than with one
+    # savepoint per request
+    query = dbsession.query(Request.sha512)
+    query = query.filter(Request.sha512.in_({r.sha512 for (r, _) in parsed_records}))
+    processed_sha512s = {sha512 for (sha512, ) in query}
+
+    requests: List[Request] = []
+    events: List[MetricEvent] = []
+
+    for request_data, request_channel in parsed_records:
+        channel_id = _get_channel_id(dbsession, request_channel)
+
+        if request_data.sha512 in processed_sha512s:
+            # Just like process(), only skip the request itself and still insert its events
+            log.error('Request %s had already been processed in the past', request_data.sha512)
+
+        else:
+            # The same request could be twice in the batch
+            processed_sha512s.add(request_data.sha512)
+            requests.append(_new_request(request_data, channel_id))
+
+        events.extend(_new_events(dbsession, request_data, channel_id))
+
+    dbsession.insert_all(requests)
+    dbsession.insert_all(events)
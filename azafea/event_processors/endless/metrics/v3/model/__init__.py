@@ -28,6 +28,7 @@ from ._base import (  # noqa: F401
     EmptyPayloadError,
     InvalidAggregateEvent,
     InvalidSingularEvent,
+    MetricEvent,
     Request,
     RequestChannel,
     SingularEvent,
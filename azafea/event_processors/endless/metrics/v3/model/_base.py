@@ -11,7 +11,7 @@ import logging
 from dataclasses import dataclass
 from datetime import date, datetime
 from hashlib import sha512
-from typing import Any, Dict, Optional, Set, Tuple, Type, Union, cast
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union, cast
 
 from gi.repository import GLib
 
@@ -25,6 +25,7 @@ from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.types import BigInteger, Boolean, Date, DateTime, Integer, LargeBinary, Unicode
 
 from azafea.model import Base, DbSession
+from azafea.timing import DECODE, ORM, PARSE_PAYLOAD
 
 from ..utils import get_child_values, get_event_datetime, get_variant
 from ....image import parse_endless_os_image
@@ -205,6 +206,7 @@ class MetricEvent(Base, metaclass=MetricMeta):
     def channel(cls) -> relationship:
         return relationship(Channel)
 
+    @ORM
     def __init__(self, payload: GLib.Variant, **kwargs: Dict[str, Any]) -> None:
         payload_fields = self._parse_payload(payload)
         fields = kwargs.copy()
@@ -240,7 +242,8 @@ class MetricEvent(Base, metaclass=MetricMeta):
                                     f'{" or ".join(types)} payload, but got '
                                     f'{payload} ({payload_type})')
 
-        return self._get_fields_from_payload(payload)
+        with PARSE_PAYLOAD:
+            return self._get_fields_from_payload(payload)
 
     @staticmethod
     def _get_fields_from_payload(payload: GLib.Variant) -> Dict[str, Any]:
@@ -341,9 +344,11 @@ def parse_record(record: bytes) -> Tuple[RequestData, RequestChannel]:
 
     received_at_timestamp = int.from_bytes(timestamp_bytes, 'little') * 1000  # in nanoseconds
 
-    payload = GLib.Variant.new_from_bytes(VARIANT_TYPE, GLib.Bytes.new(request_bytes), False)
+    with DECODE:
+        payload = GLib.Variant.new_from_bytes(VARIANT_TYPE, GLib.Bytes.new(request_bytes), False)
+        is_normal_form = payload.is_normal_form()
 
-    if not payload.is_normal_form():
+    if not is_normal_form:
         raise ValueError(
             f'Metric request is not in the expected format: {VARIANT_TYPE.dup_string()}')
 
@@ -384,7 +389,7 @@ def parse_record(record: bytes) -> Tuple[RequestData, RequestChannel]:
     return request, channel
 
 
-def new_singular_event(request: RequestData, channel: Channel, event_id: str,
+def new_singular_event(request: RequestData, channel_id: int, event_id: str,
                        event_variant: GLib.Variant, dbsession: DbSession
                        ) -> Optional[SingularEvent]:
     os_version = event_variant.get_child_value(1).get_string()
@@ -402,7 +407,7 @@ def new_singular_event(request: RequestData, channel: Channel, event_id: str,
             event = event_model(
                 payload=payload,  # type: ignore
                 os_version=os_version,
-                occured_at=event_date, channel=channel, **request.asdict()
+                occured_at=event_date, channel_id=channel_id, **request.asdict()
             )
         except Exception as e:
             if isinstance(e, EmptyPayloadError) and event_id in IGNORED_EMPTY_PAYLOAD_ERRORS:
@@ -415,7 +420,7 @@ def new_singular_event(request: RequestData, channel: Channel, event_id: str,
                 event_id=event_id,
                 os_version=os_version,
                 occured_at=event_date,
-                channel=channel,
+                channel_id=channel_id,
                 error=str(e),
                 **request.asdict()
             )
@@ -427,13 +432,13 @@ def new_singular_event(request: RequestData, channel: Channel, event_id: str,
             event_id=event_id,
             os_version=os_version,
             occured_at=event_date,
-            channel=channel,
+            channel_id=channel_id,
             **request.asdict()
         )
     return event
 
 
-def new_aggregate_event(request: RequestData, channel: Channel, event_id: str,
+def new_aggregate_event(request: RequestData, channel_id: int, event_id: str,
                         event_variant: GLib.Variant, dbsession: DbSession
                         ) -> Optional[AggregateEvent]:
     os_version = event_variant.get_child_value(1).get_string()
@@ -451,7 +456,7 @@ def new_aggregate_event(request: RequestData, channel: Channel, event_id: str,
                 os_version=os_version,
                 period_start=AggregateEvent.parse_period_start(period_start_str),
                 count=count,
-                channel=channel,
+                channel_id=channel_id,
                 **request.asdict()
             )
         except Exception as e:
@@ -467,7 +472,7 @@ def new_aggregate_event(request: RequestData, channel: Channel, event_id: str,
                 period_start=date(1970, 1, 1),
                 count=count,
                 error=str(e),
-                channel=channel,
+                channel_id=channel_id,
                 **request.asdict()
             )
     else:
@@ -479,13 +484,15 @@ def new_aggregate_event(request: RequestData, channel: Channel, event_id: str,
             os_version=os_version,
             period_start=date(1970, 1, 1),
             receveid_period_start=period_start_str,
-            channel=channel,
+            channel_id=channel_id,
             count=count, **request.asdict())
 
     return event
 
 
 def replay_invalid_singular_events(invalid_events: Query) -> None:
+    replayed_events: List[SingularEvent] = []
+
     for invalid in invalid_events:
         event_id = str(invalid.event_id)
 
@@ -511,7 +518,7 @@ def replay_invalid_singular_events(invalid_events: Query) -> None:
                 payload=payload,
                 os_version=invalid.os_version,
             )
-            invalid_events.session.add(event)
+            replayed_events.append(event)
             invalid_events.session.delete(invalid)
             continue
 
@@ -535,9 +542,11 @@ def replay_invalid_singular_events(invalid_events: Query) -> None:
             # The event is still invalid
             continue
 
-        invalid_events.session.add(event)
+        replayed_events.append(event)
         invalid_events.session.delete(invalid)
 
+    invalid_events.session.insert_all(replayed_events)
+
 
 def replay_invalid_aggregate_events(invalid_events: Query) -> None:  # pragma: no cover
     # TODO: Implement this when we actually have aggregate events
@@ -550,6 +559,8 @@ def singular_event_is_known(event_id: str) -> bool:
 
 
 def replay_unknown_singular_events(unknown_events: Query) -> None:
+    replayed_events: List[SingularEvent] = []
+
     for unknown in unknown_events:
         event_id = str(unknown.event_id)
 
@@ -593,9 +604,11 @@ def replay_unknown_singular_events(unknown_events: Query) -> None:
                 error=str(e)
             )
 
-        unknown_events.session.add(event)
+        replayed_events.append(event)
         unknown_events.session.delete(unknown)
 
+    unknown_events.session.insert_all(replayed_events)
+
 
 def aggregate_event_is_known(event_id: str) -> bool:
     return (event_id in AGGREGATE_EVENT_MODELS) or (event_id in IGNORED_EVENTS)
@@ -98,6 +98,40 @@ class TestPing(IntegrationTest):
             pings = dbsession.query(Ping)
             assert pings.count() == 10
 
+    def test_ping_v1_batch(self):
+        from azafea.event_processors.endless.ping.v1.handler import (
+            PingConfiguration, Ping, process_batch)
+
+        # Create the tables
+        self.run_subcommand('initdb')
+        self.ensure_tables(Ping, PingConfiguration)
+
+        # Process a batch of events, with only 2 different configurations
+        created_at = datetime.now(tz=timezone.utc)
+        records = [
+            json.dumps({
+                'image': 'eos-eos3.7-amd64-amd64.190419-225606.base',
+                'vendor': 'the vendor',
+                'product': 'product',
+                'dualboot': (True, False)[i % 2],
+                'release': 'release',
+                'count': i,
+                'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S.%fZ'),
+            }).encode('utf-8')
+            for i in range(4)
+        ]
+
+        with self.db as dbsession:
+            process_batch(dbsession, records)
+
+        # Ensure the records were inserted into the DB
+        with self.db as dbsession:
+            assert dbsession.query(PingConfiguration).count() == 2
+
+            pings = dbsession.query(Ping).order_by(Ping.count).all()
+            assert [p.count for p in pings] == [0, 1, 2, 3]
+            assert [p.config.dualboot for p in pings] == [True, False, True, False]
+
     def test_ping_v1_unknown_image(self):
         from azafea.event_processors.endless.ping.v1.handler import PingConfiguration, Ping
 
@@ -140,6 +174,37 @@ class TestPing(IntegrationTest):
             assert ping.count == 0
             assert ping.created_at == created_at
 
+    def test_ping_v1_invalid_ping(self, capfd):
+        from azafea.event_processors.endless.ping.v1.handler import PingConfiguration, Ping
+
+        # Create the tables
+        self.run_subcommand('initdb')
+        self.ensure_tables(Ping, PingConfiguration)
+
+        # Send an event to the Redis queue
+        created_at = datetime.now(tz=timezone.utc)
+        self.redis.lpush('test_ping_v1_invalid_ping', json.dumps({
+            'image': 'eos-eos3.7-amd64-amd64.190419-225606.base',
+            'vendor': 'the vendor',
+            'product': 'product',
+            'dualboot': True,
+            'release': 'release',
+            'count': 0,
+            'country': 'FRA',
+            'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S.%fZ'),
+        }))
+
+        # Run Azafea so it processes the event
+        self.run_azafea()
+
+        # The configuration is in the same transaction as the invalid ping
+        with self.db as dbsession:
+            assert dbsession.query(PingConfiguration).count() == 0
+            assert dbsession.query(Ping).count() == 0
+
+        capture = capfd.readouterr()
+        assert 'country has wrong length: FRA' in capture.err
+
     def test_ping_v1_invalid_image(self, capfd):
         from azafea.event_processors.endless.ping.v1.handler import PingConfiguration, Ping
 
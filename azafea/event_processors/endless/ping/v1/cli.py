@@ -14,7 +14,7 @@ from sqlalchemy.orm.query import Query
 
 from azafea.config import Config
 from azafea.model import Db
-from azafea.utils import progress
+from azafea.utils import jobs_number, progress
 from azafea.vendors import normalize_vendor
 
 from ...image import parse_endless_os_image
@@ -37,6 +37,8 @@ def register_commands(subs: argparse._SubParsersAction) -> None:
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parse_images.add_argument('--chunk-size', type=int, default=5000,
                               help='The size of the chunks to operate on')
+    parse_images.add_argument('--jobs', type=jobs_number, default=1,
+                              help='The number of processes to run in parallel')
     parse_images.set_defaults(subcommand=do_parse_images)
 
 
@@ -78,22 +80,30 @@ def do_normalize_vendors(config: Config, args: argparse.Namespace) -> None:
 
     with db as dbsession:
         query = dbsession.chunked_query(PingConfiguration, chunk_size=args.chunk_size)
-        num_records = query.count()
+        num_records = query.count(estimated=True)
 
         if num_records == 0:
             log.info('-> No ping configuration record in database')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            _normalize_chunk(chunk)
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    chunks = db.process_chunks(query, _normalize_chunk)
+
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
     log.info('All done!')
 
 
+def _parse_images_chunk(chunk: Query) -> None:
+    for ping_config in chunk:
+        parsed_image = parse_endless_os_image(ping_config.image)
+
+        for k, v in parsed_image.items():
+            setattr(ping_config, k, v)
+
+
 def do_parse_images(config: Config, args: argparse.Namespace) -> None:
     db = Db(config.postgresql)
     log.info('Parsing the image ids for old pings')
@@ -109,15 +119,10 @@ def do_parse_images(config: Config, args: argparse.Namespace) -> None:
             log.info('-> No ping record with unparsed image ids')
             return None
 
-        for chunk_number, chunk in enumerate(query, start=1):
-            for ping_config in chunk:
-                parsed_image = parse_endless_os_image(ping_config.image)
-
-                for k, v in parsed_image.items():
-                    setattr(ping_config, k, v)
+    chunks = db.process_chunks(query, _parse_images_chunk, jobs=args.jobs)
 
-            dbsession.commit()
-            progress(chunk_number * args.chunk_size, num_records)
+    for num_processed in chunks:
+        progress(num_processed, num_records)
 
     progress(num_records, num_records, end='\n')
 
@@ -9,15 +9,14 @@
 
 import json
 import logging
-from typing import Optional
+from typing import List, Optional
 
-from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import relationship, validates
 from sqlalchemy.schema import CheckConstraint, Column, ForeignKey, UniqueConstraint
 from sqlalchemy.types import Boolean, DateTime, Integer, Unicode
 
-from azafea.model import Base, DbSession, NullableBoolean
+from azafea.model import Base, DbSession, IdCache, NullableBoolean
 from azafea.vendors import normalize_vendor
 
 from ...image import parse_endless_os_image
@@ -25,6 +24,10 @@ from ...image import parse_endless_os_image
 
 log = logging.getLogger(__name__)
 
+# There are far fewer configurations than pings, so keep the ids of the most recent ones around
+# rather than looking them up for each ping
+CONFIGURATION_CACHE_SIZE = 10000
+
 
 class PingConfiguration(Base):
     __tablename__ = 'ping_configuration_v1'
@@ -61,22 +64,19 @@ class PingConfiguration(Base):
         if 'image' in record:  # pragma: no branch
             record.update(**parse_endless_os_image(record['image']))
 
-        # Postgresql's 'INSERT … ON CONFLICT …' is not available at the ORM layer, so let's
-        # drop down to the SQL layer
-        stmt = insert(PingConfiguration.__table__).values(**record)
-        stmt = stmt.returning(PingConfiguration.__table__.c.id)
+        filters = {
+            'image': record.get('image'),
+            'vendor': record['vendor'],
+            'product': record.get('product'),
+            'dualboot': record.get('dualboot'),
+        }
+
+        return _configuration_ids.get_id(dbsession, tuple(filters.values()), filters,
+                                         lambda: record)
 
-        # We have to use 'ON CONFLICT … DO UPDATE …' because 'ON CONFLICT DO NOTHING' does not
-        # return anything, and we need to get the id back; in addition we have to actually
-        # update something, anything, so let's arbitrarily update the image to its existing value
-        stmt = stmt.on_conflict_do_update(
-            constraint='uq_ping_configuration_v1_image_vendor_product_dualboot',
-            set_={'image': record['image']}
-        )
-        result = dbsession.connection().execute(stmt)
-        dbsession.commit()
 
-        return result.first()[0]
+_configuration_ids = IdCache(PingConfiguration, CONFIGURATION_CACHE_SIZE,
+                             constraint='uq_ping_configuration_v1_image_vendor_product_dualboot')
 
 
 class Ping(Base):
@@ -129,3 +129,16 @@ def process(dbsession: DbSession, record: bytes) -> None:
     ping.config_id = ping_config_id
     dbsession.add(ping)
     log.debug('Inserting ping record:\n%s', ping)
+
+
+def process_batch(dbsession: DbSession, records: List[bytes]) -> None:
+    log.debug('Processing %d ping v1 records', len(records))
+
+    pings = []
+
+    for record in records:
+        ping = Ping.from_serialized(record)
+        ping.config_id = PingConfiguration.id_from_serialized(record, dbsession)
+        pings.append(ping)
+
+    dbsession.insert_all(pings)
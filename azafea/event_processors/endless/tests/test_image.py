@@ -127,3 +127,31 @@ def test_parse_endless_os_image_invalid_time(invalid_image_id):
         parse_endless_os_image(invalid_image_id)
 
     assert f'Invalid image id {invalid_image_id!r}: Could not parse the time' in str(excinfo.value)
+
+
+def test_parse_endless_os_image_cached():
+    from azafea.event_processors.endless.image import (
+        _parse_endless_os_image, parse_endless_os_image)
+
+    _parse_endless_os_image.cache_clear()
+
+    image_id = 'eos-eos3.7-armv7hl-ec100.190419-225606.base'
+    parsed = parse_endless_os_image(image_id)
+    parsed['image_product'] = 'modified'
+    assert _parse_endless_os_image.cache_info().hits == 0
+
+    # The cached result can't be modified by callers
+    assert parse_endless_os_image(image_id)['image_product'] == 'eos'
+    assert _parse_endless_os_image.cache_info().hits == 1
+
+    # Both timestamp variants are cached separately
+    assert parse_endless_os_image(image_id)['image_timestamp'] == datetime(
+        2019, 4, 19, 22, 56, 6, tzinfo=timezone.utc)
+    assert parse_endless_os_image(image_id, tzinfo=False)['image_timestamp'] == datetime(
+        2019, 4, 19, 22, 56, 6)
+    assert parse_endless_os_image(image_id)['image_timestamp'].tzinfo == timezone.utc
+    assert parse_endless_os_image(image_id, tzinfo=False)['image_timestamp'].tzinfo is None
+
+    cache_info = _parse_endless_os_image.cache_info()
+    assert cache_info.hits == 4
+    assert cache_info.misses == 2
@@ -7,13 +7,21 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
+from collections import defaultdict
 import copy
+from datetime import date, time, timedelta
+from io import StringIO
+import multiprocessing
+from multiprocessing.queues import Queue
 from operator import attrgetter
+from queue import Empty
 from types import TracebackType
-from typing import Any, Dict, Iterator, Optional, Tuple, Type
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+from weakref import WeakSet
 
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.dialects.postgresql.base import PGDDLCompiler
-from sqlalchemy.engine import create_engine
+from sqlalchemy.engine import Connection, Dialect, create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.event import listen
 from sqlalchemy.exc import OperationalError
@@ -21,14 +29,17 @@ from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm.interfaces import MANYTOONE
 from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.relationships import RelationshipProperty
-from sqlalchemy.orm.session import Session as SaSession, sessionmaker
+from sqlalchemy.orm.session import Session as SaSession, SessionTransaction, sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlalchemy.schema import Column, CreateColumn, DDL, MetaData, Table
-from sqlalchemy.types import Enum, TypeDecorator
+from sqlalchemy.sql import func, text
+from sqlalchemy.types import Enum, LargeBinary, TypeDecorator
 
 from .config import PostgreSQL as PgConfig
-from .utils import get_fqdn
+from .utils import LRUCache, get_fqdn
 
 
 # Recommended naming convention used by Alembic, as various different database
@@ -53,6 +64,39 @@ class BaseModel:
             if k in columns:
                 setattr(self, k, v)
 
+    def to_row(self) -> Dict[str, Any]:
+        """Get the column values which were set on this instance, keyed by column name
+
+        Just like when flushing, the foreign keys of the many-to-one relationships which were set
+        are taken from the related instances, which must have a primary key already.
+        """
+        mapper = inspect(self.__class__)
+        row = {
+            column_property.columns[0].name: self.__dict__[column_property.key]
+            for column_property in mapper.column_attrs
+            if column_property.key in self.__dict__
+        }
+
+        for relationship_property in mapper.relationships:
+            if relationship_property.direction is not MANYTOONE:
+                continue
+
+            if relationship_property.key not in self.__dict__:
+                continue
+
+            related = self.__dict__[relationship_property.key]
+
+            for local, remote in relationship_property.local_remote_pairs:
+                if related is None:
+                    row[local.name] = None
+
+                else:
+                    related_mapper = inspect(related.__class__)
+                    row[local.name] = getattr(related,
+                                              related_mapper.get_property_by_column(remote).key)
+
+        return row
+
     def __str__(self) -> str:
         result = [f'# {get_fqdn(self.__class__)}']
         mapper = inspect(self.__class__)
@@ -74,33 +118,101 @@ class BaseModel:
 
 
 class ChunkedQuery:
+    """Iterate over the rows of a model in chunks, ordered by id
+
+    Chunks are delimited by ranges of ids (keyset pagination) rather than with OFFSET and LIMIT, so
+    getting the last chunk is as fast as getting the first one, and rows of the current chunk can
+    be deleted or updated without shifting the following chunks.
+    """
     def __init__(self, dbsession: 'DbSession', model: Type['Base'], chunk_size: int):
-        self._query = dbsession.query(model).order_by(model.id)
+        self._dbsession = dbsession
+        self._model = model
+        self._query = dbsession.query(model)
         self._chunk_size = chunk_size
         self._total_count: Optional[int] = None
         self._descending = False
+        self._filtered = False
 
     def __iter__(self) -> Iterator[Query]:
-        total = self.count()
+        id_column = self._model.id
+        boundary = None
 
-        if self._descending:
-            for stop in range(total, 0, -self._chunk_size):
-                start = max(stop - self._chunk_size, 0)
+        while True:
+            chunk = self._query
 
-                yield self._query.slice(start, stop)
+            if boundary is not None:
+                chunk = chunk.filter(id_column < boundary if self._descending
+                                     else id_column > boundary)
 
-        else:
-            for start in range(0, total, self._chunk_size):
-                stop = min(start + self._chunk_size, total)
+            # The id at the other end of the chunk, the chunk is the last one if there is none
+            ids = chunk.with_entities(id_column)
+            ids = ids.order_by(id_column.desc() if self._descending else id_column)
+            edge = ids.offset(self._chunk_size - 1).limit(1).scalar()
+
+            if edge is None:
+                if self._dbsession.query(chunk.exists()).scalar():
+                    yield chunk.order_by(id_column)
+
+                return
+
+            chunk = chunk.filter(id_column >= edge if self._descending else id_column <= edge)
+
+            yield chunk.order_by(id_column)
+
+            boundary = edge
+
+    def count(self, estimated: bool = False) -> int:
+        """Count the rows, only approximately if estimated is True
 
-                yield self._query.slice(start, stop)
+        The estimate comes from the table statistics, which is much faster than counting the rows
+        of large tables. It is only possible for unfiltered queries on tables which were analyzed,
+        the rows are counted otherwise.
+        """
+        if self._total_count is None and estimated and not self._filtered:
+            self._total_count = self._estimate_count()
 
-    def count(self) -> int:
         if self._total_count is None:
             self._total_count = self._query.count()
 
         return self._total_count
 
+    def _estimate_count(self) -> Optional[int]:
+        table = self._model.__table__
+        connection = self._dbsession.connection()
+        table_name = connection.dialect.identifier_preparer.format_table(table)
+        reltuples = connection.execute(
+            text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table_name AS regclass)'),
+            table_name=table_name).scalar()
+
+        # This is -1 (or 0 before PostgreSQL 14) for tables which were never analyzed
+        if reltuples is None or reltuples <= 0:
+            return None
+
+        return int(reltuples)
+
+    @property
+    def chunk_size(self) -> int:
+        return self._chunk_size
+
+    def get_id_range(self) -> Tuple[Optional[int], Optional[int]]:
+        """Get the lowest and highest ids of the rows, which are None if there are none"""
+        id_column = self._model.id
+
+        return self._query.with_entities(func.min(id_column), func.max(id_column)).one()
+
+    def with_session(self, dbsession: 'DbSession') -> 'ChunkedQuery':
+        """Get a copy of this query, which runs in another session"""
+        query = copy.copy(self)
+        query._dbsession = dbsession
+        query._query = self._query.with_session(dbsession)
+        query._total_count = None
+
+        return query
+
+    def filter_ids(self, start: int, stop: int) -> 'ChunkedQuery':
+        """Only keep the rows with an id in the [start, stop) range"""
+        return self.filter(self._model.id >= start, self._model.id < stop)
+
     def reverse_chunks(self) -> 'ChunkedQuery':
         self._descending = True
 
@@ -109,6 +221,7 @@ class ChunkedQuery:
     # FIXME: sqlalchemy-stubs doesn't have type hints for this
     def filter(self, *criterion) -> 'ChunkedQuery':  # type: ignore
         self._query = self._query.filter(*criterion)
+        self._filtered = True
 
         return self
 
@@ -117,15 +230,247 @@ class DbSession(SaSession):
     def chunked_query(self, model: Type['Base'], chunk_size: int = 5000) -> ChunkedQuery:
         return ChunkedQuery(self, model, chunk_size)
 
+    def stream(self, query: Query, chunk_size: int = 5000) -> Iterator[Any]:
+        """Iterate over the results of a query without loading them all in memory
+
+        The results are fetched by chunks from a server-side cursor. The query runs in its own
+        transaction on a separate connection, so that this session can be committed while
+        iterating, which would otherwise close the cursor.
+
+        The results are not attached to this session: this is meant for reading, typically
+        column values that are then used to modify rows from this session.
+        """
+        connection = self.get_bind().connect()
+        stream_session = DbSession(bind=connection)
+
+        try:
+            yield from query.with_session(stream_session).yield_per(chunk_size)
+
+        finally:
+            stream_session.close()
+            connection.close()
+
+    def insert_all(self, instances: Iterable['Base']) -> None:
+        """Insert model instances with COPY FROM STDIN, in the current transaction
+
+        Unlike add_all(), this bypasses the unit of work: the instances are not attached to the
+        session, only their many-to-one relationships are taken into account and their primary
+        keys are not fetched back.
+
+        Rows are grouped by table and by the columns they set, so that columns which were not set
+        still get their server default. Python-side defaults are only applied if they are scalars.
+        """
+        rows: Dict[Tuple[Table, Tuple[str, ...]], List[Dict[str, Any]]] = defaultdict(list)
+
+        for instance in instances:
+            row = instance.to_row()
+
+            for column in instance.__table__.columns:
+                if column.name not in row and getattr(column.default, 'is_scalar', False):
+                    row[column.name] = column.default.arg
+
+            rows[(instance.__table__, tuple(sorted(row)))].append(row)
+
+        if not rows:
+            return
+
+        dialect = self.get_bind().dialect
+        preparer = dialect.identifier_preparer
+
+        with self.connection().connection.cursor() as cursor:
+            for (table, column_names), table_rows in rows.items():
+                column_types = {column.name: column.type for column in table.columns}
+                formatters = [
+                    (name, _get_copy_formatter(column_types[name], dialect))
+                    for name in column_names
+                ]
+                data = StringIO()
+
+                for row in table_rows:
+                    values = (format_value(row[name]) for name, format_value in formatters)
+                    data.write('\t'.join(values))
+                    data.write('\n')
+
+                data.seek(0)
+                quoted_columns = ', '.join(preparer.quote(name) for name in column_names)
+                cursor.copy_expert(
+                    f'COPY {preparer.format_table(table)} ({quoted_columns}) FROM STDIN', data)
+
+
+class IdCache:
+    """Get the ids of the rows of a lookup table, inserting the missing rows
+
+    Lookup tables like the ping configurations or the metrics channels have far fewer rows than
+    the tables referencing them, so the ids of the most recent ones are kept around rather than
+    looked up for each record.
+
+    The cache is cleared whenever a transaction is rolled back, since it might have inserted some
+    of the cached rows. Ids must therefore not be looked up inside savepoints, whose rollback
+    doesn't clear the cache.
+    """
+    def __init__(self, model: Type['Base'], maxsize: int, constraint: Optional[str] = None):
+        self._model = model
+        self._constraint = constraint
+        self._ids: LRUCache[Tuple[Any, ...], int] = LRUCache(maxsize)
+
+        _id_caches.add(self)
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+    def get_id(self, dbsession: DbSession, key: Tuple[Any, ...], filters: Dict[str, Any],
+               get_row: Callable[[], Dict[str, Any]]) -> int:
+        """Get the id of the row matching the filters, inserting one if there is none yet
+
+        The row to insert is only built by calling get_row when it is needed.
+        """
+        row_id = self._ids.get(key)
+
+        if row_id is not None:
+            return row_id
+
+        query = dbsession.query(self._model.id).filter_by(**filters)
+        row_id = query.scalar()
+
+        if row_id is None:
+            # Postgresql's 'INSERT … ON CONFLICT …' is not available at the ORM layer, so let's
+            # drop down to the SQL layer. Only inserting when the row doesn't exist avoids writing
+            # anything in the common case, and keeps ids dense since a conflict still uses an id
+            # from the sequence.
+            table = self._model.__table__
+            stmt = insert(table).values(**get_row())
+            stmt = stmt.on_conflict_do_nothing(constraint=self._constraint)
+            stmt = stmt.returning(table.c.id)
+            row_id = dbsession.connection().execute(stmt).scalar()
+
+        if row_id is None:
+            # Another worker inserted the same row in the meantime
+            row_id = query.scalar()
+
+        self._ids.set(key, row_id)
+
+        return row_id
+
+
+# Only weak references, so that this doesn't keep alive the caches which are not used any more
+_id_caches: 'WeakSet[IdCache]' = WeakSet()
+
+
+def _clear_id_caches(dbsession: DbSession, previous_transaction: SessionTransaction) -> None:
+    # Rolling back a savepoint, like handlers do for each duplicate record, keeps what was
+    # inserted before it
+    if previous_transaction.nested:
+        return
+
+    for id_cache in _id_caches:
+        id_cache.clear()
+
+
+listen(DbSession, 'after_soft_rollback', _clear_id_caches)
+
+
+# Characters which must be escaped in the text format of COPY
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _format_array_item(value: Any) -> str:
+    if value is None:
+        return 'NULL'
+
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(_format_array_item(v) for v in value) + '}'
+
+    value = _format_copy_value(value)
+
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _format_copy_value(value: Any) -> str:
+    # This is the text representation of the value, before escaping it for COPY
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    if isinstance(value, (bytes, memoryview)):
+        return '\\x' + bytes(value).hex()
+
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+
+    if isinstance(value, timedelta):
+        return f'{value.total_seconds()} seconds'
+
+    if isinstance(value, (list, tuple)):
+        return _format_array_item(value)
+
+    return str(value)
+
+
+def _get_copy_formatter(column_type: Any, dialect: Dialect) -> Callable[[Any], str]:
+    # Let SQLAlchemy convert the values first, e.g to serialize JSON or for custom types. The
+    # exception is binary columns, which get wrapped for psycopg2 instead.
+    if isinstance(column_type, LargeBinary):
+        process = None
+    else:
+        process = column_type.bind_processor(dialect)
+
+    def format_value(value: Any) -> str:
+        if process is not None:
+            value = process(value)
+
+        if value is None:
+            return '\\N'
+
+        return _format_copy_value(value).translate(_COPY_ESCAPES)
+
+    return format_value
+
+
+def _disable_synchronous_commit(dbsession: DbSession, transaction: SessionTransaction,
+                                connection: Connection) -> None:
+    # Commits return without waiting for the WAL to be written to disk, so the last transactions
+    # could be lost if PostgreSQL crashed, but they can't be corrupted
+    connection.execute('SET LOCAL synchronous_commit = off')
+
 
 class Db:
     def __init__(self, pgconfig: PgConfig) -> None:
         connect_args = copy.deepcopy(pgconfig.connect_args)
         connect_args['password'] = pgconfig.password
+        engine_args: Dict[str, Any] = {
+            # Insert many rows with a single INSERT … VALUES statement, and run other statements
+            # executed many times in batches, rather than making one round trip for each row.
+            # This is what later SQLAlchemy versions call "values_plus_batch".
+            'executemany_mode': 'values',
+            'executemany_values_page_size': pgconfig.executemany_values_page_size,
+            'executemany_batch_page_size': pgconfig.executemany_batch_page_size,
+        }
+
+        if pgconfig.transaction_pooler:
+            # The pooler keeps the connections to the server, and shares them between its clients
+            engine_args['poolclass'] = NullPool
+
+        else:
+            engine_args['pool_size'] = pgconfig.pool_size
+            engine_args['max_overflow'] = pgconfig.max_overflow
+            engine_args['pool_pre_ping'] = pgconfig.pool_pre_ping
+            engine_args['pool_recycle'] = pgconfig.pool_recycle or -1
+
+            if pgconfig.statement_timeout_ms:
+                options = connect_args.get('options', '')
+                connect_args['options'] = (
+                    f'{options} -c statement_timeout={pgconfig.statement_timeout_ms}'.strip())
 
+        self._pgconfig = pgconfig
+
+        # Set this to False for the commits of the next sessions not to wait for the WAL flush
+        self.synchronous_commit = True
         self._url = URL('postgresql+psycopg2', username=pgconfig.user, host=pgconfig.host,
                         port=pgconfig.port, database=pgconfig.database)
-        self._engine = create_engine(self._url, connect_args=connect_args)
+        self._engine = create_engine(self._url, connect_args=connect_args, **engine_args)
+
+        if pgconfig.transaction_pooler and pgconfig.statement_timeout_ms:
+            listen(self._engine, 'begin', self._set_statement_timeout)
+
         self._session_factory = sessionmaker(bind=self._engine, class_=DbSession)
 
         # Try to connect, to fail early if the PostgreSQL server can't be reached.
@@ -142,6 +487,10 @@ class Db:
     def __enter__(self) -> DbSession:
         self._sa_session = self._session_factory()
 
+        if not self.synchronous_commit:
+            # Each transaction of the session, as handlers can commit in the middle of it
+            listen(self._sa_session, 'after_begin', _disable_synchronous_commit)
+
         return self._sa_session
 
     def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
@@ -168,6 +517,20 @@ class Db:
         finally:
             self._sa_session.close()
 
+    def _set_statement_timeout(self, connection: Connection) -> None:
+        # Settings for the whole session would stick to the server connection after the pooler
+        # hands it to another client, and the pooler would refuse them as connection options
+        with connection.connection.cursor() as cursor:
+            cursor.execute(f'SET LOCAL statement_timeout = {self._pgconfig.statement_timeout_ms}')
+
+    def dispose(self) -> None:
+        """Close the connections to the database
+
+        New ones are opened when needed. This must be called before forking, so that the child
+        processes don't share connections with the parent.
+        """
+        self._engine.dispose()
+
     def _ensure_connection(self) -> None:
         with self as dbsession:
             try:
@@ -177,6 +540,107 @@ class Db:
                 # FIXME: Are we sure this is the only error possible?
                 raise PostgresqlConnectionError(f'connection refused on {self._url}')
 
+    def process_chunks(self, query: ChunkedQuery, process_chunk: Callable[[Query], None],
+                       jobs: int = 1) -> Iterator[int]:
+        """Process a chunked query, one chunk at a time, committing after each of them
+
+        The query runs in a new session, and process_chunk is called with each of its chunks.
+
+        With more than one job, the ids of the rows are split in as many disjoint ranges, each of
+        which is processed by a child process with its own connections to the database.
+
+        This yields the number of rows processed so far, after each chunk.
+        """
+        if jobs < 1:
+            raise ValueError(f'Invalid number of jobs: {jobs}')
+
+        if jobs == 1:
+            with self as dbsession:
+                query = query.with_session(dbsession)
+
+                for chunk_number, chunk in enumerate(query, start=1):
+                    process_chunk(chunk)
+                    dbsession.commit()
+
+                    yield chunk_number * query.chunk_size
+
+            return
+
+        with self as dbsession:
+            first, last = query.with_session(dbsession).get_id_range()
+
+        if first is None or last is None:
+            return
+
+        step = -(-(last + 1 - first) // jobs)
+
+        # The children can't use the connections of the parent, close them before forking
+        self.dispose()
+
+        # Neither the query nor the function can be pickled, so the children must be forked
+        context = multiprocessing.get_context('fork')
+        progress_queue = context.Queue()
+        workers = [
+            context.Process(target=self._process_id_range, name=f'[{start}, {start + step})',
+                            args=(query, process_chunk, start, start + step, progress_queue))
+            for start in range(first, last + 1, step)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            num_processed = 0
+            num_finished = 0
+
+            while num_finished < len(workers):
+                try:
+                    num_rows = progress_queue.get(timeout=1)
+
+                except Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        # All workers died without telling us
+                        break
+
+                    continue
+
+                if num_rows is None:
+                    num_finished += 1
+                    continue
+
+                num_processed += num_rows
+
+                yield num_processed
+
+            for worker in workers:
+                worker.join()
+
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+
+        failed = [worker.name for worker in workers if worker.exitcode != 0]
+
+        if failed:
+            raise ChunkProcessingError(
+                f'Failed to process the rows with ids in {", ".join(failed)}')
+
+    def _process_id_range(self, query: ChunkedQuery, process_chunk: Callable[[Query], None],
+                          start: int, stop: int, progress_queue: 'Queue[Optional[int]]') -> None:
+        previous = 0
+
+        try:
+            db = Db(self._pgconfig)
+
+            for num_processed in db.process_chunks(query.filter_ids(start, stop), process_chunk):
+                progress_queue.put(num_processed - previous)
+                previous = num_processed
+
+        finally:
+            progress_queue.put(None)
+
     # These 2 methods create or drop all the tables for registered models.
     #
     # With SQLAlchemy, a model is registered if it inherits from Base, and the model class has been
@@ -247,6 +711,10 @@ class PostgresqlConnectionError(Exception):
     pass
 
 
+class ChunkProcessingError(Exception):
+    pass
+
+
 metadata = MetaData(naming_convention=NAMING_CONVENTION)
 Base = declarative_base(cls=BaseModel, constructor=BaseModel.__init__, metadata=metadata)
 views = {}
@@ -0,0 +1,375 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+"""Expose metrics about the workers to Prometheus
+
+Each worker accumulates its own metrics, and regularly sends what changed to the controller
+through a multiprocessing queue. A process forked by the controller merges them, and serves them
+over HTTP in the Prometheus text format, along with the length of the Redis queues.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from multiprocessing.context import ForkProcess
+from multiprocessing.queues import Queue
+import re
+from signal import SIG_DFL, SIG_IGN, SIGINT, SIGTERM, signal as intercept_signal
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from redis import Redis
+from sqlalchemy.event import listen
+
+from .config import Config
+from .model import DbSession
+from .queues import get_queue_lengths
+from . import timing
+
+
+log = logging.getLogger(__name__)
+
+# How often workers send their metrics to the controller, in seconds
+FLUSH_INTERVAL = 5
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+COUNTERS = {
+    'records_processed': 'Records pulled from the queue and processed, successfully or not',
+    'records_failed': 'Records which failed to be processed and were pushed to the error queue',
+    'records_retried': 'Records which failed to be processed and will be retried later',
+}
+HISTOGRAMS = {
+    'processing_seconds': ('Time spent processing a batch of records, including the commit',
+                           LATENCY_BUCKETS),
+    'db_commit_seconds': ('Time spent committing transactions to PostgreSQL', LATENCY_BUCKETS),
+    'batch_size': ('Number of records pulled from the queue at once', BATCH_SIZE_BUCKETS),
+}
+STAGES_HELP = 'Time spent in each stage of processing records, excluding the nested stages'
+
+# The bucket counts, sum and count of a histogram
+HistogramSnapshot = Tuple[List[int], float, int]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # The last count is for values greater than the last bucket
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, snapshot: HistogramSnapshot) -> None:
+        counts, sum_, count = snapshot
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += sum_
+        self.count += count
+
+    def snapshot(self) -> HistogramSnapshot:
+        return (self.counts, self.sum, self.count)
+
+
+class _Metrics:
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[str, int]] = {name: {} for name in COUNTERS}
+        self.histograms: Dict[str, Dict[str, Histogram]] = {name: {} for name in HISTOGRAMS}
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def _histogram(self, name: str, queue: str) -> Histogram:
+        try:
+            return self.histograms[name][queue]
+
+        except KeyError:
+            histogram = self.histograms[name][queue] = Histogram(HISTOGRAMS[name][1])
+            return histogram
+
+
+class WorkerMetrics(_Metrics):
+    """The metrics of a worker, sent to the controller through the channel
+
+    Without a channel, metrics are disabled and nothing is measured.
+    """
+    def __init__(self, channel: Optional[Queue]) -> None:
+        super().__init__()
+
+        self._channel = channel
+        self._queue: Optional[str] = None
+        self._commit_start: Optional[float] = None
+        self._next_flush = time.monotonic() + FLUSH_INTERVAL
+
+    @property
+    def enabled(self) -> bool:
+        return self._channel is not None
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+
+        listen(DbSession, 'before_commit', self._before_commit)
+        listen(DbSession, 'after_commit', self._after_commit)
+        timing.enable()
+
+    def _before_commit(self, dbsession: DbSession) -> None:
+        # Releasing a savepoint is not a commit
+        if not dbsession.transaction.nested:
+            self._commit_start = time.perf_counter()
+
+    def _after_commit(self, dbsession: DbSession) -> None:
+        if self._commit_start is None:
+            return
+
+        if self._queue is not None:
+            self._histogram('db_commit_seconds', self._queue).observe(
+                time.perf_counter() - self._commit_start)
+
+        self._commit_start = None
+
+    @contextmanager
+    def processing(self, queue: str, num_records: int) -> Iterator[None]:
+        if not self.enabled or not num_records:
+            yield
+            return
+
+        self._queue = queue
+        timing.start_queue(queue)
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self._histogram('processing_seconds', queue).observe(time.perf_counter() - start)
+            self._histogram('batch_size', queue).observe(num_records)
+            self.count('records_processed', queue, num_records)
+            timing.stop_queue()
+            self._queue = None
+
+    def count(self, name: str, queue: str, value: int = 1) -> None:
+        if self.enabled:
+            counter = self.counters[name]
+            counter[queue] = counter.get(queue, 0) + value
+
+    def flush(self, force: bool = False) -> None:
+        if self._channel is None:
+            return
+
+        now = time.monotonic()
+
+        if not force and now < self._next_flush:
+            return
+
+        self._next_flush = now + FLUSH_INTERVAL
+        snapshot = {
+            'counters': self.counters,
+            'histograms': {
+                name: {queue: h.snapshot() for queue, h in histograms.items()}
+                for name, histograms in self.histograms.items()
+            },
+            'stages': timing.pop_totals(),
+        }
+
+        # Only send what changed since the last time
+        self._channel.put(snapshot)
+        self.counters = {name: {} for name in COUNTERS}
+        self.histograms = {name: {} for name in HISTOGRAMS}
+
+
+_SAMPLE_RE = re.compile(r'^(?P<name>\w+)\{(?P<labels>.*)\} (?P<value>\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+_UNESCAPE_RE = re.compile(r'\\(.)')
+
+
+def get_stage_timings(text: str) -> Dict[str, Dict[str, Any]]:
+    """Get the breakdown of the processing time for each queue from the served metrics"""
+    timings: Dict[str, Dict[str, Any]] = {}
+
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+
+        if match is None:
+            continue
+
+        labels = {
+            key: _UNESCAPE_RE.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+            for key, value in _LABEL_RE.findall(match.group('labels'))
+        }
+        name, value = match.group('name'), float(match.group('value'))
+
+        if 'queue' not in labels:  # pragma: no cover (all our metrics have a queue)
+            continue
+
+        queue = timings.setdefault(labels['queue'], {'records': 0, 'seconds': 0.0, 'stages': {}})
+
+        if name == 'azafea_records_processed_total':
+            queue['records'] = int(value)
+
+        elif name == 'azafea_processing_seconds_sum':
+            queue['seconds'] = value
+
+        elif name == 'azafea_stage_seconds_total':
+            queue['stages'][labels['stage']] = value
+
+    return {queue: t for queue, t in timings.items() if t['records']}
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    formatted = []
+
+    for key, value in labels.items():
+        value = value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        formatted.append(f'{key}="{value}"')
+
+    return '{' + ','.join(formatted) + '}'
+
+
+class MetricsRegistry(_Metrics):
+    """The metrics of all the workers, merged together"""
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._lock = threading.Lock()
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        with self._lock:
+            for name, values in snapshot['counters'].items():
+                counter = self.counters[name]
+
+                for queue, value in values.items():
+                    counter[queue] = counter.get(queue, 0) + value
+
+            for name, histograms in snapshot['histograms'].items():
+                for queue, histogram in histograms.items():
+                    self._histogram(name, queue).merge(histogram)
+
+            for queue, stages in snapshot.get('stages', {}).items():
+                totals = self.stages.setdefault(queue, {})
+
+                for stage, seconds in stages.items():
+                    totals[stage] = totals.get(stage, 0.0) + seconds
+
+    def render(self, queue_lengths: Dict[str, int]) -> str:
+        lines = [
+            '# HELP azafea_queue_length Records waiting in the queue',
+            '# TYPE azafea_queue_length gauge',
+        ]
+        lines.extend(f'azafea_queue_length{_format_labels({"queue": queue})} {length}'
+                     for queue, length in sorted(queue_lengths.items()))
+
+        with self._lock:
+            for name, help_text in COUNTERS.items():
+                lines.append(f'# HELP azafea_{name}_total {help_text}')
+                lines.append(f'# TYPE azafea_{name}_total counter')
+
+                for queue, value in sorted(self.counters[name].items()):
+                    lines.append(f'azafea_{name}_total{_format_labels({"queue": queue})} {value}')
+
+            for name, (help_text, buckets) in HISTOGRAMS.items():
+                lines.append(f'# HELP azafea_{name} {help_text}')
+                lines.append(f'# TYPE azafea_{name} histogram')
+
+                for queue, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+
+                    for bucket, count in zip([*buckets, '+Inf'], histogram.counts):
+                        cumulative += count
+                        labels = _format_labels({'queue': queue, 'le': str(bucket)})
+                        lines.append(f'azafea_{name}_bucket{labels} {cumulative}')
+
+                    labels = _format_labels({'queue': queue})
+                    lines.append(f'azafea_{name}_sum{labels} {histogram.sum}')
+                    lines.append(f'azafea_{name}_count{labels} {histogram.count}')
+
+            lines.append(f'# HELP azafea_stage_seconds_total {STAGES_HELP}')
+            lines.append('# TYPE azafea_stage_seconds_total counter')
+
+            for queue, stages in sorted(self.stages.items()):
+                for stage, seconds in sorted(stages.items()):
+                    labels = _format_labels({'queue': queue, 'stage': stage})
+                    lines.append(f'azafea_stage_seconds_total{labels} {seconds}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(ForkProcess):
+    """Serve the metrics of the workers over HTTP, in a process of its own
+
+    The controller keeps forking workers, so it must not run any thread itself.
+    """
+    def __init__(self, config: Config, channel: Queue) -> None:
+        super().__init__(name='metrics-server', daemon=True)
+
+        self.config = config
+        self.registry = MetricsRegistry()
+
+        self._channel = channel
+        self._redis = Redis(
+            host=config.redis.host,
+            port=config.redis.port,
+            password=config.redis.password,
+            ssl=config.redis.ssl,
+        )
+
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = server.registry.render(server.get_queue_lengths()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                log.debug('Metrics request from %s: ' + format, self.address_string(), *args)
+
+        self._http_server = ThreadingHTTPServer(('', config.main.metrics_port), RequestHandler)
+        self._http_server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self._http_server.server_address[1]
+
+    def get_queue_lengths(self) -> Dict[str, int]:
+        return get_queue_lengths(self._redis, self.config.queues)
+
+    def _receive(self) -> None:
+        while True:
+            self.registry.merge(self._channel.get())
+
+    def start(self) -> None:
+        super().start()
+
+        # Only the server process accepts the connections
+        self._http_server.server_close()
+        log.info('Serving the metrics on port %d', self.port)
+
+    def stop(self) -> None:
+        self.terminate()
+        self.join()
+
+    def run(self) -> None:
+        # The signal handlers of the controller were inherited, but it stops this process itself
+        intercept_signal(SIGINT, SIG_IGN)
+        intercept_signal(SIGTERM, SIG_DFL)
+
+        threading.Thread(target=self._receive, name='metrics-receiver', daemon=True).start()
+        self._http_server.serve_forever()
@@ -8,35 +8,135 @@
 
 
 import logging
-from multiprocessing import Process
-from signal import SIGINT, SIGTERM, Signals, signal as intercept_signal
-from typing import Any
+from multiprocessing import Value
+from multiprocessing.context import ForkProcess
+from multiprocessing.queues import Queue
+import resource
+from signal import SIG_IGN, SIGINT, SIGTERM, SIGUSR1, Signals, signal as intercept_signal
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import psycopg2
 
 from redis import Redis
 
+from sqlalchemy.exc import (
+    DBAPIError, DisconnectionError, OperationalError, TimeoutError as PoolTimeoutError)
+
 from .config import Config
-from .model import Db
+from .model import Db, PostgresqlConnectionError
+from .monitoring import WorkerMetrics
+from .profiling import WorkerProfiler
+from .queues import (
+    CLAIM_RETRIES_SCRIPT, HEARTBEAT_TTL, STREAM_CLAIM_IDLE_TIME, STREAM_DATA_FIELD, STREAM_GROUP,
+    create_stream_group, decode_retry, encode_retry, get_consumer_name, get_heartbeat_key,
+    get_processing_queue, get_queue_schedule, get_retry_queue)
 from .utils import get_fqdn
 
 
 log = logging.getLogger(__name__)
 
+# How long to wait between two attempts at filling a batch, in seconds
+LINGER_POLL_INTERVAL = 0.01
+
+# How long to block on a single queue when polling them in turn, in seconds
+QUEUE_POLL_TIMEOUT = 1
+
+# How often to look for stream entries left pending by dead workers, in seconds
+STREAM_CLAIM_INTERVAL = 60
+
+# Workers exit with this code when they should be replaced by a new one, see Processor._recycle
+RECYCLE_EXIT_CODE = 75
+
+# How often to look for failed records which can be retried, in seconds
+RETRY_POLL_INTERVAL = 1
+
+# The longest to wait before retrying a failed record, in seconds
+RETRY_DELAY_MAX = 300
+
+# How long a worker has to retry the records it claimed, before other workers can claim them, in
+# seconds
+RETRY_CLAIM_TIMEOUT = 60
 
-class Processor(Process):
-    def __init__(self, name: str, config: Config) -> None:
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether processing a record could succeed if retried later
+
+    This is the case when the database could not be reached or the connection to it was lost, or
+    a statement was cancelled because it timed out or deadlocked. Other errors, like invalid
+    records, would fail again.
+    """
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+
+    # The records inserted with COPY go straight through psycopg2
+    return isinstance(error, (
+        OperationalError, DisconnectionError, PoolTimeoutError, PostgresqlConnectionError,
+        psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+# Workers are always forked, so that they share with the controller the memory holding the handler
+# modules and their models
+class Processor(ForkProcess):
+    def __init__(self, name: str, config: Config, metrics_channel: Optional[Queue] = None,
+                 queues: Optional[Sequence[str]] = None) -> None:
         super().__init__(name=name)
 
         self.config = config
+        # The queues this worker pulls from, all of them by default
+        self.queues = tuple(queues or config.queues)
         self._continue = True
+        self._metrics = WorkerMetrics(metrics_channel)
+        self._profiler = WorkerProfiler(name)
+
+        self._consumer = get_consumer_name(name)
+        self._reliable_queues = {
+            queue: get_processing_queue(queue, self._consumer)
+            for queue, queue_config in config.queues.items()
+            if queue in self.queues and queue_config.backend == 'list' and queue_config.reliable
+        }
+        # The ids of the entries pulled from each stream, which must be acknowledged
+        self._stream_ids: Dict[str, List[bytes]] = {
+            queue: [] for queue, queue_config in config.queues.items()
+            if queue in self.queues and queue_config.backend == 'stream'
+        }
+        self._stream_claim_ids = {queue: b'0-0' for queue in self._stream_ids}
+        self._next_stream_claims = {queue: 0.0 for queue in self._stream_ids}
+        self._polling = bool(self._reliable_queues or self._stream_ids)
+        self._schedule = get_queue_schedule({
+            queue: config.queues[queue].weight for queue in self.queues
+        })
+        self._next_slot = 0
+        self._next_heartbeat = 0.0
+        self._next_retry = 0.0
+        # Shared with the controller, which scales the number of workers based on it. Only the
+        # worker writes to it, so it doesn't need a lock.
+        self._num_processed = Value('Q', 0, lock=False)
 
         self._redis = self._get_redis()
         self._db = self._get_postgresql()
+        self._claim_retries = self._redis.register_script(CLAIM_RETRIES_SCRIPT)
+
+        # This runs in the controller, the connection used to check the database can be reached
+        # must not be shared with the worker once it is forked
+        self._db.dispose()
 
     def _exit_cleanly(self, signum: int, _: Any) -> None:
         signal_name = Signals(signum).name
         log.info('{%s} Received %s, finishing the current task…', self.name, signal_name)
         self._continue = False
 
+    @property
+    def num_processed(self) -> int:
+        """The number of records this worker processed so far"""
+        return self._num_processed.value
+
+    def request_profile(self, **request: Any) -> None:
+        """Ask the worker to profile itself, see WorkerProfiler for the parameters"""
+        assert self.pid is not None
+        self._profiler.request(self.pid, **request)
+
     def _get_postgresql(self) -> Db:
         return Db(self.config.postgresql)
 
@@ -55,30 +155,350 @@ class Processor(Process):
 
         return redis
 
+    def _pull(self, queues: Tuple[str, ...]) -> Tuple[Optional[str], List[bytes]]:
+        if self._polling:
+            queue, values = self._poll(queues)
+
+            if queue is None:
+                return None, []
+
+            return queue, values + self._pull_more(queue, len(values))
+
+        if self.config.main.exit_on_empty_queues:
+            for queue in queues:
+                value = self._redis.rpop(queue)
+                if value:
+                    break
+
+        else:
+            result = self._redis.brpop(queues, timeout=5)
+            if result is None:
+                value = None
+            else:
+                queue_bytes, value = result
+                queue = queue_bytes.decode('utf-8')
+
+        if value is None:
+            return None, []
+
+        return queue, [value] + self._pull_more(queue, 1)
+
+    def _get_queues_in_turn(self) -> Tuple[str, ...]:
+        # Redis pulls from the first non-empty queue, so start from the next one in the schedule
+        # each time, so that none of them gets starved and each gets its share when they are all
+        # busy
+        first = self.queues.index(self._schedule[self._next_slot])
+        self._next_slot = (self._next_slot + 1) % len(self._schedule)
+
+        return self.queues[first:] + self.queues[:first]
+
+    def _poll(self, queues: Tuple[str, ...]) -> Tuple[Optional[str], List[bytes]]:
+        # BRPOPLPUSH and XREADGROUP can't block on all kinds of queues at once, so try them all in
+        # turn
+        for queue in queues:
+            if queue in self._stream_ids:
+                batch_size = self.config.queues[queue].batch_size
+                values = self._claim_stream(queue, batch_size) or self._read_stream(queue,
+                                                                                    batch_size)
+
+            elif queue in self._reliable_queues:
+                value = self._redis.rpoplpush(queue, self._reliable_queues[queue])
+                values = [] if value is None else [value]
+
+            else:
+                value = self._redis.rpop(queue)
+                values = [] if value is None else [value]
+
+            # Stream entries without data were still pulled, and must be acknowledged
+            if values or self._stream_ids.get(queue):
+                return queue, values
+
+        if self.config.main.exit_on_empty_queues:
+            return None, []
+
+        # All queues are empty, wait a bit on one of them before trying them all again
+        queue = queues[0]
+
+        if queue in self._stream_ids:
+            values = self._read_stream(queue, self.config.queues[queue].batch_size,
+                                       block=QUEUE_POLL_TIMEOUT * 1000)
+
+            if not values and not self._stream_ids[queue]:
+                return None, []
+
+            return queue, values
+
+        if queue in self._reliable_queues:
+            value = self._redis.brpoplpush(queue, self._reliable_queues[queue],
+                                           timeout=QUEUE_POLL_TIMEOUT)
+        else:
+            result = self._redis.brpop([queue], timeout=QUEUE_POLL_TIMEOUT)
+            value = None if result is None else result[1]
+
+        if value is None:
+            return None, []
+
+        return queue, [value]
+
+    def _pull_more(self, queue: str, num_pulled: int) -> List[bytes]:
+        # We already pulled some records, see whether we can fill a batch
+        queue_config = self.config.queues[queue]
+        missing = queue_config.batch_size - num_pulled
+
+        if missing <= 0:
+            return []
+
+        deadline = time.monotonic() + queue_config.batch_linger_ms / 1000
+        values = self._drain(queue, missing)
+
+        while len(values) < missing and self._continue:
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                break
+
+            time.sleep(min(remaining, LINGER_POLL_INTERVAL))
+            values += self._drain(queue, missing - len(values))
+
+        return values
+
+    def _drain(self, queue: str, count: int) -> List[bytes]:
+        if queue in self._stream_ids:
+            return self._read_stream(queue, count)
+
+        if queue in self._reliable_queues:
+            # Each RPOPLPUSH is atomic, so they don't need to be in a transaction
+            with self._redis.pipeline(transaction=False) as pipeline:
+                for _ in range(count):
+                    pipeline.rpoplpush(queue, self._reliable_queues[queue])
+
+                return [value for value in pipeline.execute() if value is not None]
+
+        # Pull up to count records in a single round trip. This does the same as RPOP with a count,
+        # which only exists with Redis >= 6.2.
+        #
+        # The pipeline is wrapped in a MULTI/EXEC transaction so no other worker can pull the same
+        # records between the LRANGE and the LTRIM.
+        with self._redis.pipeline() as pipeline:
+            pipeline.lrange(queue, -count, -1)
+            pipeline.ltrim(queue, 0, -count - 1)
+            values, _ = pipeline.execute()
+
+        # LRANGE returns the records from head to tail, while RPOP pulls from the tail
+        return values[::-1]
+
+    def _read_stream(self, queue: str, count: int, block: Optional[int] = None) -> List[bytes]:
+        result = self._redis.xreadgroup(STREAM_GROUP, self._consumer, {queue: '>'}, count=count,
+                                        block=block)
+
+        if not result:
+            return []
+
+        _, entries = result[0]
+
+        return self._get_stream_values(queue, entries)
+
+    def _claim_stream(self, queue: str, count: int) -> List[bytes]:
+        # Take over the entries which were delivered to dead workers but never acknowledged
+        now = time.monotonic()
+
+        if now < self._next_stream_claims[queue]:
+            return []
+
+        next_id, entries = self._redis.xautoclaim(
+            queue, STREAM_GROUP, self._consumer, STREAM_CLAIM_IDLE_TIME,
+            start_id=self._stream_claim_ids[queue], count=count)[:2]
+
+        if entries:
+            log.warning('{%s} Claimed %d pending entries from the %s stream',
+                        self.name, len(entries), queue)
+
+        # Continue scanning the pending entries next time, unless we reached the end of them
+        self._stream_claim_ids[queue] = next_id
+
+        if next_id == b'0-0':
+            self._next_stream_claims[queue] = now + STREAM_CLAIM_INTERVAL
+
+        return self._get_stream_values(queue, entries)
+
+    def _get_stream_values(self, queue: str, entries: List[Tuple[bytes, Any]]) -> List[bytes]:
+        values = []
+
+        for entry_id, fields in entries:
+            # Acknowledge even the invalid entries, otherwise they would stay pending forever
+            self._stream_ids[queue].append(entry_id)
+
+            try:
+                values.append(fields[STREAM_DATA_FIELD])
+
+            except (KeyError, TypeError):
+                log.error('{%s} Ignoring entry %s of the %s stream, which has no %s field',
+                          self.name, entry_id, queue, STREAM_DATA_FIELD.decode('utf-8'))
+
+        return values
+
+    def _process(self, queue: str, values: List[bytes]) -> None:
+        self._db.synchronous_commit = self.config.queues[queue].synchronous_commit
+
+        if len(values) > 1:
+            queue_config = self.config.queues[queue]
+            queue_processor = queue_config.batch_processor or queue_config.processor
+            log.debug('{%s} Processing a batch of %d events from the %s queue with %s',
+                      self.name, len(values), queue, get_fqdn(queue_processor))
+
+            try:
+                with self._db as dbsession:
+                    if queue_config.batch_processor is not None:
+                        queue_config.batch_processor(dbsession, values)
+
+                    else:
+                        for value in values:
+                            queue_config.processor(dbsession, value)
+
+                return
+
+            except Exception:
+                log.exception('{%s} An error occured while processing a batch of %d events from '
+                              'the %s queue with %s, processing them one by one\nDetails:',
+                              self.name, len(values), queue, get_fqdn(queue_processor))
+
+        for value in values:
+            self._process_one(queue, value)
+
+    def _process_one(self, queue: str, value: bytes, attempts: int = 1) -> None:
+        queue_config = self.config.queues[queue]
+        queue_processor = queue_config.processor
+        # Retried records don't go through _process()
+        self._db.synchronous_commit = queue_config.synchronous_commit
+        log.debug('{%s} Processing event from the %s queue with %s',
+                  self.name, queue, get_fqdn(queue_processor))
+
+        try:
+            with self._db as dbsession:
+                queue_processor(dbsession, value)
+
+        except Exception as e:
+            log.exception('{%s} An error occured while processing an event from the %s queue '
+                          'with %s\nDetails:',
+                          self.name, queue, get_fqdn(queue_processor))
+
+            if is_transient_error(e) and attempts < queue_config.max_attempts:
+                delay = min(queue_config.retry_delay_ms / 1000 * 2 ** (attempts - 1),
+                            RETRY_DELAY_MAX)
+                log.warning('{%s} Retrying the event from the %s queue in %.1f seconds, after '
+                            '%d failed attempt%s', self.name, queue, delay, attempts,
+                            's' if attempts > 1 else '')
+                self._redis.zadd(get_retry_queue(queue),
+                                 {encode_retry(value, attempts): time.time() + delay})
+                self._metrics.count('records_retried', queue)
+                return
+
+            self._redis.lpush(f'errors-{queue}', value)
+            self._metrics.count('records_failed', queue)
+
+    def _retry(self) -> None:
+        now = time.time()
+
+        if now < self._next_retry:
+            return
+
+        self._next_retry = now + RETRY_POLL_INTERVAL
+
+        for queue in self.queues:
+            retry_queue = get_retry_queue(queue)
+            members = self._claim_retries(keys=[retry_queue], args=[
+                now, now + RETRY_CLAIM_TIMEOUT, self.config.queues[queue].batch_size])
+
+            if not members:
+                continue
+
+            # Not measured as processing, the records were already counted when they were first
+            # pulled from the queue
+            for member in members:
+                attempts, value = decode_retry(member)
+                log.info('{%s} Retrying an event from the %s queue, attempt %d',
+                         self.name, queue, attempts + 1)
+                self._process_one(queue, value, attempts + 1)
+
+                # The record was either committed, scheduled for another retry or pushed to the
+                # error queue, it can be forgotten
+                self._redis.zrem(retry_queue, member)
+
+    def _ack(self, queue: str) -> None:
+        # The records were either committed or pushed to the error queue, they can be forgotten
+        if queue in self._stream_ids:
+            with self._redis.pipeline() as pipeline:
+                pipeline.xack(queue, STREAM_GROUP, *self._stream_ids[queue])
+                # Streams keep their entries even once all consumer groups acknowledged them
+                pipeline.xdel(queue, *self._stream_ids[queue])
+                pipeline.execute()
+
+            self._stream_ids[queue] = []
+
+        elif queue in self._reliable_queues:
+            self._redis.delete(self._reliable_queues[queue])
+
+    def _send_heartbeat(self) -> None:
+        now = time.monotonic()
+
+        if not self._reliable_queues or now < self._next_heartbeat:
+            return
+
+        self._redis.set(get_heartbeat_key(self._consumer), self.name, ex=HEARTBEAT_TTL)
+        self._next_heartbeat = now + HEARTBEAT_TTL / 3
+
+    def _should_recycle(self) -> bool:
+        # Memory grows over time in long running workers, e.g in GLib or SQLAlchemy caches
+        max_records = self.config.main.worker_max_records
+        max_memory_mb = self.config.main.worker_max_memory_mb
+
+        if max_records and self.num_processed >= max_records:
+            log.info('{%s} Processed %d records, exiting to be replaced',
+                     self.name, self.num_processed)
+            return True
+
+        if max_memory_mb:
+            # This is the peak resident set size, in kilobytes on Linux
+            memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+            if memory_mb >= max_memory_mb:
+                log.info('{%s} Using %d MB of memory, exiting to be replaced',
+                         self.name, memory_mb)
+                return True
+
+        return False
+
+    def start(self) -> None:
+        # The worker would be killed if it was asked to profile itself before handling SIGUSR1,
+        # have it ignore the signal until then; the controller has no use for it either
+        intercept_signal(SIGUSR1, SIG_IGN)
+        super().start()
+
     def run(self) -> None:
+        intercept_signal(SIGUSR1, self._profiler.handle_signal)
+        self._profiler.check_requests()
+
         log.info('{%s} Starting', self.name)
 
         intercept_signal(SIGINT, self._exit_cleanly)
         intercept_signal(SIGTERM, self._exit_cleanly)
+        recycle = False
+
+        log.debug('{%s} Pulling from event queues: %s', self.name, self.queues)
+
+        for queue in self._stream_ids:
+            create_stream_group(self._redis, queue)
 
-        queues = tuple(self.config.queues.keys())
-        log.debug('{%s} Pulling from event queues: %s', self.name, queues)
+        self._metrics.start()
 
         while self._continue:
-            if self.config.main.exit_on_empty_queues:
-                for queue in queues:
-                    value = self._redis.rpop(queue)
-                    if value:
-                        break
-            else:
-                result = self._redis.brpop(queues, timeout=5)
-                if result is None:
-                    value = None
-                else:
-                    queue_bytes, value = result
-                    queue = queue_bytes.decode('utf-8')
-
-            if value is None:
+            self._send_heartbeat()
+            self._retry()
+            self._metrics.flush()
+            self._profiler.update()
+            queue, values = self._pull(self._get_queues_in_turn())
+
+            if queue is None:
                 if self.config.main.exit_on_empty_queues:
                     log.info('{%s} Event queues are empty, exiting', self.name)
                     break
@@ -86,18 +506,23 @@ class Processor(Process):
                 log.debug('{%s} Pulled nothing from the queues and timed out', self.name)
                 continue
 
-            log.debug('{%s} Pulled %s from the %s queue', self.name, value, queue)
+            for value in values:
+                log.debug('{%s} Pulled %s from the %s queue', self.name, value, queue)
 
-            queue_processor = self.config.queues[queue].processor
-            log.debug('{%s} Processing event from the %s queue with %s',
-                      self.name, queue, get_fqdn(queue_processor))
+            with self._metrics.processing(queue, len(values)):
+                self._process(queue, values)
+                self._ack(queue)
 
-            try:
-                with self._db as dbsession:
-                    queue_processor(dbsession, value)
+            self._profiler.update(len(values))
+            self._num_processed.value += len(values)
 
-            except Exception:
-                log.exception('{%s} An error occured while processing an event from the %s queue '
-                              'with %s\nDetails:',
-                              self.name, queue, get_fqdn(queue_processor))
-                self._redis.lpush(f'errors-{queue}', value)
+            if self._should_recycle():
+                recycle = True
+                break
+
+        self._metrics.flush(force=True)
+        self._profiler.stop()
+
+        if recycle:
+            # Let the controller know it should start a new worker
+            sys.exit(RECYCLE_EXIT_CODE)
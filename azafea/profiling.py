@@ -0,0 +1,123 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+"""Profile live workers on demand
+
+Sending SIGUSR1 to a worker makes it profile the next records it processes, then write the
+statistics to a file which can be loaded with the pstats module, or visualized with tools like
+snakeviz.
+"""
+
+from cProfile import Profile
+from datetime import datetime
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_RECORDS = 1000
+DEFAULT_PROFILE_SECONDS = 60
+
+
+def get_default_profile_request() -> Dict[str, Any]:
+    return {
+        'records': DEFAULT_PROFILE_RECORDS,
+        'seconds': DEFAULT_PROFILE_SECONDS,
+        'directory': tempfile.gettempdir(),
+    }
+
+
+class WorkerProfiler:
+    """Profile a worker for a number of records or seconds, whichever comes first
+
+    This is created before the worker is started, so the controller can pass the profiling
+    parameters to the worker through the requests queue.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+        self._requests = multiprocessing.SimpleQueue()
+        self._requested = False
+
+        self._profile: Optional[Profile] = None
+        self._request: Dict[str, Any] = {}
+        self._num_records = 0
+        self._deadline = 0.0
+
+    def request(self, pid: int, **request: Any) -> None:
+        """Ask the worker running in the pid process to profile itself"""
+        self._requests.put(request)
+        os.kill(pid, signal.SIGUSR1)
+
+    def handle_signal(self, signum: int, _: Any) -> None:
+        # Only take note of the request, so as to not start profiling in the middle of a record
+        self._requested = True
+
+    def check_requests(self) -> None:
+        """Take note of the requests sent while the worker was ignoring SIGUSR1"""
+        if not self._requests.empty():
+            self._requested = True
+
+    def _start(self) -> None:
+        self._requested = False
+        request = get_default_profile_request()
+
+        # The worker might also have been sent SIGUSR1 directly, without any parameters
+        while not self._requests.empty():
+            request.update(self._requests.get())
+
+        if self._profile is not None:
+            log.warning('{%s} Already profiling, ignoring the new request', self.name)
+            return
+
+        self._request = request
+        log.info('{%s} Profiling the next %d records, for at most %d seconds', self.name,
+                 self._request['records'], self._request['seconds'])
+        self._num_records = 0
+        self._deadline = time.monotonic() + self._request['seconds']
+        self._profile = Profile()
+        self._profile.enable()
+
+    def stop(self) -> None:
+        if self._profile is None:
+            return
+
+        self._profile.disable()
+
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self._request['directory'], f'azafea-{self.name}-{timestamp}.pstats')
+
+        try:
+            self._profile.dump_stats(path)
+            log.info('{%s} Wrote the profile of %d records to %s',
+                     self.name, self._num_records, path)
+
+        except OSError as e:
+            log.error('{%s} Could not write the profile to %s: %s', self.name, path, e)
+
+        self._profile = None
+
+    def update(self, num_records: int = 0) -> None:
+        """Start or stop profiling as needed, after having processed num_records records"""
+        if self._requested:
+            self._start()
+
+        if self._profile is None:
+            return
+
+        self._num_records += num_records
+
+        if self._num_records >= self._request['records'] or time.monotonic() >= self._deadline:
+            self.stop()
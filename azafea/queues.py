@@ -0,0 +1,212 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import logging
+import re
+import socket
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from uuid import uuid4
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+
+log = logging.getLogger(__name__)
+
+# How long a worker is considered alive after its last heartbeat, in seconds
+HEARTBEAT_TTL = 30
+
+# All workers of all hosts share the same consumer group when pulling from streams
+STREAM_GROUP = 'azafea'
+
+# The field of stream entries holding the record
+STREAM_DATA_FIELD = b'data'
+
+# How long an entry must have been pending before another worker can claim it, in milliseconds
+STREAM_CLAIM_IDLE_TIME = 60000
+
+
+# Workers of reliable queues move the records they are processing to their own processing list,
+# and only remove them once they are done. If a worker dies in the meantime, the records are still
+# in its processing list, from which they can be requeued.
+#
+# The consumer name must be unique among all the workers of all the hosts pulling from the same
+# Redis server. Hostnames can't contain "@", which makes it a safe separator.
+def get_consumer_name(worker_name: str) -> str:
+    return f'{socket.gethostname()}.{worker_name}'
+
+
+def get_processing_queue(queue: str, consumer: str) -> str:
+    return f'processing-{queue}@{consumer}'
+
+
+def get_heartbeat_key(consumer: str) -> str:
+    return f'heartbeat@{consumer}'
+
+
+# Records which failed with a transient error wait in this sorted set until they can be retried,
+# scored by the time at which they can be
+def get_retry_queue(queue: str) -> str:
+    return f'retries-{queue}'
+
+
+def encode_retry(value: bytes, attempts: int) -> bytes:
+    # Members of a sorted set are unique, the random token keeps apart identical records
+    return f'{attempts}:{uuid4().hex}:'.encode('utf-8') + value
+
+
+def decode_retry(member: bytes) -> Tuple[int, bytes]:
+    """Get the number of times a record was attempted, and the record itself"""
+    attempts, _, value = member.split(b':', 2)
+
+    return int(attempts), value
+
+
+# Workers claim the records which are due by postponing them rather than removing them from the
+# sorted set, atomically so that no two workers claim the same ones. They only remove them once
+# they are done: if a worker dies in the meantime, the records are due again after a while.
+#
+# KEYS[1] is the sorted set, ARGV the current time, the time until which to postpone the records
+# and how many to claim at most.
+CLAIM_RETRIES_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[2], member)
+end
+
+return members
+"""
+
+
+# The profile-worker command leaves its requests there, for the controller running on that host
+def get_profile_request_key(hostname: str) -> str:
+    return f'profile-request@{hostname}'
+
+
+def get_queue_schedule(weights: Mapping[str, int]) -> List[str]:
+    """Get the order in which workers should favour the queues, according to their weights
+
+    This is a smooth weighted round-robin, so the queues are interleaved as evenly as possible,
+    e.g {'a': 2, 'b': 1} gives ['a', 'b', 'a'].
+    """
+    schedule = []
+    current = dict.fromkeys(weights, 0)
+    total = sum(weights.values())
+
+    for _ in range(total):
+        for queue, weight in weights.items():
+            current[queue] += weight
+
+        chosen = max(current, key=lambda queue: current[queue])
+        current[chosen] -= total
+        schedule.append(chosen)
+
+    return schedule
+
+
+def requeue_worker_records(redis: Redis, queue: str, consumer: str) -> int:
+    """Move the records a dead worker was processing back to the queue"""
+    processing_queue = get_processing_queue(queue, consumer)
+    num_requeued = 0
+
+    while redis.rpoplpush(processing_queue, queue) is not None:
+        num_requeued += 1
+
+    log.debug('Requeued the records of %s in the %s queue', consumer, queue)
+
+    return num_requeued
+
+
+def requeue_orphaned_records(redis: Redis, queue: str) -> int:
+    """Move the records of dead workers back to the queue
+
+    A worker is dead when it stopped sending heartbeats, or when it was running on this host: this
+    is meant to be called before starting the workers, so none of them can be alive.
+    """
+    prefix = get_processing_queue(queue, '')
+    local_prefix = get_consumer_name('')
+    num_requeued = 0
+
+    # Escape the glob-style special characters which could be in the queue name
+    for key in redis.scan_iter(match=re.sub(r'([\\*?\[\]])', r'\\\1', prefix) + '*'):
+        processing_queue = key.decode('utf-8')
+        consumer = processing_queue[len(prefix):]
+
+        if '@' in consumer:
+            # This belongs to another queue with a name starting like this one
+            continue
+
+        if not consumer.startswith(local_prefix) and redis.exists(get_heartbeat_key(consumer)):
+            # The worker is still alive on another host
+            continue
+
+        num_requeued += requeue_worker_records(redis, queue, consumer)
+
+    return num_requeued
+
+
+def create_stream_group(redis: Redis, queue: str) -> None:
+    try:
+        # Start from the beginning of the stream, so nothing is lost the first time
+        redis.xgroup_create(queue, STREAM_GROUP, id='0', mkstream=True)
+
+    except ResponseError as e:
+        if not str(e).startswith('BUSYGROUP'):
+            raise
+
+
+def get_stream_status(redis: Redis, queue: str) -> Optional[Dict[str, Any]]:
+    """Get the status of the Azafea consumer group on a stream
+
+    The lag is only known with Redis >= 7.0, it is None otherwise.
+    """
+    for group in redis.xinfo_groups(queue):
+        if group['name'] != STREAM_GROUP.encode('utf-8'):
+            continue
+
+        consumers: List[Dict[str, Any]] = redis.xinfo_consumers(queue, STREAM_GROUP)
+
+        return {
+            'lag': group.get('lag'),
+            'pending': group['pending'],
+            'consumers': {
+                c['name'].decode('utf-8'): {'pending': c['pending'], 'idle': c['idle']}
+                for c in consumers
+            },
+        }
+
+    return None
+
+
+def get_queue_lengths(redis: Redis, queues: Mapping[str, Any]) -> Dict[str, int]:
+    """Get the number of records waiting in each configured queue
+
+    Streams are only included with Redis >= 7.0, which reports their lag.
+    """
+    lengths = {}
+
+    for queue, queue_config in queues.items():
+        try:
+            if queue_config.backend == 'list':
+                lengths[queue] = redis.llen(queue)
+                continue
+
+            status = get_stream_status(redis, queue)
+
+        except Exception as e:
+            # The stream might not exist yet, or Redis might be unreachable; either way the other
+            # queues might still be fine
+            log.warning('Could not get the length of the %s queue: %s', queue, e)
+            continue
+
+        if status is not None and status['lag'] is not None:
+            lengths[queue] = status['lag']
+
+    return lengths
@@ -107,3 +107,120 @@ class TestQuery(IntegrationTest):
                     counted += 1
 
         assert counted == 20
+
+    def test_chunked_query_delete_while_iterating(self):
+        Event = import_module(self.handler_module).Event
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Event)
+
+        # Insert events
+        with self.db as dbsession:
+            for i in range(1, 61):
+                dbsession.add(Event(name=f'name-{i}'))
+
+        CHUNK_SIZE = 7
+
+        # Delete every event as we go, which must not make us skip any of them
+        with self.db as dbsession:
+            query = dbsession.chunked_query(Event, chunk_size=CHUNK_SIZE)
+            seen = []
+
+            for chunk in query:
+                for event in chunk:
+                    seen.append(event.name)
+                    dbsession.delete(event)
+
+                dbsession.commit()
+
+        assert seen == [f'name-{i}' for i in range(1, 61)]
+
+        with self.db as dbsession:
+            assert dbsession.query(Event).count() == 0
+
+    def test_chunked_query_estimated_count(self):
+        Event = import_module(self.handler_module).Event
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Event)
+
+        # Insert events
+        with self.db as dbsession:
+            for i in range(1, 61):
+                dbsession.add(Event(name=f'name-{i % 3}'))
+
+        # The table was never analyzed, so the rows get counted
+        with self.db as dbsession:
+            assert dbsession.chunked_query(Event, chunk_size=7).count(estimated=True) == 60
+
+        with self.db as dbsession:
+            dbsession.execute(f'ANALYZE {Event.__tablename__}')
+
+        with self.db as dbsession:
+            assert dbsession.chunked_query(Event, chunk_size=7).count(estimated=True) == 60
+
+            # Filtered queries can't be estimated from the table statistics
+            query = dbsession.chunked_query(Event, chunk_size=7)
+            query = query.filter(Event.name == 'name-0')
+            assert query.count(estimated=True) == 20
+
+    def test_stream(self):
+        Event = import_module(self.handler_module).Event
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Event)
+
+        # Insert events
+        with self.db as dbsession:
+            for i in range(1, 61):
+                dbsession.add(Event(name=f'name-{i}'))
+
+        # Committing the session while iterating must not close the server-side cursor
+        with self.db as dbsession:
+            query = dbsession.query(Event.id, Event.name).order_by(Event.id)
+            seen = []
+
+            for i, (event_id, name) in enumerate(dbsession.stream(query, chunk_size=7), start=1):
+                seen.append(name)
+                dbsession.query(Event).filter_by(id=event_id).update({'name': f'renamed-{i}'})
+
+                if (i % 7) == 0:
+                    dbsession.commit()
+
+        assert seen == [f'name-{i}' for i in range(1, 61)]
+
+        with self.db as dbsession:
+            assert dbsession.query(Event).filter(Event.name.startswith('renamed-')).count() == 60
+
+    def test_process_chunks_in_parallel(self):
+        Event = import_module(self.handler_module).Event
+
+        # Create the table
+        self.run_subcommand('initdb')
+        self.ensure_tables(Event)
+
+        # Insert events
+        with self.db as dbsession:
+            for i in range(1, 61):
+                dbsession.add(Event(name=f'name-{i % 3}'))
+
+        def rename(chunk):
+            for event in chunk:
+                event.name = event.name.replace('name-', 'renamed-')
+
+        with self.db as dbsession:
+            query = dbsession.chunked_query(Event, chunk_size=7)
+            query = query.filter(Event.name != 'name-0')
+
+        progress = list(self.db.process_chunks(query, rename, jobs=3))
+
+        # Each job reports its chunks as it processes them
+        assert progress == sorted(progress)
+        assert progress[-1] >= 40
+
+        with self.db as dbsession:
+            assert dbsession.query(Event).filter(Event.name == 'name-0').count() == 20
+            assert dbsession.query(Event).filter(Event.name.startswith('renamed-')).count() == 40
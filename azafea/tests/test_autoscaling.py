@@ -0,0 +1,54 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import azafea.autoscaling
+
+
+def test_autoscaler(make_config):
+    config = make_config({'main': {
+        'number_of_workers': 8,
+        'autoscale_min_workers': 1,
+        'autoscale_drain_seconds': 10,
+        'autoscale_cooldown_seconds': 30,
+    }})
+    autoscaler = azafea.autoscaling.Autoscaler(config)
+
+    # Nothing to compare with yet
+    assert autoscaler.update(0, 0, 0, 1) == 1
+
+    # The backlog grows, but the throughput of the workers is not known yet
+    assert autoscaler.update(10, 100, 0, 1) == 2
+    assert autoscaler.worker_throughput is None
+
+    # The 2 busy workers processed 5 records per second each, while 10 records per second arrived
+    # and the backlog is still 100 records. It takes 2 workers to keep up, and 2 more to drain the
+    # backlog in 10 seconds.
+    assert autoscaler.update(20, 100, 100, 2) == 4
+    assert autoscaler.worker_throughput == 5
+
+    # Never more than the maximum
+    assert autoscaler.update(30, 10000, 200, 4) == 8
+
+    # The backlog is drained
+    assert autoscaler.update(40, 0, 10400, 8) == 8
+
+    # Only 2 workers are needed to keep up, but not for long enough yet
+    assert autoscaler.update(50, 0, 100, 8) == 8
+    assert autoscaler.update(60, 0, 200, 8) == 8
+    assert autoscaler.update(70, 0, 100, 8) == 8
+
+    # More workers were needed in the meantime, and that is what the cooldown retains
+    assert autoscaler.update(80, 0, 100, 8) == 4
+
+    # Nothing arrives any more
+    assert autoscaler.update(90, 0, 0, 4) == 4
+    assert autoscaler.update(120, 0, 0, 4) == 1
+
+    # Records arrive again
+    assert autoscaler.update(130, 50, 0, 1) == 2
@@ -0,0 +1,77 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+def test_image_benchmark():
+    from azafea.benchmarks.image import get_image_ids, parse_with_strptime, run
+    from azafea.event_processors.endless.image import parse_endless_os_image
+
+    # The reference implementation must give the same results, otherwise the comparison is moot
+    for image_id in get_image_ids(100):
+        assert parse_with_strptime(image_id) == parse_endless_os_image(image_id)['image_timestamp']
+
+    assert set(run(number=1)) == {'strptime', 'slicing', 'memoized'}
+
+
+def test_handlers_benchmark():
+    from azafea.benchmarks.handlers import run
+
+    for handler in ('activation-v1', 'ping-v1'):
+        result = run(handler, 'null', 10, {}, 10)
+
+        assert result['handler'] == handler
+        assert result['session'] == 'null'
+        assert result['records'] == 10
+        assert result['errors'] == 0
+        assert result['latency_ms']['p50'] <= result['latency_ms']['p99']
+
+
+def test_benchmark_command(capfd, make_config_file):
+    import json
+
+    import azafea.cli
+
+    config_file = make_config_file({})
+    azafea.cli.run_command('-c', str(config_file), 'benchmark', '--handler', 'activation-v1',
+                           '--session', 'null', '--records', '10')
+
+    capture = capfd.readouterr()
+    results = json.loads(capture.out)
+    assert results['records'] == 10
+    assert [(r['handler'], r['session']) for r in results['results']] == [
+        ('activation-v1', 'null')]
+
+
+def test_benchmark_command_too_few_records(capfd, make_config_file):
+    import pytest
+
+    import azafea.cli
+
+    config_file = make_config_file({})
+
+    with pytest.raises(SystemExit):
+        azafea.cli.run_command('-c', str(config_file), 'benchmark', '--handler', 'activation-v1',
+                               '--session', 'null', '--records', '1')
+
+    capture = capfd.readouterr()
+    assert "Invalid number of records, at least 2 are needed: '1'" in capture.err
+
+
+def test_benchmark_command_null_session_by_default(capfd, make_config_file):
+    import json
+
+    import azafea.cli
+
+    # The configured database could be the production one, don't write anything in it
+    config_file = make_config_file({})
+    azafea.cli.run_command('-c', str(config_file), 'benchmark', '--handler', 'ping-v1',
+                           '--records', '10')
+
+    capture = capfd.readouterr()
+    results = json.loads(capture.out)
+    assert [(r['handler'], r['session']) for r in results['results']] == [('ping-v1', 'null')]
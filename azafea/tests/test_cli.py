@@ -247,6 +247,13 @@ def test_print_config(capfd, monkeypatch, make_config_file):
         'verbose = false',
         'number_of_workers = 1',
         'exit_on_empty_queues = false',
+        'metrics_port = 0',
+        'worker_max_restarts = 5',
+        'worker_max_records = 0',
+        'worker_max_memory_mb = 0',
+        'autoscale_min_workers = 0',
+        'autoscale_drain_seconds = 60',
+        'autoscale_cooldown_seconds = 300',
         '',
         '[redis]',
         'host = "redis-server"',
@@ -260,11 +267,28 @@ def test_print_config(capfd, monkeypatch, make_config_file):
         'user = "Léo"',
         'password = "** hidden **"',
         'database = "azafea"',
+        'pool_size = 5',
+        'max_overflow = 10',
+        'pool_pre_ping = false',
+        'pool_recycle = 0',
+        'statement_timeout_ms = 0',
+        'transaction_pooler = false',
+        'executemany_values_page_size = 1000',
+        'executemany_batch_page_size = 100',
         '',
         '[postgresql.connect_args]',
         '',
         '[queues.some-queue]',
         'handler = "azafea.tests"',
+        'backend = "list"',
+        'batch_size = 1',
+        'batch_linger_ms = 0',
+        'reliable = false',
+        'workers = 0',
+        'weight = 1',
+        'synchronous_commit = true',
+        'max_attempts = 10',
+        'retry_delay_ms = 1000',
         '------ END ------',
     ])
 
@@ -293,28 +317,68 @@ def test_print_config_no_event_queue(capfd, make_config_file):
     assert "Did you forget to configure event queues?" in capture.err
 
 
-def test_replay_errors(capfd, monkeypatch, make_config_file):
-    class MockRedis:
-        def __init__(self):
-            self._queues = {
-                'some-queue': [],
-                'errors-some-queue': [b'event1', b'event2', b'event3'],
-            }
+class MockRedisPipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
 
-        def llen(self, queue_name):
-            return len(self._queues[queue_name])
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        def queue_command(*args):
+            self._commands.append((getattr(self._redis, name), args))
+
+        return queue_command
+
+    def execute(self):
+        return [command(*args) for command, args in self._commands]
+
+
+class MockReplayRedis:
+    def __init__(self, errors):
+        self._queues = {'some-queue': [], 'errors-some-queue': errors}
+        self._streams = {'some-queue': []}
+        self.num_round_trips = 0
+
+    def llen(self, queue_name):
+        return len(self._queues[queue_name])
+
+    def zcard(self, name):
+        return {'retries-some-queue': 2}.get(name, 0)
+
+    def rpop(self, queue_name, count=None):
+        self.num_round_trips += 1
+        values = self._queues[queue_name]
+        popped = [values.pop(-1) for _ in range(min(count, len(values)))]
+
+        return popped or None
+
+    def rpoplpush(self, src, dst):
+        try:
+            value = self._queues[src].pop(-1)
+
+        except IndexError:
+            return None
 
-        def lpush(self, queue_name, value):
-            self._queues[queue_name].insert(0, value)
+        self._queues[dst].insert(0, value)
 
-        def rpop(self, queue_name):
-            try:
-                return self._queues[queue_name].pop(-1)
+        return value
 
-            except IndexError:
-                return None
+    def xadd(self, stream_name, fields):
+        self._streams[stream_name].append(fields)
 
-    redis = MockRedis()
+    def pipeline(self):
+        self.num_round_trips += 1
+
+        return MockRedisPipeline(self)
+
+
+def test_replay_errors(capfd, monkeypatch, make_config_file):
+    redis = MockReplayRedis([b'event1', b'event2', b'event3'])
 
     def mock_redis(*args, **kwargs):
         return redis
@@ -338,6 +402,156 @@ def test_replay_errors(capfd, monkeypatch, make_config_file):
         'some-queue': [b'event1', b'event2', b'event3'],
         'errors-some-queue': [],
     }
+    assert redis.num_round_trips == 1
+
+    capture = capfd.readouterr()
+    assert 'Successfully moved failed events back to "some-queue"' in capture.out
+
+
+def test_replay_errors_batches(capfd, monkeypatch, make_config_file):
+    redis = MockReplayRedis([b'event1', b'event2', b'event3', b'event4', b'event5'])
+    sleeps = []
+
+    def mock_redis(*args, **kwargs):
+        return redis
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {'some-queue': {'handler': 'azafea.tests'}},
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', mock_redis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        m.setattr(azafea.cli.commands.time, 'monotonic', lambda: 0)
+        m.setattr(azafea.cli.commands.time, 'sleep', sleeps.append)
+        azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue',
+                               '--batch-size', '2', '--rate', '4')
+
+    assert redis._queues == {
+        'some-queue': [b'event1', b'event2', b'event3', b'event4', b'event5'],
+        'errors-some-queue': [],
+    }
+    assert redis.num_round_trips == 3
+
+    # No need to wait after the last batch
+    assert sleeps == [0.5, 1.0]
+
+    capture = capfd.readouterr()
+    assert '|  5 / 5' in capture.out
+    assert 'Successfully moved failed events back to "some-queue"' in capture.out
+
+
+def test_replay_errors_batches_limited_by_rate(capfd, monkeypatch, make_config_file):
+    redis = MockReplayRedis([b'event1', b'event2', b'event3', b'event4', b'event5'])
+    sleeps = []
+
+    def mock_redis(*args, **kwargs):
+        return redis
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {'some-queue': {'handler': 'azafea.tests'}},
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', mock_redis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        m.setattr(azafea.cli.commands.time, 'monotonic', lambda: 0)
+        m.setattr(azafea.cli.commands.time, 'sleep', sleeps.append)
+        azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue',
+                               '--rate', '2')
+
+    assert redis._queues == {
+        'some-queue': [b'event1', b'event2', b'event3', b'event4', b'event5'],
+        'errors-some-queue': [],
+    }
+
+    # Batches are not bigger than what can be moved in a second
+    assert redis.num_round_trips == 3
+    assert sleeps == [1.0, 2.0]
+
+
+@pytest.mark.parametrize('option, value', [
+    ('--rate', '-1'),
+    ('--batch-size', '0'),
+])
+def test_replay_errors_invalid_option(capfd, make_config_file, option, value):
+    config_file = make_config_file({})
+
+    with pytest.raises(SystemExit):
+        azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue',
+                               option, value)
+
+    capture = capfd.readouterr()
+    assert f"'{value}'" in capture.err
+
+
+def test_replay_errors_dry_run(capfd, monkeypatch, make_config_file):
+    redis = MockReplayRedis([b'event1', b'event2', b'event3'])
+
+    def mock_redis(*args, **kwargs):
+        return redis
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {'some-queue': {'handler': 'azafea.tests'}},
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', mock_redis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue', '--dry-run')
+
+    assert redis._queues == {
+        'some-queue': [],
+        'errors-some-queue': [b'event1', b'event2', b'event3'],
+    }
+
+    capture = capfd.readouterr()
+    assert 'some-queue: 3 errors would be moved back, 2 retrying' in capture.out
+    assert 'Successfully moved failed events' not in capture.out
+
+
+def test_replay_errors_stream(capfd, monkeypatch, make_config_file):
+    redis = MockReplayRedis([b'event1', b'event2'])
+
+    def mock_redis(*args, **kwargs):
+        return redis
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {'some-queue': {'handler': 'azafea.tests', 'backend': 'stream'}},
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', mock_redis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue')
+
+    assert redis._queues == {'some-queue': [], 'errors-some-queue': []}
+    assert redis._streams == {'some-queue': [{b'data': b'event2'}, {b'data': b'event1'}]}
+    assert redis.num_round_trips == 2
 
     capture = capfd.readouterr()
     assert 'Successfully moved failed events back to "some-queue"' in capture.out
@@ -390,28 +604,12 @@ def test_replay_errors_unknown_queue(capfd, monkeypatch, make_config_file):
 
 
 def test_replay_errors_stopped_early(capfd, monkeypatch, make_config_file):
-    class MockRedis:
-        def __init__(self):
-            self._queues = {
-                'some-queue': [],
-                'errors-some-queue': [b'event1', b'event2', b'event3'],
-            }
-
+    class MockRedis(MockReplayRedis):
         def llen(self, queue_name):
             # Pretend there were 5 elements in the queue but somehow only 3 could be pulled
             return 5
 
-        def lpush(self, queue_name, value):
-            self._queues[queue_name].insert(0, value)
-
-        def rpop(self, queue_name):
-            try:
-                return self._queues[queue_name].pop(-1)
-
-            except IndexError:
-                return None
-
-    redis = MockRedis()
+    redis = MockRedis([b'event1', b'event2', b'event3'])
 
     def mock_redis(*args, **kwargs):
         return redis
@@ -442,27 +640,11 @@ def test_replay_errors_stopped_early(capfd, monkeypatch, make_config_file):
 
 
 def test_replay_errors_fail_to_push(capfd, monkeypatch, make_config_file):
-    class MockRedis:
-        def __init__(self):
-            self._queues = {
-                'some-queue': [],
-                'errors-some-queue': [b'event1', b'event2', b'event3'],
-            }
-
-        def llen(self, queue_name):
-            return len(self._queues[queue_name])
-
-        def lpush(self, queue_name, value):
+    class MockRedis(MockReplayRedis):
+        def rpoplpush(self, src, dst):
             raise ValueError('Oh no!')
 
-        def rpop(self, queue_name):
-            try:
-                return self._queues[queue_name].pop(-1)
-
-            except IndexError:
-                return None
-
-    redis = MockRedis()
+    redis = MockRedis([b'event1', b'event2', b'event3'])
 
     def mock_redis(*args, **kwargs):
         return redis
@@ -484,13 +666,192 @@ def test_replay_errors_fail_to_push(capfd, monkeypatch, make_config_file):
         with pytest.raises(azafea.cli.errors.UnknownErrorExit):
             azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue')
 
+    # Nothing was lost
     assert redis._queues == {
         'some-queue': [],
-        'errors-some-queue': [b'event1', b'event2'],
+        'errors-some-queue': [b'event1', b'event2', b'event3'],
     }
 
     capture = capfd.readouterr()
-    assert 'Failed to push b\'event3\' back in "some-queue":' in capture.err
+    assert 'Failed to move failed events back to "some-queue":' in capture.err
+
+
+def test_replay_errors_stream_fail_to_push(capfd, monkeypatch, make_config_file):
+    class MockRedis(MockReplayRedis):
+        def xadd(self, stream_name, fields):
+            raise ValueError('Oh no!')
+
+    redis = MockRedis([b'event1', b'event2'])
+
+    def mock_redis(*args, **kwargs):
+        return redis
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {'some-queue': {'handler': 'azafea.tests', 'backend': 'stream'}},
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', mock_redis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+
+        with pytest.raises(azafea.cli.errors.UnknownErrorExit):
+            azafea.cli.run_command('-c', str(config_file), 'replay-errors', 'some-queue')
+
+    capture = capfd.readouterr()
+    assert 'Failed to push [b\'event2\', b\'event1\'] back in "some-queue":' in capture.err
+
+
+def test_queue_status(capfd, monkeypatch, make_config_file):
+    class MockRedis:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def llen(self, queue_name):
+            return {'list-queue': 3, 'errors-list-queue': 1}.get(queue_name, 0)
+
+        def zcard(self, name):
+            return {'retries-stream-queue': 4}.get(name, 0)
+
+        def xinfo_groups(self, stream_name):
+            if stream_name == 'new-stream':
+                raise azafea.cli.commands.ResponseError('no such key')
+
+            return [
+                {'name': b'other-group', 'pending': 0, 'lag': 0},
+                {'name': b'azafea', 'pending': 2, 'lag': 5},
+            ]
+
+        def xinfo_consumers(self, stream_name, group_name):
+            return [{'name': b'host.worker-1', 'pending': 2, 'idle': 1234}]
+
+    def mock_get_callable(module_name, callable_name):
+        def process(*args, **kwargs):
+            pass
+
+        return process
+
+    config_file = make_config_file({
+        'queues': {
+            'list-queue': {'handler': 'azafea.tests'},
+            'stream-queue': {'handler': 'azafea.tests', 'backend': 'stream'},
+            'new-stream': {'handler': 'azafea.tests', 'backend': 'stream'},
+        },
+    })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', MockRedis)
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        azafea.cli.run_command('-c', str(config_file), 'queue-status')
+
+    capture = capfd.readouterr()
+    assert capture.out.splitlines() == [
+        'list-queue: 3 waiting, 0 retrying, 1 errors',
+        'stream-queue: 5 waiting, 2 pending, 4 retrying, 0 errors',
+        '  host.worker-1: 2 pending, idle for 1234ms',
+        'new-stream: no consumer group yet, 0 retrying, 0 errors',
+    ]
+
+
+def test_queue_status_no_event_queue(capfd, make_config_file):
+    config_file = make_config_file({})
+
+    with pytest.raises(azafea.cli.errors.NoEventQueueExit):
+        azafea.cli.run_command('-c', str(config_file), 'queue-status')
+
+    capture = capfd.readouterr()
+    assert 'Could not get the status of the queues: no event queue configured' in capture.err
+
+
+def test_profile_worker(capfd, monkeypatch, make_config_file):
+    class MockRedis:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def set(self, key, value, ex=None):
+            print(f'SET {key} {value} EX {ex}')
+
+    config_file = make_config_file({})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands, 'Redis', MockRedis)
+        azafea.cli.run_command('-c', str(config_file), 'profile-worker', '--host', 'some-host',
+                               '--worker', 'worker-1', '--records', '10', '--output-dir', '/data')
+
+    capture = capfd.readouterr()
+    assert ('SET profile-request@some-host {"worker": "worker-1", "records": 10, "seconds": 60, '
+            '"directory": "/data"} EX 10') in capture.out
+    assert ('Asked the controller on some-host to profile worker-1, the profiles will be written '
+            'in /data') in capture.out
+
+
+def test_profile_worker_redis_connection_error(capfd, make_config_file):
+    # Hopefully nobody will ever run the tests with a Redis server accessible at this host:port
+    config_file = make_config_file({'redis': {'host': 'no-such-host', 'port': 1}})
+
+    with pytest.raises(azafea.cli.errors.ConnectionErrorExit):
+        azafea.cli.run_command('-c', str(config_file), 'profile-worker')
+
+    capture = capfd.readouterr()
+    assert 'Could not connect to Redis' in capture.err
+
+
+def test_stage_timings(capfd, monkeypatch, make_config_file):
+    class MockResponse:
+        text = '\n'.join([
+            'azafea_records_processed_total{queue="some-queue"} 10',
+            'azafea_processing_seconds_sum{queue="some-queue"} 2.0',
+            'azafea_stage_seconds_total{queue="some-queue",stage="commit"} 0.5',
+            'azafea_stage_seconds_total{queue="some-queue",stage="decode"} 1.0',
+        ])
+
+        def raise_for_status(self):
+            pass
+
+    def mock_get(url):
+        print(f'GET {url}')
+        return MockResponse()
+
+    config_file = make_config_file({'main': {'metrics_port': 9090}})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.cli.commands.requests, 'get', mock_get)
+        azafea.cli.run_command('-c', str(config_file), 'stage-timings')
+
+    capture = capfd.readouterr()
+    assert capture.out.splitlines() == [
+        'GET http://localhost:9090/metrics',
+        'some-queue: 10 events processed in 2.000s',
+        '  decode: 1.000s (50.0%)',
+        '  commit: 0.500s (25.0%)',
+        '  other: 0.500s (25.0%)',
+    ]
+
+
+def test_stage_timings_metrics_disabled(capfd, make_config_file):
+    config_file = make_config_file({})
+
+    with pytest.raises(azafea.cli.errors.MetricsDisabledExit):
+        azafea.cli.run_command('-c', str(config_file), 'stage-timings')
+
+    capture = capfd.readouterr()
+    assert 'Could not get the stage timings: the metrics are disabled' in capture.err
+
+
+def test_stage_timings_connection_error(capfd, make_config_file):
+    # Hopefully nobody will ever run the tests with a metrics server accessible at this port
+    config_file = make_config_file({'main': {'metrics_port': 1}})
+
+    with pytest.raises(azafea.cli.errors.ConnectionErrorExit):
+        azafea.cli.run_command('-c', str(config_file), 'stage-timings')
+
+    capture = capfd.readouterr()
+    assert 'Could not get the metrics from http://localhost:1/metrics' in capture.err
 
 
 @pytest.mark.integration
@@ -637,7 +998,7 @@ def test_per_queue_command(capfd, monkeypatch, make_config_file):
             do_something = subs.add_parser('do-something')
             do_something.set_defaults(subcommand=lambda *_: print('Doing something!'))
 
-        assert callable_name in ('register_commands', 'process')
+        assert callable_name in ('register_commands', 'process', 'process_batch')
 
         if callable_name == 'register_commands':
             return register_commands
@@ -670,7 +1031,7 @@ def test_per_queue_invalid_command(capfd, monkeypatch, make_config_file):
             do_something = subs.add_parser('do-something')
             do_something.set_defaults(subcommand=lambda *_: print('Doing something!'))
 
-        assert callable_name in ('register_commands', 'process')
+        assert callable_name in ('register_commands', 'process', 'process_batch')
 
         if callable_name == 'register_commands':
             return register_commands
@@ -34,6 +34,13 @@ def test_defaults():
         'verbose = false',
         f'number_of_workers = {number_of_workers}',
         'exit_on_empty_queues = false',
+        'metrics_port = 0',
+        'worker_max_restarts = 5',
+        'worker_max_records = 0',
+        'worker_max_memory_mb = 0',
+        'autoscale_min_workers = 0',
+        'autoscale_drain_seconds = 60',
+        'autoscale_cooldown_seconds = 300',
         '',
         '[redis]',
         'host = "localhost"',
@@ -47,6 +54,14 @@ def test_defaults():
         'user = "azafea"',
         'password = "** hidden **"',
         'database = "azafea"',
+        'pool_size = 5',
+        'max_overflow = 10',
+        'pool_pre_ping = false',
+        'pool_recycle = 0',
+        'statement_timeout_ms = 0',
+        'transaction_pooler = false',
+        'executemany_values_page_size = 1000',
+        'executemany_batch_page_size = 100',
         '',
         '[queues]',
         '',
@@ -99,6 +114,13 @@ def test_override(monkeypatch, make_config):
         'verbose = false',
         'number_of_workers = 1',
         'exit_on_empty_queues = false',
+        'metrics_port = 0',
+        'worker_max_restarts = 5',
+        'worker_max_records = 0',
+        'worker_max_memory_mb = 0',
+        'autoscale_min_workers = 0',
+        'autoscale_drain_seconds = 60',
+        'autoscale_cooldown_seconds = 300',
         '',
         '[redis]',
         'host = "localhost"',
@@ -112,6 +134,14 @@ def test_override(monkeypatch, make_config):
         'user = "azafea"',
         'password = "** hidden **"',
         'database = "azafea"',
+        'pool_size = 5',
+        'max_overflow = 10',
+        'pool_pre_ping = false',
+        'pool_recycle = 0',
+        'statement_timeout_ms = 0',
+        'transaction_pooler = false',
+        'executemany_values_page_size = 1000',
+        'executemany_batch_page_size = 100',
         '',
         '[postgresql.connect_args]',
         'sslmode = "require"',
@@ -119,6 +149,15 @@ def test_override(monkeypatch, make_config):
         '',
         '[queues.some-queue]',
         'handler = "azafea.tests.test_config"',
+        'backend = "list"',
+        'batch_size = 1',
+        'batch_linger_ms = 0',
+        'reliable = false',
+        'workers = 0',
+        'weight = 1',
+        'synchronous_commit = true',
+        'max_attempts = 10',
+        'retry_delay_ms = 1000',
     ])
 
 
@@ -172,6 +211,40 @@ def test_override_number_of_workers_negative_or_zero(make_config, value):
     ) in str(exc_info.value)
 
 
+@pytest.mark.parametrize('value', [
+    False,
+    '9090',
+])
+def test_override_metrics_port_invalid(make_config, value):
+    with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+        make_config({'main': {'metrics_port': value}})
+
+    assert (
+        'Invalid configuration:\n'
+        f'* main.metrics_port: Value error, {value!r} is not an integer'
+    ) in str(exc_info.value)
+
+
+def test_override_metrics_port_negative(make_config):
+    with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+        make_config({'main': {'metrics_port': -1}})
+
+    assert (
+        'Invalid configuration:\n'
+        '* main.metrics_port: Value error, -1 is not a positive integer'
+    ) in str(exc_info.value)
+
+
+def test_override_autoscale_min_workers_too_many(make_config):
+    with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+        make_config({'main': {'number_of_workers': 2, 'autoscale_min_workers': 3}})
+
+    assert (
+        'Invalid configuration:\n'
+        '* main: Value error, autoscale_min_workers must not be greater than number_of_workers'
+    ) in str(exc_info.value)
+
+
 @pytest.mark.parametrize('value', [
     False,
     True,
@@ -355,6 +428,26 @@ def test_override_postgresql_database_empty(make_config):
     ) in str(exc_info.value)
 
 
+def test_override_postgresql_pool_size_not_positive(make_config):
+    with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+        make_config({'postgresql': {'pool_size': 0}})
+
+    assert (
+        'Invalid configuration:\n'
+        '* postgresql.pool_size: Value error, 0 is not a strictly positive integer'
+    ) in str(exc_info.value)
+
+
+def test_override_postgresql_transaction_pooler_invalid(make_config):
+    with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+        make_config({'postgresql': {'transaction_pooler': 'yes'}})
+
+    assert (
+        'Invalid configuration:\n'
+        "* postgresql.transaction_pooler: Value error, 'yes' is not a boolean"
+    ) in str(exc_info.value)
+
+
 def test_add_queue_with_nonexistent_handler_module(make_config):
     with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
         make_config({'queues': {'some-queue': {'handler': 'no.such.module'}}})
@@ -394,3 +487,121 @@ def test_non_default_passwords(capfd, make_config):
     capture = capfd.readouterr()
     assert 'Did you forget to change the PostgreSQL password?' not in capture.err
     assert 'Did you forget to change the Redis password?' not in capture.err
+
+
+def test_override_queue_batch(monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_config',
+                'batch_size': 100,
+                'batch_linger_ms': 50,
+            }},
+        })
+
+    assert config.queues['some-queue'].batch_size == 100
+    assert config.queues['some-queue'].batch_linger_ms == 50
+
+
+@pytest.mark.parametrize('value', [
+    False,
+    True,
+    '42',
+])
+def test_override_queue_batch_size_invalid(monkeypatch, make_config, value):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+
+        with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+            make_config({'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_config',
+                'batch_size': value,
+            }}})
+
+    assert (
+        'Invalid configuration:\n'
+        f'* queues.some-queue.batch_size: Value error, {value!r} is not an integer'
+    ) in str(exc_info.value)
+
+
+@pytest.mark.parametrize('value', [
+    -1,
+    0,
+])
+def test_override_queue_batch_size_negative_or_zero(monkeypatch, make_config, value):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+
+        with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+            make_config({'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_config',
+                'batch_size': value,
+            }}})
+
+    assert (
+        'Invalid configuration:\n'
+        f'* queues.some-queue.batch_size: Value error, {value!r} is not a strictly positive integer'
+    ) in str(exc_info.value)
+
+
+def test_override_queue_batch_linger_negative(monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+
+        with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+            make_config({'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_config',
+                'batch_linger_ms': -1,
+            }}})
+
+    assert (
+        'Invalid configuration:\n'
+        '* queues.some-queue.batch_linger_ms: Value error, -1 is not a positive integer'
+    ) in str(exc_info.value)
+
+
+def test_override_queue_backend_invalid(monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+
+        with pytest.raises(azafea.config.InvalidConfigurationError) as exc_info:
+            make_config({'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_config',
+                'backend': 'pubsub',
+            }}})
+
+    assert (
+        'Invalid configuration:\n'
+        "* queues.some-queue.backend: Value error, 'pubsub' is not one of 'list', 'stream'"
+    ) in str(exc_info.value)
@@ -7,19 +7,26 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
+import gc
+import json
 from signal import SIGINT, SIGTERM
+import socket
 
 import pytest
 
+import azafea.config
 from azafea.config import Config
 import azafea.controller
+import azafea.model
 from azafea.logging import setup_logging
 from azafea.utils import get_cpu_count
 
 
 class MockProcessor:
-    def __init__(self, name, config):
+    def __init__(self, name, config, metrics_channel=None, queues=None):
         self.name = name
+        self.metrics_channel = metrics_channel
+        self.queues = tuple(queues or config.queues)
         self.joined = False
         self.terminated = False
 
@@ -110,3 +117,430 @@ def test_sigterm_handler(capfd, make_config):
     assert 'All workers finished, exiting' in capture.out
 
     assert exc_info.value.args == (0, )
+
+
+def test_requeue_orphaned_records(capfd, monkeypatch, make_config):
+    closed = []
+
+    class MockRedis:
+        def __init__(self, host, port, password, ssl):
+            pass
+
+        def close(self):
+            closed.append(self)
+
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    def mock_requeue_orphaned_records(redis, queue):
+        return 3 if queue == 'reliable-queue' else 0
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'number_of_workers': 1},
+            'queues': {
+                'reliable-queue': {'handler': 'azafea.tests.test_controller', 'reliable': True},
+                'other-queue': {'handler': 'azafea.tests.test_controller'},
+            },
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProcessor)
+        m.setattr(azafea.controller, 'Redis', MockRedis)
+        m.setattr(azafea.controller, 'requeue_orphaned_records', mock_requeue_orphaned_records)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+    capture = capfd.readouterr()
+    assert ('Requeued 3 records left unprocessed by dead workers in the reliable-queue queue'
+            in capture.err)
+    assert 'other-queue' not in capture.err
+    assert '{worker-1} Starting' in capture.out
+
+    # The worker did not inherit the connection of the controller
+    assert len(closed) == 1
+    assert controller._redis is None
+
+
+def test_start_metrics_server(capfd, monkeypatch, make_config):
+    class MockMetricsServer:
+        def __init__(self, config, channel):
+            self.channel = channel
+            self.stopped = False
+
+        def start(self):
+            print('Serving the metrics')
+
+        def stop(self):
+            self.stopped = True
+
+    config = make_config({'main': {'number_of_workers': 1, 'metrics_port': 9090}})
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProcessor)
+        m.setattr(azafea.controller, 'MetricsServer', MockMetricsServer)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+    # The workers send their metrics to the server
+    assert controller._processors[0].metrics_channel is controller._metrics_server.channel
+
+    with pytest.raises(SystemExit):
+        controller._handle_exit_signals(SIGINT, None)
+
+    assert controller._metrics_server.stopped
+
+    capture = capfd.readouterr()
+    assert 'Serving the metrics' in capture.out
+
+
+def test_profile_request(capfd, monkeypatch, make_config):
+    class MockPipeline:
+        def __init__(self, redis):
+            self.redis = redis
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def get(self, key):
+            self.key = key
+
+        def delete(self, key):
+            pass
+
+        def execute(self):
+            return [self.redis.requests.pop(self.key, None), 1]
+
+    class MockRedis:
+        def __init__(self, host, port, password, ssl):
+            self.requests = {
+                f'profile-request@{socket.gethostname()}': json.dumps({
+                    'worker': 'worker-2', 'records': 10, 'seconds': 5, 'directory': '/tmp',
+                }),
+            }
+
+        def pipeline(self):
+            return MockPipeline(self)
+
+    class MockProfiledProcessor(MockProcessor):
+        def is_alive(self):
+            return True
+
+        def request_profile(self, **request):
+            print(f'{{{self.name}}} Profile requested: {request}')
+
+    config = make_config({'main': {'number_of_workers': 2}})
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProfiledProcessor)
+        m.setattr(azafea.controller, 'Redis', MockRedis)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+        controller._handle_profile_requests()
+
+        # The request was consumed
+        controller._handle_profile_requests()
+
+    capture = capfd.readouterr()
+    assert 'Asking worker-2 to profile itself' in capture.out
+    assert ("{worker-2} Profile requested: {'records': 10, 'seconds': 5, 'directory': '/tmp'}"
+            in capture.out)
+    assert 'worker-1} Profile requested' not in capture.out
+    assert capture.out.count('Profile requested') == 1
+
+
+def test_profile_request_redis_error(capfd, monkeypatch, make_config):
+    class MockRedis:
+        def __init__(self, host, port, password, ssl):
+            pass
+
+        def pipeline(self):
+            raise azafea.controller.RedisError('Connection refused')
+
+    config = make_config({'main': {'number_of_workers': 1}})
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Redis', MockRedis)
+        controller = azafea.controller.Controller(config)
+        controller._handle_profile_requests()
+
+    capture = capfd.readouterr()
+    assert 'Could not check for profile requests: Connection refused' in capture.err
+
+
+class MockSupervisedProcessor(MockProcessor):
+    exitcodes = {}
+
+    def __init__(self, name, config, metrics_channel=None, queues=None):
+        super().__init__(name, config, metrics_channel, queues)
+
+        # Each new worker takes the next exit code
+        self.exitcode = self.exitcodes[name].pop(0)
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+def test_supervise(capfd, monkeypatch, make_config):
+    class MockRedis:
+        def __init__(self, host, port, password, ssl):
+            self.lists = {f'processing-reliable-queue@{socket.gethostname()}.worker-1': [b'1']}
+
+        def rpoplpush(self, src, dst):
+            values = self.lists.get(src)
+            return values.pop() if values else None
+
+        def close(self):
+            pass
+
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'number_of_workers': 4, 'worker_max_restarts': 1},
+            'queues': {
+                'reliable-queue': {'handler': 'azafea.tests.test_controller', 'reliable': True},
+            },
+        })
+
+    setup_logging(verbose=config.main.verbose)
+    MockSupervisedProcessor.exitcodes = {
+        # Crashes, then runs
+        'worker-1': [1, None],
+        # Gets recycled, then runs
+        'worker-2': [azafea.controller.RECYCLE_EXIT_CODE, None],
+        # Exits cleanly
+        'worker-3': [0],
+        # Crashes too often
+        'worker-4': [-9, -9],
+    }
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockSupervisedProcessor)
+        m.setattr(azafea.controller, 'Redis', MockRedis)
+        m.setattr(azafea.controller, 'RESTART_BACKOFF', 0)
+        m.setattr(azafea.controller, 'requeue_orphaned_records', lambda redis, queue: 0)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+        # Find the dead workers, then restart them
+        controller._supervise()
+        controller._supervise()
+        controller._supervise()
+        controller._supervise()
+
+    assert [p.exitcode for p in controller._processors] == [None, None, 0, -9]
+    assert controller._finished == {'worker-3', 'worker-4'}
+
+    capture = capfd.readouterr()
+    assert ('Requeued 1 records left unprocessed by worker-1 in the reliable-queue queue'
+            in capture.err)
+    assert 'worker-1 crashed with exit code 1, restarting it in 0 second' in capture.err
+    assert 'Replacing worker-2' in capture.out
+    assert 'worker-3' not in capture.err
+    assert ('worker-4 crashed with exit code -9 too many times in a row, giving up on it'
+            in capture.err)
+
+
+def test_supervise_restart_failed(capfd, monkeypatch, make_config):
+    class FailingProcessor(MockSupervisedProcessor):
+        def __init__(self, name, config, metrics_channel=None, queues=None):
+            if not self.exitcodes[name]:
+                raise azafea.model.PostgresqlConnectionError('connection refused')
+
+            super().__init__(name, config, metrics_channel, queues)
+
+    config = make_config({'main': {'number_of_workers': 1}})
+    setup_logging(verbose=config.main.verbose)
+    FailingProcessor.exitcodes = {'worker-1': [1]}
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', FailingProcessor)
+        m.setattr(azafea.controller, 'RESTART_BACKOFF', 0)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+        controller._supervise()
+        controller._supervise()
+
+    assert 'worker-1' in controller._restart_at
+
+    capture = capfd.readouterr()
+    assert 'Could not restart worker-1: connection refused' in capture.err
+    assert 'worker-1 crashed with exit code None, restarting it in 0 second' in capture.err
+
+
+def test_autoscale(capfd, monkeypatch, make_config):
+    class MockScaledProcessor(MockProcessor):
+        num_processed = 0
+
+        def is_alive(self):
+            # Workers exit once they finished their current task
+            return not self.terminated
+
+        @property
+        def exitcode(self):
+            return 0 if self.terminated else None
+
+    class MockAutoscaler:
+        def __init__(self, config):
+            self.min_workers = config.main.autoscale_min_workers
+            self.max_workers = config.main.number_of_workers
+            self.wanted = [3, 3, 2]
+
+        def update(self, now, backlog, num_processed, num_workers):
+            return self.wanted.pop(0)
+
+    config = make_config({'main': {'number_of_workers': 4, 'autoscale_min_workers': 1}})
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockScaledProcessor)
+        m.setattr(azafea.controller, 'Autoscaler', MockAutoscaler)
+        m.setattr(azafea.controller, 'AUTOSCALE_INTERVAL', 0)
+        m.setattr(azafea.controller, 'get_queue_lengths', lambda redis, queues: {'a-queue': 42})
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+        assert [p.name for p in controller._processors] == ['worker-1']
+
+        controller._autoscale()
+        assert [p.name for p in controller._processors] == ['worker-1', 'worker-2', 'worker-3']
+
+        controller._autoscale()
+        assert len(controller._processors) == 3
+
+        controller._autoscale()
+        assert [p.name for p in controller._processors] == ['worker-1', 'worker-2']
+        assert [p.name for p in controller._retiring] == ['worker-3']
+        assert controller._retiring[0].terminated
+
+        controller._supervise()
+        assert controller._retiring == []
+        assert controller._finished == set()
+
+    capture = capfd.readouterr()
+    assert 'Starting the controller with 1 worker' in capture.out
+    assert 'Scaling between 1 and 4 workers depending on the queues' in capture.out
+    assert 'Scaling from 1 to 3 workers, with 42 records waiting in the queues' in capture.out
+    assert 'Scaling from 3 to 2 workers, with 42 records waiting in the queues' in capture.out
+
+
+def test_dedicated_workers(capfd, monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'number_of_workers': 2},
+            'queues': {
+                'cheap-queue': {'handler': 'azafea.tests.test_controller'},
+                'expensive-queue': {'handler': 'azafea.tests.test_controller', 'workers': 3},
+                'other-queue': {'handler': 'azafea.tests.test_controller', 'weight': 2},
+            },
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProcessor)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+    assert [(p.name, p.queues) for p in controller._processors] == [
+        ('worker-1', ('cheap-queue', 'other-queue')),
+        ('worker-2', ('cheap-queue', 'other-queue')),
+        ('expensive-queue-worker-1', ('expensive-queue',)),
+        ('expensive-queue-worker-2', ('expensive-queue',)),
+        ('expensive-queue-worker-3', ('expensive-queue',)),
+    ]
+
+    capture = capfd.readouterr()
+    assert 'Starting the controller with 5 workers' in capture.out
+    assert 'Dedicating 3 workers to the expensive-queue queue' in capture.out
+
+
+def test_only_dedicated_workers(capfd, monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'number_of_workers': 2, 'autoscale_min_workers': 1},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_controller', 'workers': 1}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProcessor)
+        controller = azafea.controller.Controller(config)
+        controller.start()
+
+    # There is nothing left for the shared workers to do
+    assert [p.name for p in controller._processors] == ['some-queue-worker-1']
+    assert controller._autoscaler is None
+
+    capture = capfd.readouterr()
+    assert 'Starting the controller with 1 worker' in capture.out
+
+
+def test_preload(monkeypatch, make_config):
+    configured = []
+
+    def mock_configure_mappers():
+        configured.append(len(controller._processors))
+
+    config = make_config({'main': {'number_of_workers': 2}})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.controller, 'Processor', MockProcessor)
+        m.setattr(azafea.controller, 'configure_mappers', mock_configure_mappers)
+        controller = azafea.controller.Controller(config)
+
+        try:
+            controller.start()
+
+            # Everything was set up before forking any worker
+            assert configured == [0]
+            assert gc.get_freeze_count() > 0
+
+        finally:
+            gc.unfreeze()
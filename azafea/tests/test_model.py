@@ -9,9 +9,19 @@
 
 import pytest
 
+from datetime import date, datetime, timezone
+import gc
+from types import SimpleNamespace
+from uuid import UUID
+
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID as PgUUID
+from sqlalchemy.dialects.postgresql.psycopg2 import EXECUTEMANY_VALUES, PGDialect_psycopg2
+from sqlalchemy.engine import create_engine
+from sqlalchemy.event import contains
 from sqlalchemy.orm import relationship
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.schema import Column, ForeignKey
-from sqlalchemy.types import Integer, Text
+from sqlalchemy.types import Boolean, Date, DateTime, Integer, LargeBinary, Text
 
 from azafea.config import Config
 import azafea.model
@@ -95,6 +105,102 @@ def test_fail_in_db_session(monkeypatch, mock_sessionmaker):
         assert dbsession.rolled_back
 
 
+def test_db_pool(monkeypatch, mock_sessionmaker, make_config):
+    config = make_config({'postgresql': {
+        'pool_size': 2,
+        'max_overflow': 0,
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,
+        'statement_timeout_ms': 5000,
+        'connect_args': {'options': '-c lock_timeout=1000'},
+    }})
+
+    def mock_create_engine(url, connect_args, **kwargs):
+        engine_connect_args.update(connect_args)
+
+        return create_engine(url, connect_args=connect_args, **kwargs)
+
+    engine_connect_args = {}
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        m.setattr(azafea.model, 'create_engine', mock_create_engine)
+        db = azafea.model.Db(config.postgresql)
+
+    assert engine_connect_args['options'] == '-c lock_timeout=1000 -c statement_timeout=5000'
+
+    dialect = db._engine.dialect
+    assert dialect.executemany_mode is EXECUTEMANY_VALUES
+    assert dialect.executemany_values_page_size == 1000
+    assert dialect.executemany_batch_page_size == 100
+
+    pool = db._engine.pool
+    assert isinstance(pool, QueuePool)
+    assert pool.size() == 2
+    assert pool._max_overflow == 0
+    assert pool._pre_ping
+    assert pool._recycle == 3600
+
+
+def test_db_transaction_pooler(monkeypatch, mock_sessionmaker, make_config):
+    class MockCursor:
+        statements = []
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute(self, statement):
+            self.statements.append(statement)
+
+    class MockDbapiConnection:
+        def cursor(self):
+            return MockCursor()
+
+    class MockConnection:
+        connection = MockDbapiConnection()
+
+    config = make_config({'postgresql': {'transaction_pooler': True, 'statement_timeout_ms': 5000}})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        db = azafea.model.Db(config.postgresql)
+
+    # Connections are neither kept around nor configured for the whole session
+    assert isinstance(db._engine.pool, NullPool)
+
+    db._engine.dispatch.begin(MockConnection)
+    assert MockCursor.statements == ['SET LOCAL statement_timeout = 5000']
+
+
+def test_db_asynchronous_commit(monkeypatch):
+    class MockConnection:
+        statements = []
+
+        def execute(self, statement):
+            self.statements.append(statement)
+
+    config = Config()
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model.Db, '_ensure_connection', lambda db: None)
+        m.setattr(azafea.model.Base.metadata, 'reflect', lambda *args, **kwargs: None)
+        db = azafea.model.Db(config.postgresql)
+
+    with db as dbsession:
+        assert not contains(dbsession, 'after_begin', azafea.model._disable_synchronous_commit)
+
+    db.synchronous_commit = False
+
+    with db as dbsession:
+        assert contains(dbsession, 'after_begin', azafea.model._disable_synchronous_commit)
+
+    azafea.model._disable_synchronous_commit(dbsession, None, MockConnection())
+    assert MockConnection.statements == ['SET LOCAL synchronous_commit = off']
+
+
 def test_base_model():
     class Address(azafea.model.Base):
         __tablename__ = 'addresses'
@@ -136,3 +242,231 @@ def test_base_model():
     azafea.model.Base._decl_class_registry.clear()
     azafea.model.Base.metadata.clear()
     azafea.model.Base.metadata.dispatch._clear()
+
+
+def test_base_model_to_row():
+    class Person(azafea.model.Base):
+        __tablename__ = 'people'
+
+        id = Column(Integer, primary_key=True)
+        name = Column(Text)
+        nickname = Column('alias', Text)
+        city = Column(Text)
+
+    person = Person(name='Sherlock Holmes', nickname='Sherlock', city=None)
+
+    # Only the columns which were set are returned, keyed by column name
+    assert person.to_row() == {'name': 'Sherlock Holmes', 'alias': 'Sherlock', 'city': None}
+
+    # Deregister the test models, to avoid side-effects between tests
+    azafea.model.Base._decl_class_registry.clear()
+    azafea.model.Base.metadata.clear()
+    azafea.model.Base.metadata.dispatch._clear()
+
+
+def test_base_model_to_row_relationship():
+    class Address(azafea.model.Base):
+        __tablename__ = 'addresses'
+
+        id = Column(Integer, primary_key=True)
+
+    class Person(azafea.model.Base):
+        __tablename__ = 'people'
+
+        id = Column(Integer, primary_key=True)
+        name = Column(Text)
+        address_id = Column(Integer, ForeignKey('addresses.id'))
+
+        address = relationship(Address)
+
+    # Foreign keys are taken from the related instances
+    assert Person(name='Sherlock Holmes', address=Address(id=221)).to_row() == {
+        'name': 'Sherlock Holmes',
+        'address_id': 221,
+    }
+    assert Person(name='Nobody', address=None).to_row() == {'name': 'Nobody', 'address_id': None}
+    assert Person(name='John Watson', address_id=221).to_row() == {
+        'name': 'John Watson',
+        'address_id': 221,
+    }
+
+    # Deregister the test models, to avoid side-effects between tests
+    azafea.model.Base._decl_class_registry.clear()
+    azafea.model.Base.metadata.clear()
+    azafea.model.Base.metadata.dispatch._clear()
+
+
+def test_insert_all(monkeypatch):
+    class Event(azafea.model.Base):
+        __tablename__ = 'events'
+
+        id = Column(Integer, primary_key=True)
+        name = Column(Text)
+        flag = Column(Boolean)
+        day = Column(Date)
+        at = Column(DateTime(timezone=True))
+        uuid = Column(PgUUID(as_uuid=True))
+        info = Column(JSONB)
+        tags = Column(ARRAY(Text, dimensions=1))
+        payload = Column(LargeBinary)
+        state = Column(azafea.model.NullableBoolean())
+        source = Column(Text, default='unknown')
+
+    class MockCursor:
+        def __init__(self):
+            self.copies = []
+            self.closed = False
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.closed = True
+
+        def copy_expert(self, sql, data):
+            self.copies.append((sql, data.read()))
+
+    class MockConnection:
+        def __init__(self):
+            self.connection = self
+            self.cursor_ = MockCursor()
+
+        def cursor(self):
+            return self.cursor_
+
+    class MockBind:
+        dialect = PGDialect_psycopg2()
+
+    connection = MockConnection()
+    dbsession = azafea.model.DbSession()
+
+    with monkeypatch.context() as m:
+        m.setattr(dbsession, 'get_bind', lambda: MockBind())
+        m.setattr(dbsession, 'connection', lambda: connection)
+        dbsession.insert_all([
+            Event(name='tab\there\nand \\ backslash', flag=True, day=date(2020, 1, 2),
+                  at=datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+                  uuid=UUID('d3863909-8eff-43b6-9a33-ef7eda266195'), info={'a': 1},
+                  tags=['x', 'y "z"', None], payload=b'\x00\x01', state=None),
+            Event(name=None, flag=False),
+            Event(name='other'),
+        ])
+
+    assert not dbsession.new
+    assert connection.cursor_.closed
+
+    # Rows are grouped by the columns they set, with scalar defaults
+    assert connection.cursor_.copies == [
+        ('COPY events (at, day, flag, info, name, payload, source, state, tags, uuid) FROM STDIN',
+         '2020-01-02T03:04:05+00:00\t2020-01-02\tt\t{"a": 1}\t'
+         'tab\\there\\nand \\\\ backslash\t\\\\x0001\tunknown\tunknown\t'
+         '{"x","y \\\\"z\\\\"",NULL}\td3863909-8eff-43b6-9a33-ef7eda266195\n'),
+        ('COPY events (flag, name, source) FROM STDIN',
+         'f\t\\N\tunknown\n'),
+        ('COPY events (name, source) FROM STDIN',
+         'other\tunknown\n'),
+    ]
+
+    # Deregister the test models, to avoid side-effects between tests
+    azafea.model.Base._decl_class_registry.clear()
+    azafea.model.Base.metadata.clear()
+    azafea.model.Base.metadata.dispatch._clear()
+
+
+def test_id_cache(monkeypatch):
+    class Thing(azafea.model.Base):
+        __tablename__ = 'things'
+
+        id = Column(Integer, primary_key=True)
+        name = Column(Text, unique=True)
+
+    class MockQuery:
+        def filter_by(self, **filters):
+            self.filters = filters
+
+            return self
+
+        def scalar(self):
+            statements.append(('SELECT', self.filters))
+
+            return selected.pop(0)
+
+    class MockConnection:
+        def execute(self, stmt):
+            compiled = stmt.compile(dialect=PGDialect_psycopg2())
+            assert 'ON CONFLICT DO NOTHING RETURNING things.id' in str(compiled)
+            statements.append(('INSERT', compiled.params))
+
+            return self
+
+        def scalar(self):
+            return inserted.pop(0)
+
+    def get_row():
+        rows.append({'name': 'a'})
+
+        return rows[-1]
+
+    statements = []
+    rows = []
+    cache = azafea.model.IdCache(Thing, 10)
+    dbsession = azafea.model.DbSession()
+
+    with monkeypatch.context() as m:
+        m.setattr(dbsession, 'query', lambda *entities: MockQuery())
+        m.setattr(dbsession, 'connection', lambda: MockConnection())
+
+        # Only inserted when missing
+        selected, inserted = [None], [3]
+        assert cache.get_id(dbsession, ('a', ), {'name': 'a'}, get_row) == 3
+        assert statements == [('SELECT', {'name': 'a'}), ('INSERT', {'name': 'a'})]
+
+        statements.clear()
+        selected = [4]
+        assert cache.get_id(dbsession, ('b', ), {'name': 'b'}, get_row) == 4
+        assert statements == [('SELECT', {'name': 'b'})]
+
+        # Cached
+        statements.clear()
+        assert cache.get_id(dbsession, ('a', ), {'name': 'a'}, get_row) == 3
+        assert statements == []
+
+        # The row was only built when inserting it
+        assert len(rows) == 1
+
+        # Rolling back a savepoint keeps the rows inserted before it
+        azafea.model._clear_id_caches(dbsession, SimpleNamespace(nested=True))
+        assert cache.get_id(dbsession, ('a', ), {'name': 'a'}, get_row) == 3
+        assert statements == []
+
+        # The row might not exist any more after a rollback, and another worker could insert it
+        # in the meantime
+        dbsession.rollback()
+        statements.clear()
+        selected, inserted = [None, 5], [None]
+        assert cache.get_id(dbsession, ('a', ), {'name': 'a'}, get_row) == 5
+        assert statements == [
+            ('SELECT', {'name': 'a'}), ('INSERT', {'name': 'a'}), ('SELECT', {'name': 'a'})]
+        assert len(rows) == 2
+
+    # Caches which are not used any more are not kept alive
+    num_caches = len(azafea.model._id_caches)
+    del cache
+    gc.collect()
+    assert len(azafea.model._id_caches) == num_caches - 1
+
+    # Deregister the test models, to avoid side-effects between tests
+    azafea.model.Base._decl_class_registry.clear()
+    azafea.model.Base.metadata.clear()
+    azafea.model.Base.metadata.dispatch._clear()
+
+
+def test_process_chunks_invalid_jobs(monkeypatch, mock_sessionmaker):
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        db = azafea.model.Db(Config().postgresql)
+
+    with pytest.raises(ValueError) as excinfo:
+        next(db.process_chunks(None, print, jobs=0))
+
+    assert str(excinfo.value) == 'Invalid number of jobs: 0'
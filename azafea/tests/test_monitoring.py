@@ -0,0 +1,193 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import multiprocessing
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import azafea.config
+import azafea.monitoring
+
+
+class MockChannel:
+    def __init__(self):
+        self.snapshots = []
+
+    def put(self, snapshot):
+        self.snapshots.append(snapshot)
+
+
+class MockRedis:
+    def __init__(self, host, port, password, ssl):
+        pass
+
+    def llen(self, key):
+        return {'some-queue': 42}.get(key, 0)
+
+
+def test_worker_metrics_disabled():
+    metrics = azafea.monitoring.WorkerMetrics(None)
+
+    with metrics.processing('some-queue', 3):
+        metrics.count('records_failed', 'some-queue')
+
+    metrics.flush(force=True)
+
+    assert not metrics.enabled
+    assert metrics.counters == {'records_processed': {}, 'records_failed': {},
+                                'records_retried': {}}
+    assert metrics.histograms == {'processing_seconds': {}, 'db_commit_seconds': {},
+                                  'batch_size': {}}
+
+
+def test_worker_metrics_flush():
+    channel = MockChannel()
+    metrics = azafea.monitoring.WorkerMetrics(channel)
+
+    with metrics.processing('some-queue', 3):
+        metrics.count('records_failed', 'some-queue')
+
+    # Stream entries without data are acknowledged without processing anything
+    with metrics.processing('some-queue', 0):
+        pass
+
+    # Too early
+    metrics.flush()
+    assert channel.snapshots == []
+
+    metrics.flush(force=True)
+    snapshot = channel.snapshots.pop()
+    assert snapshot['counters'] == {
+        'records_processed': {'some-queue': 3},
+        'records_failed': {'some-queue': 1},
+        'records_retried': {},
+    }
+    assert snapshot['histograms']['batch_size'] == {
+        'some-queue': ([0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0], 3.0, 1),
+    }
+    assert snapshot['histograms']['processing_seconds']['some-queue'][2] == 1
+
+    # Only what changed since the last time is sent
+    metrics.flush(force=True)
+    snapshot = channel.snapshots.pop()
+    assert snapshot['counters'] == {'records_processed': {}, 'records_failed': {},
+                                    'records_retried': {}}
+
+
+def test_registry_render():
+    registry = azafea.monitoring.MetricsRegistry()
+    snapshot = {
+        'counters': {'records_processed': {'some-queue': 3}, 'records_failed': {}},
+        'histograms': {'batch_size': {'some-queue': ([1, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0], 4.0, 2)}},
+    }
+    registry.merge(snapshot)
+    registry.merge(snapshot)
+
+    lines = registry.render({'some-queue': 42, 'other"queue': 0}).splitlines()
+    assert 'azafea_queue_length{queue="some-queue"} 42' in lines
+    assert 'azafea_queue_length{queue="other\\"queue"} 0' in lines
+    assert '# TYPE azafea_records_processed_total counter' in lines
+    assert 'azafea_records_processed_total{queue="some-queue"} 6' in lines
+    assert '# TYPE azafea_batch_size histogram' in lines
+    assert 'azafea_batch_size_bucket{queue="some-queue",le="1"} 2' in lines
+    assert 'azafea_batch_size_bucket{queue="some-queue",le="2"} 2' in lines
+    assert 'azafea_batch_size_bucket{queue="some-queue",le="5"} 4' in lines
+    assert 'azafea_batch_size_bucket{queue="some-queue",le="+Inf"} 4' in lines
+    assert 'azafea_batch_size_sum{queue="some-queue"} 8.0' in lines
+    assert 'azafea_batch_size_count{queue="some-queue"} 4' in lines
+
+
+def test_get_stage_timings():
+    registry = azafea.monitoring.MetricsRegistry()
+    registry.merge({
+        'counters': {'records_processed': {'some-queue': 3, 'other"queue': 1}},
+        'histograms': {'processing_seconds': {'some-queue': ([0] * 14, 1.5, 1)}},
+        'stages': {'some-queue': {'decode': 0.25, 'commit': 0.5}},
+    })
+    registry.merge({
+        'counters': {},
+        'histograms': {},
+        'stages': {'some-queue': {'decode': 0.25}},
+    })
+
+    text = registry.render({'some-queue': 42, 'idle-queue': 0})
+    assert 'azafea_stage_seconds_total{queue="some-queue",stage="decode"} 0.5' in text.splitlines()
+
+    assert azafea.monitoring.get_stage_timings(text) == {
+        'some-queue': {'records': 3, 'seconds': 1.5, 'stages': {'decode': 0.5, 'commit': 0.5}},
+        'other"queue': {'records': 1, 'seconds': 0.0, 'stages': {}},
+    }
+
+
+def test_metrics_server(monkeypatch, make_config):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    # Find a free port
+    with socket.socket() as s:
+        s.bind(('', 0))
+        port = s.getsockname()[1]
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'metrics_port': port},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_monitoring'}},
+        })
+
+    channel = multiprocessing.Queue()
+    metrics = azafea.monitoring.WorkerMetrics(channel)
+    metrics.count('records_failed', 'some-queue', 2)
+    metrics.flush(force=True)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.monitoring, 'Redis', MockRedis)
+        server = azafea.monitoring.MetricsServer(config, channel)
+
+    num_threads = threading.active_count()
+    server.start()
+
+    # The server runs in its own process, the controller must not have threads when forking workers
+    assert server.is_alive()
+    assert threading.active_count() == num_threads
+
+    try:
+        for _ in range(50):
+            with urllib.request.urlopen(f'http://localhost:{port}/metrics') as response:
+                body = response.read().decode('utf-8')
+
+            if 'azafea_records_failed_total{' in body:
+                break
+
+            time.sleep(0.1)
+
+        assert 'azafea_queue_length{queue="some-queue"} 42' in body.splitlines()
+        assert 'azafea_records_failed_total{queue="some-queue"} 2' in body.splitlines()
+
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            urllib.request.urlopen(f'http://localhost:{port}/')
+
+        assert exc_info.value.code == 404
+        exc_info.value.close()
+
+    finally:
+        server.stop()
+
+    assert not server.is_alive()
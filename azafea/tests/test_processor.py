@@ -8,19 +8,26 @@
 
 
 from itertools import cycle
+import multiprocessing
 import os
-from signal import SIGINT, SIGTERM
+import pstats
+from signal import SIG_IGN, SIGINT, SIGTERM, SIGUSR1, signal as intercept_signal
 import time
 from typing import Optional, Sequence, Tuple
 
+import psycopg2
+
 from redis.exceptions import ConnectionError as RedisConnectionError
 
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+
 import pytest
 
 from azafea.config import Config
 from azafea.logging import setup_logging
 from azafea.model import PostgresqlConnectionError
 import azafea.processor
+import azafea.queues
 
 
 class MockRedis:
@@ -62,6 +69,176 @@ class MockRedis:
 
         return 1
 
+    def register_script(self, script):
+        return lambda keys, args: []
+
+
+class MockListRedis:
+    """A mock Redis client which actually stores the lists, to test batches"""
+    lists = {}
+    sorted_sets = {}
+
+    def __init__(self, host: str, port: int, password: str, ssl: bool = False):
+        self.connection_pool = MockRedisConnectionPool()
+
+    def rpop(self, key: str) -> Optional[bytes]:
+        print(f'Ran Redis command: RPOP {key}')
+
+        try:
+            return self.lists[key].pop(-1)
+
+        except (IndexError, KeyError):
+            return None
+
+    def lpush(self, name, *values):
+        str_values = b' '.join(values).decode('utf-8')
+        print(f'Ran Redis command: LPUSH {name} {str_values}')
+
+        for value in values:
+            self.lists.setdefault(name, []).insert(0, value)
+
+        return len(self.lists[name])
+
+    def lrange(self, key, start, end):
+        print(f'Ran Redis command: LRANGE {key} {start} {end}')
+        values = self.lists.get(key, [])
+
+        # Redis ranges are inclusive
+        return values[max(start, -len(values)):len(values) if end == -1 else end + 1]
+
+    def ltrim(self, key, start, end):
+        print(f'Ran Redis command: LTRIM {key} {start} {end}')
+        values = self.lists.get(key, [])
+        self.lists[key] = values[max(start, -len(values)):len(values) if end == -1 else end + 1]
+
+        return True
+
+    def rpoplpush(self, src, dst):
+        print(f'Ran Redis command: RPOPLPUSH {src} {dst}')
+
+        try:
+            value = self.lists[src].pop(-1)
+
+        except (IndexError, KeyError):
+            return None
+
+        self.lists.setdefault(dst, []).insert(0, value)
+
+        return value
+
+    def brpoplpush(self, src, dst, timeout=0):
+        return self.rpoplpush(src, dst)
+
+    def delete(self, *names):
+        print(f'Ran Redis command: DEL {" ".join(names)}')
+
+        return sum(1 for name in names if self.lists.pop(name, None) is not None)
+
+    def set(self, name, value, ex=None):
+        print(f'Ran Redis command: SET {name} {value} EX {ex}')
+
+        return True
+
+    def zadd(self, name, mapping):
+        print(f'Ran Redis command: ZADD {name} {b" ".join(mapping).decode()}')
+        self.sorted_sets.setdefault(name, {}).update(mapping)
+
+        return len(mapping)
+
+    def register_script(self, script):
+        # Only the script claiming retries is used
+        def claim_retries(keys, args):
+            now, postponed, count = args
+            sorted_set = self.sorted_sets.get(keys[0], {})
+            due = sorted(((score, member) for member, score in sorted_set.items()
+                          if score <= now))
+            members = [member for _, member in due[:count]]
+            sorted_set.update((member, postponed) for member in members)
+
+            return members
+
+        return claim_retries
+
+    def zrem(self, name, *members):
+        print(f'Ran Redis command: ZREM {name} {b" ".join(members).decode()}')
+        sorted_set = self.sorted_sets.get(name, {})
+
+        return sum(1 for member in members if sorted_set.pop(member, None) is not None)
+
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+
+class MockPipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        def queue_command(*args):
+            self._commands.append((getattr(self._redis, name), args))
+
+        return queue_command
+
+    def execute(self):
+        return [command(*args) for command, args in self._commands]
+
+
+class MockStreamRedis:
+    """A mock Redis client which actually stores the streams, to test the stream backend"""
+    streams = {}
+    claimable = {}
+
+    def __init__(self, host: str, port: int, password: str, ssl: bool = False):
+        self.connection_pool = MockRedisConnectionPool()
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        print(f'Ran Redis command: XGROUP CREATE {name} {groupname} {id}')
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None):
+        name = next(iter(streams))
+        print(f'Ran Redis command: XREADGROUP GROUP {groupname} {consumername} COUNT {count} '
+              f'STREAMS {name} {streams[name]}')
+
+        entries = self.streams.get(name, [])
+        result, self.streams[name] = entries[:count], entries[count:]
+
+        return [[name.encode('utf-8'), result]] if result else []
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id='0-0',
+                   count=None):
+        print(f'Ran Redis command: XAUTOCLAIM {name} {groupname} {consumername} {min_idle_time} '
+              f'{start_id.decode()}')
+
+        return [b'0-0', self.claimable.pop(name, []), []]
+
+    def xack(self, name, groupname, *ids):
+        print(f'Ran Redis command: XACK {name} {groupname} {b" ".join(ids).decode()}')
+
+        return len(ids)
+
+    def xdel(self, name, *ids):
+        print(f'Ran Redis command: XDEL {name} {b" ".join(ids).decode()}')
+
+        return len(ids)
+
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+    def lpush(self, name, *values):
+        print(f'Ran Redis command: LPUSH {name} {b" ".join(values).decode()}')
+
+        return 1
+
+    def register_script(self, script):
+        return lambda keys, args: []
+
 
 class MockRedisConnectionPool:
     def make_connection(self):
@@ -127,6 +304,125 @@ def test_start_then_sigint(capfd, monkeypatch, make_config, mock_sessionmaker):
     assert '{test-worker} Received SIGINT, finishing the current task…' in capture.out
 
 
+def test_start_then_profile(capfd, monkeypatch, make_config, mock_sessionmaker, tmp_path):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor'}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+
+    # Give the process a bit of time to start before sending the signals
+    time.sleep(1)
+    proc.request_profile(records=2, directory=str(tmp_path))
+    time.sleep(1)
+    os.kill(proc.pid, SIGTERM)
+
+    proc.join()
+
+    capture = capfd.readouterr()
+    assert '{test-worker} Profiling the next 2 records, for at most 60 seconds' in capture.out
+    assert f'{{test-worker}} Wrote the profile of 2 records to {tmp_path}' in capture.out
+
+    profiles = list(tmp_path.glob('azafea-test-worker-*.pstats'))
+    assert len(profiles) == 1
+
+    # This is a valid profile
+    stats = pstats.Stats(str(profiles[0]))
+    assert stats.total_calls > 0
+
+
+def test_profile_right_after_start(capfd, monkeypatch, make_config, mock_sessionmaker, tmp_path):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    def slow_intercept_signal(signum, handler):
+        # Leave some time to send the signal before the worker handles it
+        if signum == SIGUSR1 and handler is not SIG_IGN:
+            time.sleep(0.5)
+
+        return intercept_signal(signum, handler)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor'}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockRedis)
+        m.setattr(azafea.processor, 'intercept_signal', slow_intercept_signal)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+
+    # The worker did not get to handle SIGUSR1 yet, this must not kill it
+    proc.request_profile(records=2, directory=str(tmp_path))
+    time.sleep(1.5)
+    os.kill(proc.pid, SIGTERM)
+
+    proc.join()
+    assert proc.exitcode == 0
+
+    capture = capfd.readouterr()
+    assert '{test-worker} Profiling the next 2 records, for at most 60 seconds' in capture.out
+    assert len(list(tmp_path.glob('azafea-test-worker-*.pstats'))) == 1
+
+
+@pytest.mark.parametrize('main_config, message', [
+    ({'worker_max_records': 2}, 'Processed 2 records, exiting to be replaced'),
+    ({'worker_max_memory_mb': 1}, 'MB of memory, exiting to be replaced'),
+])
+def test_recycle(capfd, monkeypatch, make_config, mock_sessionmaker, main_config, message):
+    def process(*args, **kwargs):
+        pass
+
+    def mock_get_callable(module_name, callable_name):
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, **main_config},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor'}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+
+    proc.join(10)
+
+    assert proc.exitcode == azafea.processor.RECYCLE_EXIT_CODE
+
+    capture = capfd.readouterr()
+    assert message in capture.out
+
+
 def test_start_then_sigterm(capfd, monkeypatch, make_config, mock_sessionmaker):
     def process(*args, **kwargs):
         pass
@@ -220,3 +516,478 @@ def test_cannot_connect_to_postgresql(monkeypatch, make_config):
 
         with pytest.raises(PostgresqlConnectionError):
             azafea.processor.Processor('test-worker', config)
+
+
+def test_database_connection_not_shared(monkeypatch, make_config, mock_sessionmaker):
+    disposed = []
+    config = make_config({})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        m.setattr(azafea.model.Db, 'dispose', lambda db: disposed.append(db))
+        proc = azafea.processor.Processor('test-worker', config)
+
+    # The worker opens its own connections once forked
+    assert disposed == [proc._db]
+
+
+def test_process_synchronous_commit(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        pass
+
+    def mock_listen(target, identifier, fn):
+        listened.append(identifier)
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'queues': {
+                'durable-queue': {'handler': 'azafea.tests.test_processor'},
+                'telemetry-queue': {
+                    'handler': 'azafea.tests.test_processor', 'synchronous_commit': False},
+            },
+        })
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+
+    listened = []
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model, 'listen', mock_listen)
+
+        proc._process('telemetry-queue', [b'value'])
+        assert listened == ['after_begin']
+
+        proc._process('durable-queue', [b'value'])
+        assert listened == ['after_begin']
+
+    capture = capfd.readouterr()
+    assert 'LPUSH' not in capture.out
+
+
+def test_process_batch(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        print(f'Processing {record.decode()} in session {id(dbsession)}')
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor', 'batch_size': 3}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(MockListRedis, 'lists', {'some-queue': [b'5', b'4', b'3', b'2', b'1']})
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+    assert 'Ran Redis command: RPOP some-queue' in capture.out
+    assert 'Ran Redis command: LRANGE some-queue -2 -1' in capture.out
+    assert 'Ran Redis command: LTRIM some-queue 0 -3' in capture.out
+    assert '{test-worker} Processing a batch of 3 events from the some-queue queue' in capture.out
+    assert '{test-worker} Processing a batch of 2 events from the some-queue queue' in capture.out
+    assert '{test-worker} Event queues are empty, exiting' in capture.out
+
+    # Records are processed in order, the first 3 in one session and the last 2 in another one
+    processed = [line.split() for line in capture.out.splitlines()
+                 if line.startswith('Processing ')]
+    assert [p[1] for p in processed] == ['1', '2', '3', '4', '5']
+    assert processed[0][-1] == processed[1][-1] == processed[2][-1]
+    assert processed[3][-1] == processed[4][-1]
+
+
+def test_process_weighted_queues(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        print(f'Processing {record.decode()}')
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {
+                'cheap-queue': {'handler': 'azafea.tests.test_processor', 'weight': 3},
+                'expensive-queue': {'handler': 'azafea.tests.test_processor'},
+                'other-queue': {'handler': 'azafea.tests.test_processor', 'workers': 1},
+            },
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(MockListRedis, 'lists', {
+            'cheap-queue': [b'c4', b'c3', b'c2', b'c1'],
+            'expensive-queue': [b'e4', b'e3', b'e2', b'e1'],
+            'other-queue': [b'o1'],
+        })
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config,
+                                          queues=('cheap-queue', 'expensive-queue'))
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+    assert 'other-queue' not in capture.out
+
+    # Both queues are served, 3 times more often the cheap one as long as it has records
+    processed = [line.split()[1] for line in capture.out.splitlines()
+                 if line.startswith('Processing ')]
+    assert processed == ['c1', 'c2', 'e1', 'c3', 'c4', 'e2', 'e3', 'e4']
+
+
+def test_process_batch_with_error(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        if record == b'2':
+            raise ValueError('Oh no!')
+
+        print(f'Processing {record.decode()}')
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor', 'batch_size': 3}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(MockListRedis, 'lists', {'some-queue': [b'3', b'2', b'1']})
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+    assert ('{test-worker} An error occured while processing a batch of 3 events from the '
+            'some-queue queue with azafea.tests.test_processor.process, processing them one by '
+            'one\nDetails:') in capture.err
+
+    # The batch failed after processing the first record, then all were retried one by one
+    assert capture.out.count('Processing 1') == 2
+    assert capture.out.count('Processing 3') == 1
+    assert ('{test-worker} An error occured while processing an event from the some-queue queue '
+            'with azafea.tests.test_processor.process\nDetails:') in capture.err
+    assert 'Ran Redis command: LPUSH errors-some-queue 2' in capture.out
+
+
+@pytest.mark.parametrize('error, transient', [
+    (OperationalError('SELECT 1', {}, Exception('server closed the connection')), True),
+    (DBAPIError('SELECT 1', {}, Exception('connection lost'), connection_invalidated=True), True),
+    (PostgresqlConnectionError(), True),
+    (psycopg2.OperationalError('could not connect to server'), True),
+    (IntegrityError('INSERT', {}, Exception('duplicate key value')), False),
+    (ValueError('Oh no!'), False),
+])
+def test_is_transient_error(error, transient):
+    assert azafea.processor.is_transient_error(error) is transient
+
+
+def test_process_retry(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        if record == b'invalid':
+            raise ValueError('Oh no!')
+
+        retrying.append(dict(MockListRedis.sorted_sets.get('retries-some-queue', {})))
+        raise OperationalError('INSERT', {}, Exception('server closed the connection'))
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True},
+            'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_processor',
+                'max_attempts': 2,
+                'retry_delay_ms': 500,
+            }},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+    monkeypatch.setattr(MockListRedis, 'lists', {})
+    monkeypatch.setattr(MockListRedis, 'sorted_sets', {})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config, multiprocessing.Queue())
+
+    # Invalid records go straight to the error queue, the others wait to be retried
+    retrying = []
+
+    with proc._metrics.processing('some-queue', 2):
+        proc._process('some-queue', [b'transient', b'invalid'])
+    assert MockListRedis.lists == {'errors-some-queue': [b'invalid']}
+
+    retries = MockListRedis.sorted_sets['retries-some-queue']
+    ((member, due),) = retries.items()
+    assert azafea.queues.decode_retry(member) == (1, b'transient')
+    assert due > time.time()
+
+    # Not due yet
+    proc._retry()
+    assert len(retries) == 1
+
+    # The last attempt fails again
+    retries[member] = 0
+    proc._next_retry = 0
+    proc._retry()
+    assert retries == {}
+
+    # The record was postponed rather than removed while retrying it, so that it would be retried
+    # again if the worker had died, but not by other workers in the meantime
+    assert retrying[-1] == {member: pytest.approx(time.time() + 60, abs=5)}
+    assert MockListRedis.lists == {'errors-some-queue': [b'transient', b'invalid']}
+
+    # The retried record was only processed once as far as the metrics are concerned
+    assert proc._metrics.counters['records_processed'] == {'some-queue': 2}
+    assert proc._metrics.counters['records_retried'] == {'some-queue': 1}
+    assert proc._metrics.counters['records_failed'] == {'some-queue': 2}
+
+    capture = capfd.readouterr()
+    assert ('{test-worker} Retrying the event from the some-queue queue in 0.5 seconds, after 1 '
+            'failed attempt') in capture.err
+    assert '{test-worker} Retrying an event from the some-queue queue, attempt 2' in capture.out
+
+
+def test_process_retry_synchronous_commit(monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        pass
+
+    def mock_listen(target, identifier, fn):
+        listened.append(identifier)
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'queues': {
+                'durable-queue': {'handler': 'azafea.tests.test_processor'},
+                'telemetry-queue': {
+                    'handler': 'azafea.tests.test_processor', 'synchronous_commit': False},
+            },
+        })
+
+    member = azafea.queues.encode_retry(b'value', 1)
+    monkeypatch.setattr(MockListRedis, 'lists', {})
+    monkeypatch.setattr(MockListRedis, 'sorted_sets', {'retries-durable-queue': {member: 0}})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+
+    listened = []
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.model, 'listen', mock_listen)
+
+        proc._process('telemetry-queue', [b'value'])
+        assert listened == ['after_begin']
+
+        # Retrying a record from the durable queue right after must not disable synchronous
+        # commits
+        proc._retry()
+        assert listened == ['after_begin']
+
+    assert MockListRedis.sorted_sets == {'retries-durable-queue': {}}
+    assert MockListRedis.lists == {}
+
+
+def test_process_batch_with_batch_processor(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        print(f'Processing {record.decode()}')
+
+    def process_batch(dbsession, records):
+        print(f'Processing batch {b" ".join(records).decode()}')
+
+    callables = {'process': process, 'process_batch': process_batch}
+
+    def mock_get_callable(module_name, callable_name):
+        try:
+            return callables[callable_name]
+
+        except KeyError:
+            raise AttributeError(callable_name)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {'some-queue': {'handler': 'azafea.tests.test_processor', 'batch_size': 3}},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(MockListRedis, 'lists', {'some-queue': [b'4', b'3', b'2', b'1']})
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+
+    # Batches are passed to process_batch, but single records still go through process
+    assert 'Processing batch 1 2 3' in capture.out
+    assert 'Processing 4' in capture.out
+    assert 'Processing 1' not in capture.out
+
+
+def test_process_reliable(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        if record == b'3':
+            raise ValueError('Oh no!')
+
+        print(f'Processing {record.decode()}')
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_processor',
+                'batch_size': 2,
+                'reliable': True,
+            }},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockListRedis)
+        m.setattr(MockListRedis, 'lists', {'some-queue': [b'3', b'2', b'1']})
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        m.setattr(azafea.queues.socket, 'gethostname', lambda: 'some-host')
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+    processing_queue = 'processing-some-queue@some-host.test-worker'
+    assert ('Ran Redis command: SET heartbeat@some-host.test-worker test-worker EX 30'
+            in capture.out)
+    assert f'Ran Redis command: RPOPLPUSH some-queue {processing_queue}' in capture.out
+    assert 'Ran Redis command: RPOP some-queue' not in capture.out
+    assert 'Ran Redis command: LRANGE' not in capture.out
+
+    # Records are only removed from the processing queue once they have been processed, or pushed
+    # to the error queue
+    lines = capture.out.splitlines()
+    assert lines.index('Processing 2') < lines.index(f'Ran Redis command: DEL {processing_queue}')
+    assert lines.index('Ran Redis command: LPUSH errors-some-queue 3') < (
+        len(lines) - 1 - lines[::-1].index(f'Ran Redis command: DEL {processing_queue}'))
+    assert capture.out.count(f'Ran Redis command: DEL {processing_queue}') == 2
+    assert '{test-worker} Event queues are empty, exiting' in capture.out
+
+
+def test_process_stream(capfd, monkeypatch, make_config, mock_sessionmaker):
+    def process(dbsession, record):
+        print(f'Processing {record.decode()}')
+
+    def mock_get_callable(module_name, callable_name):
+        if callable_name != 'process':
+            raise AttributeError(callable_name)
+
+        return process
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.config, 'get_callable', mock_get_callable)
+        config = make_config({
+            'main': {'verbose': True, 'exit_on_empty_queues': True},
+            'queues': {'some-queue': {
+                'handler': 'azafea.tests.test_processor',
+                'backend': 'stream',
+                'batch_size': 2,
+            }},
+        })
+
+    setup_logging(verbose=config.main.verbose)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.processor, 'Redis', MockStreamRedis)
+        m.setattr(MockStreamRedis, 'streams', {'some-queue': [
+            (b'2-0', {b'data': b'2'}),
+            (b'3-0', {b'not-data': b'3'}),
+            (b'4-0', {b'data': b'4'}),
+        ]})
+        m.setattr(MockStreamRedis, 'claimable', {'some-queue': [(b'1-0', {b'data': b'1'})]})
+        m.setattr(azafea.model, 'sessionmaker', mock_sessionmaker)
+        m.setattr(azafea.queues.socket, 'gethostname', lambda: 'some-host')
+        proc = azafea.processor.Processor('test-worker', config)
+        proc.start()
+        proc.join()
+
+    capture = capfd.readouterr()
+    assert 'Ran Redis command: XGROUP CREATE some-queue azafea 0' in capture.out
+    assert ('Ran Redis command: XAUTOCLAIM some-queue azafea some-host.test-worker 60000 0-0'
+            in capture.out)
+    assert '{test-worker} Claimed 1 pending entries from the some-queue stream' in capture.err
+    assert ('Ran Redis command: XREADGROUP GROUP azafea some-host.test-worker COUNT 1 '
+            'STREAMS some-queue >') in capture.out
+    assert ('{test-worker} Ignoring entry b\'3-0\' of the some-queue stream, which has no data '
+            'field') in capture.err
+
+    # The claimed entry filled the first batch with the first new one, all were acknowledged
+    # after processing, including the invalid one
+    assert 'Ran Redis command: XACK some-queue azafea 1-0 2-0' in capture.out
+    assert 'Ran Redis command: XACK some-queue azafea 3-0 4-0' in capture.out
+
+    # Then deleted, so the stream doesn't grow forever
+    assert 'Ran Redis command: XDEL some-queue 1-0 2-0' in capture.out
+    assert 'Ran Redis command: XDEL some-queue 3-0 4-0' in capture.out
+    processed = [line for line in capture.out.splitlines() if line.startswith('Processing ')]
+    assert processed == ['Processing 1', 'Processing 2', 'Processing 4']
+    assert '{test-worker} Event queues are empty, exiting' in capture.out
@@ -0,0 +1,92 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from signal import SIGUSR1
+
+from azafea.logging import setup_logging
+import azafea.profiling
+
+
+def test_profile_records(capfd, monkeypatch, tmp_path):
+    setup_logging(verbose=False)
+    monkeypatch.setattr(azafea.profiling.tempfile, 'gettempdir', lambda: str(tmp_path))
+    profiler = azafea.profiling.WorkerProfiler('test-worker')
+
+    # Not profiling yet
+    profiler.update(10)
+
+    # Sending the signal directly uses the default parameters
+    profiler.handle_signal(SIGUSR1, None)
+    profiler.update()
+    profiler.update(999)
+    assert list(tmp_path.iterdir()) == []
+
+    profiler.update(1)
+    assert len(list(tmp_path.glob('azafea-test-worker-*.pstats'))) == 1
+
+    capture = capfd.readouterr()
+    assert '{test-worker} Profiling the next 1000 records, for at most 60 seconds' in capture.out
+    assert f'{{test-worker}} Wrote the profile of 1000 records to {tmp_path}' in capture.out
+
+
+def test_profile_seconds(capfd, monkeypatch, tmp_path):
+    setup_logging(verbose=False)
+    profiler = azafea.profiling.WorkerProfiler('test-worker')
+
+    def mock_kill(pid, signum):
+        # Don't actually send the signal
+        profiler.handle_signal(signum, None)
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.profiling.os, 'kill', mock_kill)
+        profiler.request(42, seconds=0, directory=str(tmp_path))
+
+    profiler.update()
+    assert len(list(tmp_path.glob('azafea-test-worker-*.pstats'))) == 1
+
+    capture = capfd.readouterr()
+    assert '{test-worker} Profiling the next 1000 records, for at most 0 seconds' in capture.out
+    assert f'{{test-worker}} Wrote the profile of 0 records to {tmp_path}' in capture.out
+
+
+def test_profile_already_profiling(capfd, tmp_path):
+    setup_logging(verbose=False)
+    profiler = azafea.profiling.WorkerProfiler('test-worker')
+
+    profiler._requests.put({'seconds': 60, 'directory': str(tmp_path)})
+    profiler.handle_signal(SIGUSR1, None)
+    profiler.update()
+
+    profiler._requests.put({'records': 1})
+    profiler.handle_signal(SIGUSR1, None)
+    profiler.update()
+
+    # The second request was ignored
+    assert list(tmp_path.iterdir()) == []
+
+    # The worker exits before the end of the profile
+    profiler.stop()
+    profiler.stop()
+    assert len(list(tmp_path.glob('azafea-test-worker-*.pstats'))) == 1
+
+    capture = capfd.readouterr()
+    assert '{test-worker} Already profiling, ignoring the new request' in capture.err
+
+
+def test_profile_invalid_directory(capfd, tmp_path):
+    setup_logging(verbose=False)
+    profiler = azafea.profiling.WorkerProfiler('test-worker')
+
+    profiler._requests.put({'records': 1, 'directory': str(tmp_path / 'nonexistent')})
+    profiler.handle_signal(SIGUSR1, None)
+    profiler.update()
+    profiler.update(1)
+
+    capture = capfd.readouterr()
+    assert f'{{test-worker}} Could not write the profile to {tmp_path}/nonexistent/' in capture.err
@@ -0,0 +1,100 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+from fnmatch import fnmatchcase
+import re
+
+import azafea.queues
+
+
+class MockRedis:
+    def __init__(self, lists, keys):
+        self.lists = lists
+        self.keys = keys
+
+    def scan_iter(self, match):
+        # Redis escapes special characters with a backslash, fnmatch with brackets
+        pattern = re.sub(r'\\(.)', r'[\1]', match)
+
+        for key in list(self.lists):
+            if fnmatchcase(key, pattern):
+                yield key.encode('utf-8')
+
+    def exists(self, name):
+        return int(name in self.keys)
+
+    def rpoplpush(self, src, dst):
+        try:
+            value = self.lists[src].pop(-1)
+
+        except (IndexError, KeyError):
+            return None
+
+        self.lists.setdefault(dst, []).insert(0, value)
+
+        return value
+
+
+def test_requeue_orphaned_records(monkeypatch):
+    lists = {
+        'some[queue]': [b'4'],
+        'processing-some[queue]@this-host.worker-1': [b'2', b'1'],
+        'processing-some[queue]@other-host.worker-1': [b'3'],
+        'processing-some[queue]@busy-host.worker-1': [b'5'],
+        'processing-some[queue]@weird@this-host.worker-1': [b'6'],
+        'processing-someX@this-host.worker-1': [b'7'],
+    }
+    redis = MockRedis(lists, {'heartbeat@busy-host.worker-1'})
+
+    with monkeypatch.context() as m:
+        m.setattr(azafea.queues.socket, 'gethostname', lambda: 'this-host')
+        num_requeued = azafea.queues.requeue_orphaned_records(redis, 'some[queue]')
+
+    # Records from this host and from hosts which stopped sending heartbeats are requeued
+    assert num_requeued == 3
+    assert sorted(lists['some[queue]']) == [b'1', b'2', b'3', b'4']
+    assert lists['processing-some[queue]@this-host.worker-1'] == []
+    assert lists['processing-some[queue]@other-host.worker-1'] == []
+
+    # Records from workers still alive, or from other queues, are left alone
+    assert lists['processing-some[queue]@busy-host.worker-1'] == [b'5']
+    assert lists['processing-some[queue]@weird@this-host.worker-1'] == [b'6']
+    assert lists['processing-someX@this-host.worker-1'] == [b'7']
+
+
+def test_requeue_worker_records():
+    lists = {
+        'some-queue': [b'3'],
+        'processing-some-queue@this-host.worker-1': [b'2', b'1'],
+        'processing-some-queue@this-host.worker-2': [b'4'],
+    }
+    redis = MockRedis(lists, set())
+
+    num_requeued = azafea.queues.requeue_worker_records(redis, 'some-queue', 'this-host.worker-1')
+
+    # The records are requeued in the order they had been pulled
+    assert num_requeued == 2
+    assert lists['some-queue'] == [b'2', b'1', b'3']
+    assert lists['processing-some-queue@this-host.worker-1'] == []
+    assert lists['processing-some-queue@this-host.worker-2'] == [b'4']
+
+
+def test_get_queue_schedule():
+    assert azafea.queues.get_queue_schedule({'a': 1}) == ['a']
+    assert azafea.queues.get_queue_schedule({'a': 1, 'b': 1, 'c': 1}) == ['a', 'b', 'c']
+    assert azafea.queues.get_queue_schedule({'a': 2, 'b': 2}) == ['a', 'b', 'a', 'b']
+    assert azafea.queues.get_queue_schedule({'a': 1, 'b': 3}) == ['b', 'a', 'b', 'b']
+
+
+def test_encode_retry():
+    member = azafea.queues.encode_retry(b'{"some": "record"}', 3)
+    assert azafea.queues.decode_retry(member) == (3, b'{"some": "record"}')
+
+    # The same record can wait to be retried more than once
+    assert azafea.queues.encode_retry(b'{"some": "record"}', 3) != member
@@ -0,0 +1,82 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+import time
+
+import azafea.timing
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(azafea.timing, '_timings', azafea.timing._Timings())
+
+    azafea.timing.start_queue('some-queue')
+
+    with azafea.timing.DECODE:
+        pass
+
+    assert azafea.timing.pop_totals() == {}
+
+
+def test_enable(monkeypatch):
+    listened = []
+
+    monkeypatch.setattr(azafea.timing, '_timings', azafea.timing._Timings())
+    monkeypatch.setattr(azafea.timing, 'listen', lambda target, name, fn: listened.append(name))
+
+    azafea.timing.enable()
+    azafea.timing.enable()
+
+    assert listened == ['before_flush', 'after_flush_postexec', 'before_commit', 'after_commit']
+
+
+def test_nested_stages(monkeypatch):
+    timings = azafea.timing._Timings()
+    timings.enabled = True
+    monkeypatch.setattr(azafea.timing, '_timings', timings)
+
+    @azafea.timing.ORM
+    def build():
+        time.sleep(0.01)
+
+        with azafea.timing.PARSE_PAYLOAD:
+            time.sleep(0.02)
+
+    # Nothing is counted outside of a queue
+    build()
+    assert azafea.timing.pop_totals() == {}
+
+    azafea.timing.start_queue('some-queue')
+    build()
+    build()
+    azafea.timing.stop_queue()
+
+    totals = azafea.timing.pop_totals()
+    assert set(totals) == {'some-queue'}
+    assert 0.02 <= totals['some-queue']['orm'] < 0.04
+    assert 0.04 <= totals['some-queue']['parse-payload'] < 0.06
+
+    # The totals were reset
+    assert azafea.timing.pop_totals() == {}
+
+
+def test_interrupted_stage(monkeypatch):
+    timings = azafea.timing._Timings()
+    timings.enabled = True
+    monkeypatch.setattr(azafea.timing, '_timings', timings)
+
+    azafea.timing.start_queue('some-queue')
+
+    with azafea.timing.ORM:
+        # A failed flush never calls after_flush_postexec
+        azafea.timing.FLUSH.__enter__()
+
+    assert timings.stack == ['orm', 'flush']
+
+    azafea.timing.start_queue('some-queue')
+    assert timings.stack == []
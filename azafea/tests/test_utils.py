@@ -7,6 +7,8 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
+import argparse
+
 import pytest
 
 import azafea.utils
@@ -97,3 +99,36 @@ def test_progress_over(capfd):
     capture = capfd.readouterr()
     assert capture.out == (
         '\r|############################################################|  6 / 6\n')
+
+
+def test_jobs_number():
+    assert azafea.utils.jobs_number('4') == 4
+
+
+@pytest.mark.parametrize('value', ['0', '-2', 'many'])
+def test_jobs_number_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError) as excinfo:
+        azafea.utils.jobs_number(value)
+
+    assert str(excinfo.value) == f'Invalid number of jobs: {value!r}'
+
+
+def test_lru_cache():
+    cache = azafea.utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # This evicts "b", which is now the least recently used
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache.set('a', 4)
+    assert cache.get('a') == 4
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get('a') is None
@@ -0,0 +1,115 @@
+# Copyright (c) 2020 - Endless
+#
+# This file is part of Azafea
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+
+"""Measure the time spent in each stage of processing records
+
+Stages are context managers and decorators, which do nothing until timing is enabled:
+
+    with DECODE:
+        variant = GLib.Variant.new_from_bytes(...)
+
+Stages can be nested, in which case the time spent in the inner one is not counted in the outer
+one. The totals are kept for each queue, and only while a queue is being processed.
+"""
+
+from contextlib import ContextDecorator
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.event import listen
+
+from .model import DbSession
+
+
+class _Timings:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.queue: Optional[str] = None
+        self.stack: List[str] = []
+        self.start = 0.0
+        self.totals: Dict[Tuple[str, str], float] = {}
+
+    def add_elapsed(self, now: float) -> None:
+        if self.stack and self.queue is not None:
+            key = (self.queue, self.stack[-1])
+            self.totals[key] = self.totals.get(key, 0.0) + now - self.start
+
+        self.start = now
+
+
+_timings = _Timings()
+
+
+class Stage(ContextDecorator):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> 'Stage':
+        if _timings.enabled:
+            # Pause the outer stage
+            _timings.add_elapsed(time.perf_counter())
+            _timings.stack.append(self.name)
+
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if _timings.enabled and _timings.stack and _timings.stack[-1] == self.name:
+            # Resume the outer stage
+            _timings.add_elapsed(time.perf_counter())
+            _timings.stack.pop()
+
+
+DECODE = Stage('decode')
+PARSE_PAYLOAD = Stage('parse-payload')
+ORM = Stage('orm')
+FLUSH = Stage('flush')
+COMMIT = Stage('commit')
+
+
+def _before_commit(dbsession: DbSession) -> None:
+    # Releasing a savepoint is not a commit
+    if not dbsession.transaction.nested:
+        COMMIT.__enter__()
+
+
+def enable() -> None:
+    """Start measuring the stages, for the rest of the life of the process"""
+    if _timings.enabled:
+        return
+
+    _timings.enabled = True
+
+    listen(DbSession, 'before_flush', lambda *args: FLUSH.__enter__())
+    listen(DbSession, 'after_flush_postexec', lambda *args: FLUSH.__exit__())
+    listen(DbSession, 'before_commit', _before_commit)
+    listen(DbSession, 'after_commit', lambda *args: COMMIT.__exit__())
+
+
+def start_queue(queue: str) -> None:
+    _timings.queue = queue
+
+    # A stage could have been interrupted by an exception while processing the previous records,
+    # e.g a failed flush
+    _timings.stack.clear()
+
+
+def stop_queue() -> None:
+    _timings.queue = None
+
+
+def pop_totals() -> Dict[str, Dict[str, float]]:
+    """Get the time spent in each stage for each queue since the last call"""
+    totals: Dict[str, Dict[str, float]] = {}
+
+    for (queue, stage), seconds in _timings.totals.items():
+        totals.setdefault(queue, {})[stage] = seconds
+
+    _timings.totals = {}
+
+    return totals
@@ -7,10 +7,16 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 
+import argparse
+from collections import OrderedDict
 from importlib import import_module
 import os
 import sys
-from typing import Callable
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
 
 
 # The Python documentation for os.cpu_count() says:
@@ -32,6 +38,20 @@ def get_callable(module_name: str, callable_name: str) -> Callable:
     return getattr(module, callable_name)
 
 
+def jobs_number(value: str) -> int:
+    """Parse the number of processes to run in parallel, from the command line"""
+    try:
+        jobs = int(value)
+
+    except ValueError:
+        jobs = 0
+
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f'Invalid number of jobs: {value!r}')
+
+    return jobs
+
+
 def progress(current: int, total: int, end: str = '') -> None:
     bar_length = 60
 
@@ -50,3 +70,32 @@ def progress(current: int, total: int, end: str = '') -> None:
     remaining = bar_length - done
 
     print(f'\r|{"#" * done}{" " * remaining}|  {current} / {total}', end=end, flush=True)
+
+
+class LRUCache(Generic[K, V]):
+    """A mapping which only keeps the most recently used items"""
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._items: 'OrderedDict[K, V]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            self._items.move_to_end(key)
+
+        except KeyError:
+            return None
+
+        return self._items[key]
+
+    def set(self, key: K, value: V) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        if len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()